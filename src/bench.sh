@@ -0,0 +1,3 @@
+#!/bin/bash
+
+PYTHONPATH=. python3 workflow_bench.py run --scales 1000,10000,100000
@@ -0,0 +1,132 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import typing as tp
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+from os.path import abspath, dirname, join
+
+import polars as pl
+
+from benchmark.utils import generate_dataset
+from pipeline.utils import SRC_DIR, run_stage
+from profiling.utils import peak_rss_mb, reset_peak_rss
+
+# CLI stages in pipeline order, "{name}" placeholders are replaced with the generated dataset paths
+STAGES = (
+    ("load", ["--train-data-path", "{train}", "--val-data-path", "{val}"]),
+    ("train-candidate-models", []),
+    ("inference-candidates", ["--inference-data-path", "{val}"]),
+    ("train-ranker", ["--train-data-path", "{train}", "--val-data-path", "{val}"]),
+    ("make-recommendations", ["--val-data-path", "{val}"]),
+    ("evaluate-common-metrics", ["--target-path", "{target}"]),
+)
+FUNCTIONS = ("load_data", "get_pairs_with_context", "get_candidates", "rank_candidates")
+
+
+def _prepare_function(name: str, paths: tp.Dict[str, str]) -> tp.Callable[[], int]:
+    # loads the inputs of a benchmarked function and returns a call producing its output row count
+    from configs.schema import DataSchema
+    from data.artifacts import load_artifact
+
+    schema = DataSchema()
+    if name == "load_data":
+        from data.tasks import load_data
+        return lambda: load_data(train_data_path=paths["train"], val_data_path=paths["val"])[0].shape[0]
+
+    val = pl.read_csv(paths["val"], separator="\t")
+    if name == "get_pairs_with_context":
+        from data.utils import get_pairs_with_context
+        train = pl.read_csv(paths["train"], separator="\t")
+        return lambda: get_pairs_with_context(train, val)[0].shape[0]
+
+    if name == "get_candidates":
+        from inference.tasks import get_candidates
+        from inference.utils import get_receipt_indexes
+        models = load_artifact("models.implicit_models", schema)
+        spmat, spmat_norm = load_artifact("models.spmat", schema), load_artifact("models.spmat_norm", schema)
+        user_indexes = get_receipt_indexes(receipt_ids=val["receipt_id"].unique(), encoder=load_artifact("models.encoders", schema)["receipt_id"])
+        return lambda: sum(
+            candidates.shape[0] for candidates in get_candidates(models=models, uim=spmat, uim_norm=spmat_norm, user_indexes=user_indexes).values()
+        )
+
+    if name == "rank_candidates":
+        from inference.tasks import rank_candidates, uses_text_features
+        candidates = load_artifact("data.candidates", schema)
+        item_features, ranker = load_artifact("models.item_features", schema), load_artifact("models.ranker", schema)
+        item_embeddings = load_artifact("models.item_embeddings", schema) if uses_text_features(ranker) else None
+        context = val.select(["receipt_id", "item_id"])
+        return lambda: rank_candidates(
+            context=context, candidates=candidates, item_features=item_features, ranker=ranker, item_embeddings=item_embeddings
+        ).shape[0]
+
+    raise ValueError(f"Unknown benchmark function '{name}', expected one of {FUNCTIONS}")
+
+
+def run_function(name: str, paths: tp.Dict[str, str], work_dir: str) -> tp.Dict[str, tp.Any]:
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+    os.chdir(work_dir)
+    call = _prepare_function(name, paths)
+
+    reset_peak_rss()
+    start_cpu, start = time.process_time(), time.perf_counter()
+    rows = call()
+    return {
+        "seconds": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "peak_rss_mb": peak_rss_mb(),
+        "rows": rows,
+    }
+
+
+def git_commit() -> tp.Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    scales: tp.Sequence[int],
+    n_items: int,
+    output_path: str,
+    functions: tp.Sequence[str] = FUNCTIONS,
+    seed: int = 0,
+    work_dir: tp.Optional[str] = None,
+) -> pl.DataFrame:
+    run = {"run_id": uuid.uuid4().hex[:12], "started_at": datetime.now().isoformat(timespec="seconds"), "commit": git_commit()}
+    records = []
+    os.makedirs(dirname(abspath(output_path)), exist_ok=True)
+    for n_receipts in scales:
+        with tempfile.TemporaryDirectory(dir=work_dir) as scale_dir:
+            for sub_dir in ("cache", "export"):
+                os.makedirs(join(scale_dir, sub_dir))
+            paths = generate_dataset(join(scale_dir, "data"), n_receipts=n_receipts, n_items=n_items, seed=seed)
+            scale = {"n_receipts": n_receipts, "n_items": n_items, "n_train_lines": sum(1 for _ in open(paths["train"])) - 1}
+
+            results = []
+            for stage, args in STAGES:
+                results.append(("stage", stage, run_stage(stage, [arg.format(**paths) for arg in args], scale_dir)))
+            # the same stages in one process, the difference to their sum is interpreter startup, imports and artifact IO
+            results.append(("pipeline", "run-pipeline", run_stage("run-pipeline", [
+                "--train-data-path", paths["train"], "--val-data-path", paths["val"], "--target-path", paths["target"],
+            ], scale_dir)))
+            # every function runs in a fresh process so that its peak memory is not shared with the others
+            for name in functions:
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    results.append(("function", name, pool.submit(run_function, name, paths, scale_dir).result()))
+
+        with open(output_path, "a") as f:
+            for kind, name, result in results:
+                record = {**run, **scale, "kind": kind, "name": name, **result}
+                f.write(json.dumps(record) + "\n")
+                records.append(record)
+    return pl.DataFrame(records)
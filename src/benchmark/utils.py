@@ -0,0 +1,86 @@
+import os
+import typing as tp
+
+import numpy as np
+import polars as pl
+
+
+LINE_ITEMS_SCHEMA = {"receipt_id": pl.Int64, "item_id": pl.Int64, "quantity": pl.Float64, "price": pl.Float64}
+
+
+class Catalogue(tp.NamedTuple):
+    item_ids: np.ndarray
+    item_cdf: np.ndarray
+    item_prices: np.ndarray
+
+
+def generate_catalogue(n_items: int, zipf_exponent: float = 1.1, seed: int = 0) -> Catalogue:
+    rng = np.random.default_rng(seed)
+
+    # item popularity follows a Zipf-like law over a shuffled catalogue, prices are fixed per item
+    item_ids = rng.permutation(n_items).astype(np.int64) + 1
+    popularity = 1 / np.arange(1, n_items + 1) ** zipf_exponent
+    item_cdf = np.cumsum(popularity / popularity.sum())
+    item_prices = np.round(rng.lognormal(mean=4.5, sigma=0.8, size=n_items), 2)
+    return Catalogue(item_ids=item_ids, item_cdf=item_cdf, item_prices=item_prices)
+
+
+def generate_line_items(
+    n_receipts: int,
+    catalogue: Catalogue,
+    mean_basket_size: float = 4.0,
+    first_receipt_id: int = 0,
+    seed: int = 0,
+) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    n_items = catalogue.item_ids.shape[0]
+
+    # baskets hold at least one line, the size is 1 + Poisson so its mean is mean_basket_size
+    basket_sizes = 1 + rng.poisson(max(mean_basket_size - 1, 0), size=n_receipts)
+    receipt_ids = np.repeat(np.arange(first_receipt_id, first_receipt_id + n_receipts, dtype=np.int64), basket_sizes)
+    items = np.searchsorted(catalogue.item_cdf, rng.random(receipt_ids.shape[0]), side="right").clip(max=n_items - 1)
+
+    return pl.DataFrame({
+        "receipt_id": receipt_ids,
+        "item_id": catalogue.item_ids[items],
+        "quantity": (1 + rng.poisson(0.3, size=receipt_ids.shape[0])).astype(np.float64),
+        "price": catalogue.item_prices[items],
+    }, schema=LINE_ITEMS_SCHEMA)
+
+
+def split_target(line_items: pl.DataFrame, seed: int = 0) -> tp.Tuple[pl.DataFrame, pl.DataFrame]:
+    # one random line of every receipt with two or more distinct items is held out as the target
+    rng = np.random.default_rng(seed)
+    line_items = line_items.unique(subset=["receipt_id", "item_id"], maintain_order=True)
+    lengths = line_items.group_by("receipt_id", maintain_order=True).agg(pl.count())["count"].to_numpy().astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    held_out = (offsets + (rng.random(lengths.shape[0]) * lengths).astype(np.int64))[lengths > 1]
+
+    mask = np.zeros(line_items.shape[0], dtype=bool)
+    mask[held_out] = True
+    return line_items.filter(pl.Series(values=~mask)), line_items.filter(pl.Series(values=mask)).select(["receipt_id", "item_id"])
+
+
+def generate_dataset(
+    output_dir: str,
+    n_receipts: int,
+    n_items: int,
+    val_share: float = 0.2,
+    zipf_exponent: float = 1.1,
+    mean_basket_size: float = 4.0,
+    seed: int = 0,
+) -> tp.Dict[str, str]:
+    os.makedirs(output_dir, exist_ok=True)
+    n_val = max(1, int(n_receipts * val_share))
+    n_train = max(1, n_receipts - n_val)
+    # train and val share one catalogue, only their baskets are drawn from separate generators
+    catalogue = generate_catalogue(n_items, zipf_exponent, seed=seed)
+    train = generate_line_items(n_train, catalogue, mean_basket_size, seed=seed + 1)
+    val, target = split_target(
+        generate_line_items(n_val, catalogue, mean_basket_size, first_receipt_id=10 ** 9, seed=seed + 2), seed=seed
+    )
+
+    paths = {name: os.path.join(output_dir, f"{name}.tsv") for name in ("train", "val", "target")}
+    for name, table in (("train", train), ("val", val), ("target", target)):
+        table.write_csv(paths[name], separator="\t")
+    return paths
@@ -1,5 +1,26 @@
 RANDOM_STATE = 2105
+CANDIDATE_GENERATORS = ("bm25", "tfidf", "cosine", "als")
 N_CANDIDATES = 10
+CANDIDATES_BLOCK_SIZE = 20_000
+NEGATIVES_PER_POSITIVE = 1
+N_POPULAR_PRODUCTS = 25
+# item popularity halves over this many days of deltas applied by update, load counts the history as one day
+POPULARITY_HALF_LIFE_DAYS = 30
+# popular lists are kept per store ("store_id") or per "price_band" of the receipt's median price
+# when the line items have the column, None keeps the global list only
+POPULARITY_SEGMENT = "store_id"
+POPULARITY_PRICE_BANDS = [100, 300, 1000]
+# Int32 encoded ids, Float32 scores and features, Int32 ranks and categorical model names,
+# RECS_LOW_MEMORY or workflow.py --low-memory switch it for a single run
+LOW_MEMORY = False
+
+# in-memory size of a line-items chunk relative to its size in the source file
+STREAMING_MEMORY_FACTOR = 4
+
+# update adds the delta co-occurrences to the similarity rows of touched items and rescales the rest, pairs
+# outside a row's top K and global bm25/tf-idf statistics drift; once the appended interactions exceed
+# this share of those the item-item models were fitted on, update refits them
+ITEM_ITEM_REFIT_SHARE = 0.25
 
 
 bm25_config = {
@@ -16,6 +37,21 @@ cosine_config = {
     "K": 15
 }
 
+nn_inference_config = {
+    "block_size": 1000,
+    "max_block_mb": 512,
+    "filter_cart_items": False,
+}
+
+als_inference_config = {
+    "block_size": 512,
+    "item_block_size": 8192,
+    "filter_cart_items": False,
+}
+# int8 item factors for ALS retrieval, recall against exact search is reported on a user sample
+ALS_QUANTIZED_INDEX = False
+ALS_RECALL_SAMPLE = 1_000
+
 als_config = {
     "factors": 5,
     "regularization": 0.01,
@@ -23,3 +59,34 @@ als_config = {
     "random_state": RANDOM_STATE,       
 }
 
+# values tried by sweep-candidate-models, parameters left out keep their *_config value
+sweep_space = {
+    "bm25": {"K": [10, 25, 50, 100], "K1": [0.15, 0.6, 1.2], "B": [0.5, 0.66, 0.8]},
+    "tfidf": {"K": [10, 15, 25, 50, 100]},
+    "cosine": {"K": [10, 15, 25, 50, 100]},
+    "als": {"factors": [5, 16, 32, 64], "regularization": [0.01, 0.1, 1.0], "iterations": [15, 50, 100]},
+}
+# configurations sampled per model by a random sweep
+SWEEP_TRIALS = 10
+
+
+RANKER_FEATURES = ["price", "quantity", "popularity", "context_price", "context_quantity", "context_popularity"]
+# generator scores and ranks of the candidate union, the ranker only uses them when trained with candidate features
+CANDIDATE_FEATURES = [
+    "bm25_score", "bm25_rank", "tfidf_score", "tfidf_rank", "cosine_score", "cosine_rank", "als_score", "als_rank", "popular_rank", "rrf"
+]
+RANKER_CANDIDATE_FEATURES = False
+# cosine between the cart and the candidate name embeddings, needs the embed-items artifact
+TEXT_FEATURES = ["cart_similarity"]
+RANKER_TEXT_FEATURES = False
+# negatives per training receipt drawn from its own candidates when training with candidate features
+CANDIDATE_NEGATIVES = 10
+# candidates kept per receipt after reciprocal-rank fusion of the generators, None keeps the whole union
+CANDIDATES_BUDGET = None
+RRF_K = 60
+RANKER_BATCH_SIZE = 500_000
+# max absolute score difference allowed between the compiled ranker and CatBoost
+COMPILED_RANKER_TOLERANCE = 1e-6
+# cart requests arriving within this window of the first one are scored as one batch
+SERVING_BATCH_WINDOW_MS = 5.0
+SERVING_MAX_BATCH_SIZE = 256
@@ -1,7 +1,22 @@
+import os
 from dataclasses import dataclass
 from datetime import datetime
 from os.path import join
 
+import polars as pl
+
+from configs.model import LOW_MEMORY
+
+
+def low_memory_mode() -> bool:
+    # the environment reaches stage subprocesses and spawned workers, configs.model is the default
+    value = os.environ.get("RECS_LOW_MEMORY")
+    enabled = LOW_MEMORY if value is None else value.lower() in ("1", "true", "yes")
+    if enabled:
+        # categorical model names of separately built frames only concatenate under the global string cache
+        pl.enable_string_cache(True)
+    return enabled
+
 
 @dataclass
 class DataSchema():
@@ -11,27 +26,65 @@ class DataSchema():
         super().__init__()
         self.target_paths = {
             # cache
-            "data.line_items": join(self.cache_dir, "line_items.csv"),
-            "data.prices": join(self.cache_dir, "prices.csv"),
-            "data.quantities": join(self.cache_dir, "quantities.csv"),
-            "data.popularity": join(self.cache_dir, "popularity.csv"),
-            "data.rpi": join(self.cache_dir, "rpi.csv"),
-            "data.candidates": join(self.cache_dir, "candidates.pq"),
-            "data.candidates_tfidf": join(self.cache_dir, "candidates_tfidf.csv"),
-            "data.candidates_cosine": join(self.cache_dir, "candidates_cosine.csv"),
-            "data.candidates_als": join(self.cache_dir, "candidates_als.csv"),
-            "data.candidates_bm25": join(self.cache_dir, "candidates_bm25.csv"),
-            "data.candidates_with_features": join(self.cache_dir, "candidates_with_features.csv"),
-            "data.recommendations": join(self.cache_dir, "recommendations.csv"),
+            "data.line_items": join(self.cache_dir, "line_items.pq"),
+            "data.rpi": join(self.cache_dir, "rpi.pq"),
+            "data.candidates": join(self.cache_dir, "candidates.arrow"),
+            "data.candidates_tfidf": join(self.cache_dir, "candidates_tfidf.arrow"),
+            "data.candidates_cosine": join(self.cache_dir, "candidates_cosine.arrow"),
+            "data.candidates_als": join(self.cache_dir, "candidates_als.arrow"),
+            "data.candidates_bm25": join(self.cache_dir, "candidates_bm25.arrow"),
+            "data.candidates_with_features": join(self.cache_dir, "candidates_with_features.arrow"),
+            "data.recommendations": join(self.cache_dir, "recommendations.pq"),
             "data.recommendations_10": join(self.cache_dir, "recommendations_10.pq"),
-            "data.popular_products": join(self.cache_dir, "popular_products.csv"),
 
             # export
-            "models.spmat_norm": join(self.export_dir, "spmat_norm.jlb"),
-            "models.spmat": join(self.export_dir, "spmat.jlb"),
+            "models.spmat_norm": join(self.export_dir, "spmat_norm"),
+            "models.spmat": join(self.export_dir, "spmat"),
             "models.implicit_models": join(self.export_dir, "implicit_models.jlb"),
-            "models.encoders": join(self.export_dir, "encoders.jlb"),
+            "models.incremental_stats": join(self.export_dir, "incremental_stats"),
+            "models.encoders": join(self.export_dir, "encoders"),
             "models.ranker": join(self.export_dir, "rank_model.jlb"),
+            "models.ranker_compiled": join(self.export_dir, "ranker_compiled"),
+            "models.item_features": join(self.export_dir, "item_features"),
+            "models.item_embeddings": join(self.export_dir, "item_embeddings"),
+            "models.popularity": join(self.export_dir, "popularity"),
             "metrics.common": join(self.export_dir, "common_metrics.jlb"),
             "metrics.candidates": join(self.export_dir, "candidates_metrics.jlb"),
-        }
\ No newline at end of file
+            "metrics.update": join(self.export_dir, "update_metrics.jlb"),
+            "metrics.benchmarks": join(self.export_dir, "benchmarks.jsonl"),
+            "metrics.profile": join(self.export_dir, "profile.jsonl"),
+            "metrics.stages": join(self.export_dir, "stage_manifest.jlb"),
+            "metrics.sweep": join(self.export_dir, "sweep_leaderboard.pq"),
+            "metrics.serving": join(self.export_dir, "serving_load_test.pq"),
+        }
+        # raw receipt and item ids stay Int64 in both modes, they are the join keys against the line items
+        self.low_memory = low_memory_mode()
+        self.code_dtype = pl.Int32 if self.low_memory else pl.Int64
+        self.score_dtype = pl.Float32 if self.low_memory else pl.Float64
+        self.feature_dtype = pl.Float32 if self.low_memory else pl.Float64
+        self.rank_dtype = pl.Int32 if self.low_memory else pl.Int64
+        self.model_name_dtype = pl.Categorical if self.low_memory else pl.Utf8
+
+        candidates_schema = {
+            "model_name": self.model_name_dtype, "receipt_id": pl.Int64, "item_id": pl.Int64, "score": self.score_dtype, "rank": self.rank_dtype
+        }
+        union_schema = {"receipt_id": pl.Int64, "item_id": pl.Int64}
+        for model_name in ("bm25", "tfidf", "cosine", "als", "popular"):
+            union_schema.update({f"{model_name}_score": self.score_dtype, f"{model_name}_rank": self.rank_dtype})
+        union_schema.update({"rrf": self.score_dtype, "rank": self.rank_dtype})
+        self.table_schemas = {
+            "data.rpi": {
+                "receipt_id": pl.Int64,
+                "item_id": pl.Int64,
+                "interaction_score": self.score_dtype,
+                "denum": self.score_dtype,
+                "interaction_score_norm": self.score_dtype,
+            },
+            "data.candidates": union_schema,
+            "data.candidates_tfidf": candidates_schema,
+            "data.candidates_cosine": candidates_schema,
+            "data.candidates_als": candidates_schema,
+            "data.candidates_bm25": candidates_schema,
+            "data.recommendations": {"receipt_id": pl.Int64, "item_id": pl.Int64},
+            "data.recommendations_10": {"receipt_id": pl.Int64, "item_id": pl.List(pl.Int64)},
+        }
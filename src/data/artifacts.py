@@ -0,0 +1,185 @@
+import json
+import os
+import time
+import typing as tp
+from contextlib import contextmanager
+from os.path import join
+
+import numpy as np
+import polars as pl
+from scipy.sparse import csr_matrix
+
+from configs.schema import DataSchema
+from data.encoders import IdEncoder
+from data.features import IncrementalStats, ItemEmbeddings, ItemFeatureStore, PopularityIndex
+from inference.ranker import CompiledRanker
+from profiling.utils import profile_step
+
+
+CSR_ARRAYS = ("indptr", "indices", "data")
+
+# (name, seconds, bytes on disk) of every artifact loaded by this process
+load_report: tp.List[tp.Tuple[str, float, int]] = []
+
+# artifacts saved while in_memory_artifacts is active, later loads in the same process get the object back
+_memory: tp.Dict[str, tp.Any] = {}
+_memory_state: tp.Dict[str, tp.Any] = {"enabled": False, "persist": None}
+
+
+def artifact_size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(join(root, file_name)) for root, _, file_names in os.walk(path) for file_name in file_names)
+    return os.path.getsize(path)
+
+
+def save_csr(path: str, matrix: csr_matrix) -> None:
+    os.makedirs(path, exist_ok=True)
+    for array_name in CSR_ARRAYS:
+        np.save(join(path, f"{array_name}.npy"), getattr(matrix, array_name))
+    with open(join(path, "meta.json"), "w") as f:
+        json.dump({"kind": "csr", "shape": list(matrix.shape)}, f)
+
+
+def load_csr(path: str, mmap: bool = True) -> csr_matrix:
+    with open(join(path, "meta.json")) as f:
+        meta = json.load(f)
+    # copy-on-write like the joblib artifacts: implicit fits need writable buffers, untouched pages stay shared
+    arrays = {name: np.load(join(path, f"{name}.npy"), mmap_mode="c" if mmap else None) for name in CSR_ARRAYS}
+    return csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"]), copy=False)
+
+
+def save_encoders(path: str, encoders: tp.Dict[str, IdEncoder]) -> None:
+    os.makedirs(path, exist_ok=True)
+    for key, encoder in encoders.items():
+        encoder.save(join(path, key))
+    with open(join(path, "meta.json"), "w") as f:
+        json.dump({"kind": "encoders", "keys": list(encoders)}, f)
+
+
+def load_encoders(path: str, mmap: bool = True) -> tp.Dict[str, IdEncoder]:
+    with open(join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return {key: IdEncoder.load(join(path, key), mmap=mmap) for key in meta["keys"]}
+
+
+@contextmanager
+def in_memory_artifacts(persist: tp.Optional[tp.Collection[str]] = None) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+    # stages of one process hand objects over instead of writing and re-reading them,
+    # only the persisted names (all of them when None) still go to disk
+    _memory_state.update(enabled=True, persist=persist)
+    try:
+        yield _memory
+    finally:
+        _memory.clear()
+        _memory_state.update(enabled=False, persist=None)
+
+
+def save_artifact(name: str, obj: tp.Any, schema: tp.Optional[DataSchema] = None) -> None:
+    schema = schema or DataSchema()
+    path = schema.target_paths[name]
+    if _memory_state["enabled"]:
+        _memory[name] = _cast_to_schema(name, obj, schema) if isinstance(obj, pl.DataFrame) else obj
+        if _memory_state["persist"] is not None and name not in _memory_state["persist"]:
+            return
+
+    with profile_step(f"write.{name}", rows=obj.shape[0] if isinstance(obj, (pl.DataFrame, csr_matrix)) else None):
+        if isinstance(obj, pl.DataFrame):
+            obj = _cast_to_schema(name, obj, schema)
+            if path.endswith(".arrow"):
+                obj.write_ipc(path)
+            else:
+                obj.write_parquet(path)
+        elif isinstance(obj, csr_matrix):
+            save_csr(path, obj)
+        elif name == "models.encoders":
+            save_encoders(path, obj)
+        elif isinstance(obj, (ItemFeatureStore, ItemEmbeddings, IncrementalStats, PopularityIndex, CompiledRanker)):
+            obj.save(path)
+        else:
+            import joblib
+
+            joblib.dump(obj, path)
+
+
+def _cast_to_schema(name: str, table: pl.DataFrame, schema: DataSchema) -> pl.DataFrame:
+    table_schema = schema.table_schemas.get(name)
+    if table_schema is None:
+        return table
+    return table.select([pl.col(col).cast(dtype) for col, dtype in table_schema.items()])
+
+
+@contextmanager
+def artifact_writer(name: str, schema: tp.Optional[DataSchema] = None) -> tp.Iterator[tp.Callable[[pl.DataFrame], None]]:
+    # appends DataFrame chunks to a parquet artifact without holding the whole table in memory
+    import pyarrow.parquet as pq
+
+    schema = schema or DataSchema()
+    path = schema.target_paths[name]
+    if not path.endswith(".pq"):
+        raise ValueError(f"Chunked writes are supported for parquet artifacts only, got {path}")
+
+    writer = None
+
+    def write(chunk: pl.DataFrame) -> None:
+        nonlocal writer
+        table = _cast_to_schema(name, chunk, schema).to_arrow()
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+
+    try:
+        yield write
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def load_artifact(name: str, schema: tp.Optional[DataSchema] = None, mmap: bool = True) -> tp.Any:
+    if name in _memory:
+        return _memory[name]
+    schema = schema or DataSchema()
+    path = schema.target_paths[name]
+
+    start = time.perf_counter()
+    with profile_step(f"read.{name}") as record:
+        if path.endswith(".arrow"):
+            obj = pl.read_ipc(path, memory_map=True)
+        elif path.endswith(".pq"):
+            obj = pl.read_parquet(path)
+        elif path.endswith(".jsonl"):
+            obj = pl.read_ndjson(path)
+        elif path.endswith(".jlb"):
+            # numpy arrays inside the pickle (factors, similarity matrices) are mapped copy-on-write,
+            # implicit needs writable buffers but pages stay shared between processes until written
+            import joblib
+
+            obj = joblib.load(path, mmap_mode="c" if mmap else None)
+        elif name == "models.encoders":
+            obj = load_encoders(path, mmap=mmap)
+        elif name == "models.item_features":
+            obj = ItemFeatureStore.load(path, mmap=mmap)
+        elif name == "models.item_embeddings":
+            obj = ItemEmbeddings.load(path, mmap=mmap)
+        elif name == "models.popularity":
+            obj = PopularityIndex.load(path, mmap=mmap)
+        elif name == "models.incremental_stats":
+            obj = IncrementalStats.load(path, mmap=mmap)
+        elif name == "models.ranker_compiled":
+            obj = CompiledRanker.load(path, mmap=mmap)
+        else:
+            obj = load_csr(path, mmap=mmap)
+        record["rows"] = obj.shape[0] if isinstance(obj, (pl.DataFrame, csr_matrix)) else None
+    load_report.append((name, time.perf_counter() - start, artifact_size(path)))
+    return obj
+
+
+def describe_artifacts(schema: tp.Optional[DataSchema] = None) -> pl.DataFrame:
+    schema = schema or DataSchema()
+    rows = []
+    for name, path in schema.target_paths.items():
+        if not os.path.exists(path):
+            continue
+        load_artifact(name, schema)
+        _, seconds, size = load_report[-1]
+        rows.append((name, path, size / 2 ** 20, seconds * 1000))
+    return pl.DataFrame(rows, schema=["artifact", "path", "size_mb", "load_ms"], orient="row")
@@ -0,0 +1,88 @@
+import os
+import typing as tp
+from os.path import exists, join
+
+import numpy as np
+import polars as pl
+
+
+UNKNOWN_POLICIES = ("drop", "raise", "missing")
+MISSING_CODE = -1
+
+
+class IdEncoder:
+    def __init__(self, ids: np.ndarray, sorter: tp.Optional[np.ndarray] = None):
+        # ids[code] is the raw id, sorter orders ids ascending (None when they already are)
+        self.ids = ids
+        self._sorter = sorter
+        self._sorted_ids = ids if sorter is None else ids[sorter]
+
+    @classmethod
+    def fit(cls, values: tp.Union[pl.Series, np.ndarray]) -> "IdEncoder":
+        values = values.to_numpy() if isinstance(values, pl.Series) else values
+        return cls(np.unique(np.asarray(values, dtype=np.int64)))
+
+    def __len__(self) -> int:
+        return self.ids.shape[0]
+
+    def _lookup(self, values: np.ndarray) -> tp.Tuple[np.ndarray, np.ndarray]:
+        values = np.asarray(values, dtype=np.int64)
+        if len(self) == 0:
+            return np.full(values.shape[0], MISSING_CODE, dtype=np.int64), np.zeros(values.shape[0], dtype=bool)
+        pos = np.searchsorted(self._sorted_ids, values).clip(max=len(self) - 1)
+        known = self._sorted_ids[pos] == values
+        codes = pos if self._sorter is None else self._sorter[pos]
+        return codes.astype(np.int64), known
+
+    def contains(self, values: np.ndarray) -> np.ndarray:
+        return self._lookup(values)[1]
+
+    def encode(self, values: tp.Union[pl.Series, np.ndarray], unknown: str = "drop") -> np.ndarray:
+        if unknown not in UNKNOWN_POLICIES:
+            raise ValueError(f"Unknown id policy '{unknown}', expected one of {UNKNOWN_POLICIES}")
+        values = values.to_numpy() if isinstance(values, pl.Series) else values
+        codes, known = self._lookup(values)
+        if known.all():
+            return codes
+        if unknown == "raise":
+            raise KeyError(f"{(~known).sum()} ids are missing from the encoder, e.g. {np.asarray(values)[~known][:5].tolist()}")
+        if unknown == "drop":
+            return codes[known]
+        return np.where(known, codes, MISSING_CODE)
+
+    def decode(self, codes: tp.Union[pl.Series, np.ndarray]) -> np.ndarray:
+        codes = codes.to_numpy() if isinstance(codes, pl.Series) else codes
+        return self.ids[codes]
+
+    def extend(self, values: tp.Union[pl.Series, np.ndarray]) -> "IdEncoder":
+        values = values.to_numpy() if isinstance(values, pl.Series) else values
+        new_ids = np.unique(np.asarray(values, dtype=np.int64))
+        new_ids = new_ids[~self.contains(new_ids)]
+        if new_ids.shape[0] == 0:
+            return self
+        ids = np.concatenate((self.ids, new_ids))
+        sorter = np.argsort(ids, kind="stable")
+        return IdEncoder(ids, None if np.array_equal(sorter, np.arange(ids.shape[0])) else sorter)
+
+    def to_frame(self, key: str, enc_key: str, dtype: type = pl.Int64) -> pl.DataFrame:
+        return pl.DataFrame(
+            [
+                pl.Series(name=key, values=self.ids, dtype=dtype),
+                pl.Series(name=enc_key, values=np.arange(len(self)), dtype=dtype),
+            ]
+        )
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        np.save(join(path, "ids.npy"), self.ids)
+        if self._sorter is not None:
+            np.save(join(path, "sorter.npy"), self._sorter.astype(np.int32 if len(self) < 2 ** 31 else np.int64))
+        elif exists(join(path, "sorter.npy")):
+            os.remove(join(path, "sorter.npy"))
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IdEncoder":
+        mmap_mode = "r" if mmap else None
+        sorter_path = join(path, "sorter.npy")
+        sorter = np.load(sorter_path, mmap_mode=mmap_mode) if exists(sorter_path) else None
+        return cls(np.load(join(path, "ids.npy"), mmap_mode=mmap_mode), sorter)
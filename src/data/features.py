@@ -0,0 +1,460 @@
+import hashlib
+import json
+import os
+import typing as tp
+from os.path import join
+
+import numpy as np
+import polars as pl
+from scipy.sparse import csr_matrix
+
+from configs.model import N_POPULAR_PRODUCTS, POPULARITY_HALF_LIFE_DAYS, POPULARITY_PRICE_BANDS, POPULARITY_SEGMENT
+from data.encoders import IdEncoder
+
+
+ITEM_FEATURES = ("price", "quantity", "popularity")
+# forward-decay weights are rescaled to the current day once new lines would weigh more than this
+MAX_DECAY_FACTOR = 2.0 ** 32
+
+
+class ItemFeatureStore:
+    def __init__(self, encoder: IdEncoder, features: tp.Dict[str, np.ndarray], version: tp.Optional[str] = None):
+        # features[name][code] is the value for the item encoded as code
+        self.encoder = encoder
+        self.features = features
+        self.version = version or self._fingerprint()
+
+    @classmethod
+    def fit(cls, line_items: pl.DataFrame, popularity: tp.Optional["PopularityIndex"] = None) -> "ItemFeatureStore":
+        # popularity comes from the maintained index when there is one instead of a count over line_items
+        encoder = IdEncoder.fit(line_items["item_id"])
+        n_items = len(encoder)
+
+        if popularity is None:
+            counts = np.bincount(encoder.encode(line_items["item_id"], unknown="raise"), minlength=n_items)
+            item_popularity = counts / counts.max()
+        else:
+            item_popularity = popularity.popularity(encoder.ids)
+        distinct = line_items.unique(subset=["item_id", "price", "quantity"])
+        codes = encoder.encode(distinct["item_id"], unknown="raise")
+        # nulls are skipped like in a polars max and sum: fmax ignores NaN and null quantities add nothing,
+        # an item without any price keeps NaN
+        prices = np.full(n_items, np.nan)
+        np.fmax.at(prices, codes, distinct["price"].cast(pl.Float64).to_numpy())
+        quantities = distinct["quantity"].cast(pl.Float64).fill_null(0.0).fill_nan(0.0).to_numpy()
+
+        return cls(encoder, {
+            "price": prices,
+            "quantity": np.bincount(codes, weights=quantities, minlength=n_items),
+            "popularity": item_popularity,
+        })
+
+    def _fingerprint(self) -> str:
+        digest = hashlib.sha1(np.ascontiguousarray(self.encoder.ids).tobytes())
+        for name in sorted(self.features):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(self.features[name]).tobytes())
+        return digest.hexdigest()[:16]
+
+    def __len__(self) -> int:
+        return len(self.encoder)
+
+    def gather(self, item_ids: tp.Union[pl.Series, np.ndarray]) -> tp.Dict[str, np.ndarray]:
+        # unknown items get NaN, the same as a left join against the feature tables
+        codes = self.encoder.encode(item_ids, unknown="missing")
+        known = codes >= 0
+        return {name: np.where(known, values[codes.clip(min=0)], np.nan) for name, values in self.features.items()}
+
+    def segment_mean(
+        self, item_ids: tp.Union[pl.Series, np.ndarray], segments: np.ndarray, n_segments: int
+    ) -> tp.Dict[str, np.ndarray]:
+        # mean over the known items of each segment, NaN for segments without any
+        res = {}
+        for name, values in self.gather(item_ids).items():
+            known = ~np.isnan(values)
+            totals = np.bincount(segments[known], weights=values[known], minlength=n_segments)
+            counts = np.bincount(segments[known], minlength=n_segments)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                res[name] = totals / counts
+        return res
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.encoder.save(join(path, "item_id"))
+        for name, values in self.features.items():
+            np.save(join(path, f"{name}.npy"), values)
+        with open(join(path, "meta.json"), "w") as f:
+            json.dump({"kind": "item_features", "version": self.version, "features": list(self.features)}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "ItemFeatureStore":
+        with open(join(path, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        features = {name: np.load(join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in meta["features"]}
+        return cls(IdEncoder.load(join(path, "item_id"), mmap=mmap), features, meta["version"])
+
+
+class ItemEmbeddings:
+    def __init__(self, encoder: IdEncoder, vectors: np.ndarray):
+        # vectors[code] is the unit-length embedding of the item encoded as code, zero when its name has no known word
+        self.encoder = encoder
+        self.vectors = vectors
+
+    @classmethod
+    def fit(cls, item_ids: pl.Series, vectors: np.ndarray) -> "ItemEmbeddings":
+        encoder = IdEncoder.fit(item_ids)
+        ordered = np.zeros((len(encoder), vectors.shape[1]), dtype=np.float32)
+        ordered[encoder.encode(item_ids, unknown="raise")] = vectors
+        norms = np.linalg.norm(ordered, axis=1, keepdims=True)
+        return cls(encoder, np.divide(ordered, norms, out=np.zeros_like(ordered), where=norms > 0))
+
+    def __len__(self) -> int:
+        return len(self.encoder)
+
+    def gather(self, item_ids: tp.Union[pl.Series, np.ndarray]) -> np.ndarray:
+        # unknown items get a zero vector
+        codes = self.encoder.encode(item_ids, unknown="missing")
+        return np.where((codes >= 0)[:, None], self.vectors[codes.clip(min=0)], 0).astype(np.float32, copy=False)
+
+    def cart_similarity(self, context: pl.DataFrame, candidates: pl.DataFrame, block_size: int = 100_000) -> np.ndarray:
+        # cosine between the mean embedding of the receipt's cart and every candidate row,
+        # NaN when either side has no embedding
+        receipt_ids, segments = np.unique(context["receipt_id"].to_numpy(), return_inverse=True)
+        carts = np.zeros((receipt_ids.shape[0], self.vectors.shape[1]), dtype=np.float32)
+        np.add.at(carts, segments, self.gather(context["item_id"]))
+        norms = np.linalg.norm(carts, axis=1, keepdims=True)
+        carts = np.divide(carts, norms, out=np.zeros_like(carts), where=norms > 0)
+
+        candidate_receipts = candidates["receipt_id"].to_numpy()
+        cart_idxs = np.searchsorted(receipt_ids, candidate_receipts).clip(max=max(receipt_ids.shape[0] - 1, 0))
+        valid = np.zeros(candidates.shape[0], dtype=bool)
+        if receipt_ids.shape[0]:
+            valid = (receipt_ids[cart_idxs] == candidate_receipts) & (norms[cart_idxs, 0] > 0)
+        item_ids = candidates["item_id"].to_numpy()
+
+        similarity = np.empty(candidates.shape[0], dtype=np.float32)
+        for start in range(0, candidates.shape[0], block_size):
+            end = min(start + block_size, candidates.shape[0])
+            items = self.gather(item_ids[start:end])
+            similarity[start:end] = np.einsum("ij,ij->i", carts[cart_idxs[start:end]], items)
+            valid[start:end] &= items.any(axis=1)
+        similarity[~valid] = np.nan
+        return similarity
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.encoder.save(join(path, "item_id"))
+        np.save(join(path, "vectors.npy"), self.vectors)
+        with open(join(path, "meta.json"), "w") as f:
+            json.dump({"kind": "item_embeddings", "dim": self.vectors.shape[1]}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "ItemEmbeddings":
+        mmap_mode = "r" if mmap else None
+        return cls(IdEncoder.load(join(path, "item_id"), mmap=mmap), np.load(join(path, "vectors.npy"), mmap_mode=mmap_mode))
+
+
+class PopularityIndex:
+    def __init__(
+        self,
+        encoder: IdEncoder,
+        weights: np.ndarray,
+        segments: IdEncoder,
+        segment_weights: csr_matrix,
+        top_items: np.ndarray,
+        day: float = 0.0,
+        base_day: float = 0.0,
+        segment_column: tp.Optional[str] = None,
+        half_life: float = POPULARITY_HALF_LIFE_DAYS,
+    ):
+        # weights[code] is the item's line count decayed to base_day: a line sold on day d weighs
+        # 2 ** ((d - base_day) / half_life), so older weights never change when new days are added (forward decay);
+        # segment_weights[segment code, item code] is the same per segment, top_items[0] holds the global
+        # top item codes and top_items[1 + segment code] the segment's, padded with global items and then -1
+        self.encoder = encoder
+        self.weights = weights
+        self.segments = segments
+        self.segment_weights = segment_weights
+        self.top_items = top_items
+        self.day = day
+        self.base_day = base_day
+        self.segment_column = segment_column
+        self.half_life = half_life
+
+    @classmethod
+    def fit(
+        cls,
+        line_items: tp.Union[pl.DataFrame, pl.LazyFrame],
+        segment_column: tp.Optional[str] = POPULARITY_SEGMENT,
+        top_k: int = N_POPULAR_PRODUCTS,
+        half_life: float = POPULARITY_HALF_LIFE_DAYS,
+    ) -> "PopularityIndex":
+        # segments are only kept when the line items have the column they come from
+        if segment_column is not None and _segment_source(segment_column) not in line_items.columns:
+            segment_column = None
+        empty = IdEncoder(np.empty(0, dtype=np.int64))
+        index = cls(
+            encoder=empty,
+            weights=np.empty(0, dtype=np.float64),
+            segments=empty,
+            segment_weights=csr_matrix((0, 0), dtype=np.float64),
+            top_items=np.full((1, top_k), -1, dtype=np.int32),
+            segment_column=segment_column,
+            half_life=half_life,
+        )
+        index.update(line_items)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.encoder)
+
+    @property
+    def top_k(self) -> int:
+        return self.top_items.shape[1]
+
+    def _segment_expr(self) -> pl.Expr:
+        if self.segment_column == "price_band":
+            # band i holds prices in [bounds[i - 1], bounds[i])
+            return pl.sum_horizontal([(pl.col("price") >= bound).cast(pl.Int64) for bound in POPULARITY_PRICE_BANDS])
+        return pl.col(self.segment_column).cast(pl.Int64)
+
+    def _receipt_keys(self, line_items: tp.Union[pl.DataFrame, pl.LazyFrame]) -> tp.Union[pl.DataFrame, pl.LazyFrame]:
+        # segment key of every receipt: the price band of its median price or its store
+        source = _segment_source(self.segment_column)
+        return line_items.group_by("receipt_id").agg(
+            pl.col(source).median() if self.segment_column == "price_band" else pl.col(source).first()
+        ).select([pl.col("receipt_id"), self._segment_expr().alias("segment")])
+
+    def update(self, line_items: tp.Union[pl.DataFrame, pl.LazyFrame], day: tp.Optional[float] = None) -> None:
+        # adds the lines of one day, only their items and segments are touched
+        day = self.day if day is None else day
+        if day < self.day:
+            raise ValueError(f"Popularity index is at day {self.day}, can't add lines of day {day}")
+        keys = ["item_id"] + (["segment"] if self.segment_column else [])
+        lines = line_items.lazy()
+        if self.segment_column:
+            # a line counts towards the segment of its receipt, the one receipt_segments serves the receipt from
+            lines = lines.join(self._receipt_keys(lines), on="receipt_id", how="left")
+        counts = (
+            lines
+            .group_by(keys)
+            .agg(pl.count().alias("count"))
+            .collect(streaming=True)
+        )
+
+        scale = 2.0 ** ((day - self.base_day) / self.half_life)
+        if scale > MAX_DECAY_FACTOR:
+            self.weights = self.weights / scale
+            self.segment_weights = self.segment_weights / scale
+            self.base_day, scale = day, 1.0
+        self.day = day
+
+        self.encoder = self.encoder.extend(counts["item_id"])
+        n_items = len(self.encoder)
+        item_codes = self.encoder.encode(counts["item_id"], unknown="raise")
+        weights = counts["count"].to_numpy().astype(np.float64) * scale
+        self.weights = np.concatenate((self.weights, np.zeros(n_items - self.weights.shape[0]))) + np.bincount(
+            item_codes, weights=weights, minlength=n_items
+        )
+
+        touched = np.empty(0, dtype=np.int64)
+        if self.segment_column:
+            # lines without a segment only count towards the global list
+            segmented = counts["segment"].is_not_null()
+            keys = counts["segment"].filter(segmented)
+            segmented = segmented.to_numpy()
+            self.segments = self.segments.extend(keys)
+            segment_codes = self.segments.encode(keys, unknown="raise")
+            shape = (len(self.segments), n_items)
+            segment_weights = self.segment_weights.copy()
+            segment_weights.resize(shape)
+            self.segment_weights = segment_weights + csr_matrix(
+                (weights[segmented], (segment_codes, item_codes[segmented])), shape=shape
+            )
+            touched = np.unique(segment_codes)
+        self._refresh_top(touched)
+
+    def _top(self, codes: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        # the heaviest items, ties go to the smaller item id
+        if weights.shape[0] > self.top_k:
+            keep = weights >= np.partition(weights, -self.top_k)[-self.top_k]
+            codes, weights = codes[keep], weights[keep]
+        return codes[np.lexsort((self.encoder.ids[codes], -weights))[:self.top_k]]
+
+    def _refresh_top(self, touched: np.ndarray) -> None:
+        top_items = np.full((1 + len(self.segments), self.top_k), -1, dtype=np.int32)
+        top_items[:self.top_items.shape[0]] = self.top_items
+        global_top = self._top(np.arange(len(self)), self.weights)
+        top_items[0, :global_top.shape[0]] = global_top
+
+        # segments with fewer items than the list are padded from the global list, which may have changed
+        segment_sizes = np.diff(self.segment_weights.indptr)
+        for segment in np.union1d(touched, np.flatnonzero(segment_sizes < self.top_k)):
+            start, end = self.segment_weights.indptr[segment], self.segment_weights.indptr[segment + 1]
+            segment_top = self._top(self.segment_weights.indices[start:end], self.segment_weights.data[start:end])
+            items = np.concatenate((segment_top, global_top[~np.isin(global_top, segment_top)]))[:self.top_k]
+            top_items[1 + segment] = -1
+            top_items[1 + segment, :items.shape[0]] = items
+        self.top_items = top_items
+
+    def popularity(self, item_ids: tp.Union[pl.Series, np.ndarray]) -> np.ndarray:
+        # decayed line count relative to the most popular item, 0 for items the index has not seen
+        codes = self.encoder.encode(item_ids, unknown="missing")
+        top = self.weights.max() if len(self) else 1.0
+        return np.where(codes >= 0, self.weights[codes.clip(min=0)], 0.0) / top
+
+    def receipt_segments(self, line_items: pl.DataFrame) -> pl.DataFrame:
+        # segment code of every receipt: its store or the price band of its median price,
+        # -1 (the global list) when the index is not segmented, the lines lack the column or the segment is unknown
+        if self.segment_column is None or _segment_source(self.segment_column) not in line_items.columns:
+            return line_items.select(pl.col("receipt_id").unique()).with_columns(pl.lit(-1, dtype=pl.Int64).alias("segment"))
+        receipts = self._receipt_keys(line_items)
+        keys = receipts["segment"]
+        known = keys.is_not_null()
+        codes = np.full(receipts.shape[0], -1, dtype=np.int64)
+        codes[known.to_numpy()] = self.segments.encode(keys.filter(known), unknown="missing")
+        return receipts.select("receipt_id").with_columns(pl.Series(name="segment", values=codes, dtype=pl.Int64))
+
+    def top_table(self) -> pl.DataFrame:
+        # (segment code, item_id, rank) of every top list, the global list has segment -1
+        segments, ranks = np.nonzero(self.top_items >= 0)
+        return pl.DataFrame([
+            pl.Series(name="segment", values=segments - 1, dtype=pl.Int64),
+            pl.Series(name="item_id", values=self.encoder.decode(self.top_items[segments, ranks]), dtype=pl.Int64),
+            pl.Series(name="rank", values=ranks + 1, dtype=pl.Int64),
+        ])
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        self.encoder.save(join(path, "item_id"))
+        self.segments.save(join(path, "segment"))
+        arrays = {
+            "weights": self.weights,
+            "top_items": self.top_items,
+            "segment_data": self.segment_weights.data,
+            "segment_indices": self.segment_weights.indices,
+            "segment_indptr": self.segment_weights.indptr,
+        }
+        for name, values in arrays.items():
+            np.save(join(path, f"{name}.npy"), values)
+        with open(join(path, "meta.json"), "w") as f:
+            json.dump({
+                "kind": "popularity",
+                "day": self.day,
+                "base_day": self.base_day,
+                "segment_column": self.segment_column,
+                "half_life": self.half_life,
+                "shape": list(self.segment_weights.shape),
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "PopularityIndex":
+        with open(join(path, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ("weights", "top_items", "segment_data", "segment_indices", "segment_indptr")
+        }
+        return cls(
+            encoder=IdEncoder.load(join(path, "item_id"), mmap=mmap),
+            weights=arrays["weights"],
+            segments=IdEncoder.load(join(path, "segment"), mmap=mmap),
+            segment_weights=csr_matrix(
+                (arrays["segment_data"], arrays["segment_indices"], arrays["segment_indptr"]), shape=tuple(meta["shape"])
+            ),
+            top_items=arrays["top_items"],
+            day=meta["day"],
+            base_day=meta["base_day"],
+            segment_column=meta["segment_column"],
+            half_life=meta["half_life"],
+        )
+
+
+class IncrementalStats:
+    def __init__(
+        self,
+        item_sums: tp.Dict[str, np.ndarray],
+        als_gram: np.ndarray,
+        als_lhs: np.ndarray,
+        als_rhs: np.ndarray,
+        n_receipts: int,
+        nnz: int,
+        fitted_nnz: int,
+    ):
+        # running sums the update command works from, so it only reads the delta receipts:
+        # item_sums are spmat_norm sums per item behind the bm25/tf-idf/cosine weightings,
+        # als_gram is the gram matrix of the ALS user factors and als_lhs[item] / als_rhs[item] the item's
+        # terms of its least squares problem; fitted_nnz counts the interactions of the last item-item fit
+        self.item_sums = item_sums
+        self.als_gram = als_gram
+        self.als_lhs = als_lhs
+        self.als_rhs = als_rhs
+        self.n_receipts = n_receipts
+        self.nnz = nnz
+        self.fitted_nnz = fitted_nnz
+
+    @property
+    def n_items(self) -> int:
+        return self.als_rhs.shape[0]
+
+    def add(
+        self,
+        item_sums: tp.Optional[tp.Dict[str, np.ndarray]] = None,
+        als_terms: tp.Optional[tp.Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+        n_receipts: int = 0,
+        nnz: int = 0,
+    ) -> None:
+        # per-item terms may cover items added since, the stored ones are padded with zeros
+        def pad(values: np.ndarray, n_items: int) -> np.ndarray:
+            return np.pad(values, [(0, n_items - values.shape[0])] + [(0, 0)] * (values.ndim - 1))
+
+        if item_sums is not None:
+            n_items = max(self.n_items, *(values.shape[0] for values in item_sums.values()))
+            self.item_sums = {name: pad(self.item_sums[name], n_items) + pad(item_sums[name], n_items) for name in self.item_sums}
+        if als_terms is not None:
+            gram, lhs, rhs = als_terms
+            n_items = max(self.n_items, rhs.shape[0])
+            self.als_gram = self.als_gram + gram
+            self.als_lhs = pad(self.als_lhs, n_items) + pad(lhs, n_items)
+            self.als_rhs = pad(self.als_rhs, n_items) + pad(rhs, n_items)
+        self.n_receipts += n_receipts
+        self.nnz += nnz
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        arrays = {"als_gram": self.als_gram, "als_lhs": self.als_lhs, "als_rhs": self.als_rhs, **self.item_sums}
+        for name, values in arrays.items():
+            np.save(join(path, f"{name}.npy"), values)
+        with open(join(path, "meta.json"), "w") as f:
+            json.dump({
+                "kind": "incremental_stats",
+                "item_sums": list(self.item_sums),
+                "n_receipts": self.n_receipts,
+                "nnz": self.nnz,
+                "fitted_nnz": self.fitted_nnz,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "IncrementalStats":
+        with open(join(path, "meta.json")) as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(join(path, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ["als_gram", "als_lhs", "als_rhs"] + meta["item_sums"]
+        }
+        return cls(
+            item_sums={name: arrays[name] for name in meta["item_sums"]},
+            als_gram=arrays["als_gram"],
+            als_lhs=arrays["als_lhs"],
+            als_rhs=arrays["als_rhs"],
+            n_receipts=meta["n_receipts"],
+            nnz=meta["nnz"],
+            fitted_nnz=meta["fitted_nnz"],
+        )
+
+
+def _segment_source(segment_column: str) -> str:
+    return "price" if segment_column == "price_band" else segment_column
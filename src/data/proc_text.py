@@ -1,48 +1,98 @@
+import itertools
 import re
 import typing as tp
+from functools import lru_cache
 
 import numpy as np
+import polars as pl
+from scipy.sparse import csr_matrix
 
 
-def clean_first_step(string: str) -> str:
-    r1: str = r"\d+(\.\d+)?[гслмк]?[рк]?[м]?[\%]?"
-    r2: str = r"(?<!\S)./"
-    r3: str = r" \/[^\/]*\/"
-    r4: str = r"\w+\."
-    r5: str = r"[а-яА-Я]\/"
-    r6: str = r"\w+\([^\)]*\)"
-    r7: str = r"\*"
+# cleaning rules are compiled once at import, the functions below only apply them
+FIRST_STEP_REGEX = re.compile(
+    r"(%s|%s|%s|%s|%s|%s|%s)" % (
+        r"\d+(\.\d+)?[гслмк]?[рк]?[м]?[\%]?",
+        r"(?<!\S)./",
+        r" \/[^\/]*\/",
+        r"\w+\.",
+        r"[а-яА-Я]\/",
+        r"\w+\([^\)]*\)",
+        r"\*",
+    ),
+    re.IGNORECASE,
+)
+SECOND_STEP_REGEX = re.compile(r"(%s)" % (r"\(\+\)"), re.IGNORECASE)
+DEDUCTIONS = {"Сиг-ты": "Сигареты", "К-са": "Колбаса"}
+UNKNOWN_WORD = "<unk>"
 
-    regex = re.compile(r"(%s|%s|%s|%s|%s|%s|%s)" % (r1, r2, r3, r4, r5, r6, r7), re.IGNORECASE)
 
-    return re.sub(regex, '', string)
+def clean_first_step(string: str) -> str:
+    return FIRST_STEP_REGEX.sub('', string)
 
 
 def clean_second_step(string: str) -> str:
-    r1: str = r"\(\+\)"
-    
-    regex = re.compile(r"(%s)" % (r1), re.IGNORECASE)
-    
-    return re.sub(regex, '', string)
+    return SECOND_STEP_REGEX.sub('', string)
 
 
 def specify_deduction(string: str) -> str:
-    return string \
-                .replace("Сиг-ты", "Сигареты") \
-                .replace("К-са", "Колбаса")
+    for short, full in DEDUCTIONS.items():
+        string = string.replace(short, full)
+    return string
 
 
+@lru_cache(maxsize=2 ** 16)
 def process_sentence(sent: str) -> str:
     return specify_deduction(clean_second_step(clean_first_step(sent)))
 
 
-def get_sentence_embedding(string: str) -> np.array:
-    sent: tp.List[np.array] = []
-    emb = {}
-    for word in process_sentence(string).split():
-        curr_emb: np.array = emb.get(word.lower())
+def process_names(names: pl.Series) -> pl.Series:
+    # every distinct name is cleaned once, repeated names reuse the result
+    unique_names = names.unique()
+    cleaned = pl.Series(values=[process_sentence(name) for name in unique_names.to_list()], dtype=pl.Utf8)
+    mapping = pl.DataFrame([unique_names.alias("name"), cleaned.alias("cleaned")])
+    return pl.DataFrame([names.alias("name")]).join(mapping, on="name", how="left")["cleaned"]
+
+
+def load_word_embeddings(path: str) -> tp.Tuple[tp.Dict[str, int], np.ndarray]:
+    # word2vec / fastText text format: "word v1 v2 ...", optionally preceded by a "n_words dim" header;
+    # lines are parsed one at a time into a float32 table sized from the header, or doubled when there is none
+    vocab, vectors, n_words = {}, np.empty((0, 0), dtype=np.float32), 0
+    with open(path, encoding="utf-8") as f:
+        first = f.readline()
+        header = first.split()
+        capacity, lines = (int(header[0]), f) if len(header) == 2 else (1024, itertools.chain((first,), f))
+        for line in lines:
+            word, _, values = line.rstrip().partition(" ")
+            if not word:
+                continue
+            vector = np.fromstring(values, dtype=np.float32, sep=" ")
+            if not vectors.size:
+                vectors = np.empty((max(capacity, 1), vector.shape[0]), dtype=np.float32)
+            if n_words == vectors.shape[0]:
+                vectors = np.concatenate((vectors, np.empty_like(vectors)))
+            vectors[n_words] = vector
+            # a repeated word points at its last vector
+            vocab[word] = n_words
+            n_words += 1
+    return vocab, vectors[:n_words].copy() if n_words < vectors.shape[0] else vectors
+
+
+def sentence_embeddings(sentences: tp.Sequence[str], vocab: tp.Dict[str, int], vectors: np.ndarray) -> np.ndarray:
+    # mean of the word vectors of every sentence as one sparse (sentences x words) product,
+    # unknown words take the <unk> vector when the table has one and are skipped otherwise
+    unknown = vocab.get(UNKNOWN_WORD, -1)
+    tokens = [[vocab.get(word.lower(), unknown) for word in sentence.split()] for sentence in sentences]
+    lengths = np.fromiter((len(sentence_tokens) for sentence_tokens in tokens), dtype=np.int64, count=len(tokens))
+    word_idxs = np.fromiter((idx for sentence_tokens in tokens for idx in sentence_tokens), dtype=np.int64, count=lengths.sum())
+    rows = np.repeat(np.arange(len(tokens)), lengths)
+
+    known = word_idxs >= 0
+    rows, word_idxs = rows[known], word_idxs[known]
+    counts = np.bincount(rows, minlength=len(tokens))
+    weights = (1 / counts[rows]).astype(np.float32)
+    pooling = csr_matrix((weights, (rows, word_idxs)), shape=(len(tokens), vectors.shape[0]), dtype=np.float32)
+    return np.asarray(pooling @ vectors, dtype=np.float32)
+
 
-        if curr_emb is not None: sent.append(curr_emb)
-        else: sent.append(emb["<unk>"])
-                          
-    return np.mean(np.array(sent), axis=0)
+def get_sentence_embedding(string: str, vocab: tp.Dict[str, int], vectors: np.ndarray) -> np.ndarray:
+    return sentence_embeddings([process_sentence(string)], vocab, vectors)[0]
@@ -1,106 +1,182 @@
-from typing import Dict, Optional, Tuple
+import math
+import os
+import tempfile
+from os.path import join
+from typing import Callable, Dict, List, Optional, Tuple
 
+import numpy as np
 import polars as pl
-from scipy.sparse import csr_matrix
-from data.utils import prepare_rpi, create_sparse_matrices, get_pairs_with_context
+from scipy.sparse import csr_matrix, vstack
+from configs.model import NEGATIVES_PER_POSITIVE, STREAMING_MEMORY_FACTOR
+from configs.schema import DataSchema
+from data.encoders import IdEncoder
+from data.features import ItemEmbeddings, ItemFeatureStore, PopularityIndex
+from data.proc_text import load_word_embeddings, process_names, sentence_embeddings
+from data.utils import prepare_rpi, create_sparse_matrices, get_pairs_with_context, resize_csr, rpi2sparse
+from profiling.utils import profile_step
 
 
-def load_data(train_data_path: str, val_data_path: Optional[str] = None) -> Tuple[pl.DataFrame, csr_matrix, csr_matrix, Dict]:
-    train_li = pl.read_csv(train_data_path, separator="\t")
+def read_line_items(path: str) -> pl.DataFrame:
+    with profile_step("read.line_items") as record:
+        line_items = pl.read_csv(path, separator="\t")
+        record["rows"] = line_items.shape[0]
+    return line_items
+
+
+def load_data(
+    train_data_path: str, val_data_path: Optional[str] = None
+) -> Tuple[pl.DataFrame, csr_matrix, csr_matrix, Dict[str, IdEncoder], PopularityIndex]:
+    train_li = read_line_items(train_data_path)
     if val_data_path:
-        val_li = pl.read_csv(val_data_path, separator="\t")
-        full_li = pl.concat((train_li, val_li))
+        full_li = pl.concat((train_li, read_line_items(val_data_path)))
     else:
         full_li = train_li
 
-    popular_products = full_li["item_id"].value_counts().sort("counts", descending=True).head(25)[["item_id"]]
-    rpi = prepare_rpi(full_li)
-    spmat_norm, spmat, encoders = create_sparse_matrices(rpi)
-    return rpi, spmat, spmat_norm, encoders, popular_products
-
-
-def generate_features(train: pl.DataFrame, val: pl.DataFrame) -> pl.DataFrame:
-    mapping, full_li = get_pairs_with_context(train, val)
-    popularity = full_li["item_id"].value_counts().with_columns((pl.col("counts") / pl.col("counts").max()).alias("popularity")).select(["item_id", "popularity"])
-    prices = full_li.unique(subset=["item_id", "price", "quantity"]).select(["item_id", "price"]).group_by("item_id").agg(pl.col("price").max())
-    quantities = full_li.unique(subset=["item_id", "price", "quantity"]).select(["item_id", "quantity"]).group_by("item_id").agg(pl.col("quantity").sum())
-
-    return mapping.explode("context").join(
-            prices.rename({"price": "context_price"}),
-            left_on="context",
-            right_on="item_id"
-        ).join(
-            prices.rename({"price": "pos_price"}),
-            left_on="positives",
-            right_on="item_id"
-        ).join(
-            prices.rename({"price": "neg_price"}),
-            left_on="negatives",
-            right_on="item_id"
-        ).join(
-            quantities.rename({"quantity": "context_quantity"}),
-            left_on="context",
-            right_on="item_id"
-        ).join(
-            quantities.rename({"quantity": "pos_quantity"}),
-            left_on="positives",
-            right_on="item_id"
-        ).join(
-            quantities.rename({"quantity": "neg_quantity"}),
-            left_on="negatives",
-            right_on="item_id"
-        ).join(
-            popularity.rename({"popularity": "context_popularity"}),
-            left_on="context",
-            right_on="item_id"
-        ).join(
-            popularity.rename({"popularity": "pos_popularity"}),
-            left_on="positives",
-            right_on="item_id"
-        ).join(
-            popularity.rename({"popularity": "neg_popularity"}),
-            left_on="negatives",
-            right_on="item_id"
-        ).group_by("receipt_id").agg(
-            [pl.col("context")] + \
-            [pl.col(col).first() for col in ["positives", "negatives"]] + \
-            [pl.col(col).mean() for col in ["pos_price", "neg_price", "context_price", "context_popularity", "pos_popularity", "neg_popularity"]] + \
-            [pl.col(col).mean() for col in ["pos_quantity", "neg_quantity", "context_quantity"]]
-        ), prices, quantities, popularity
-
-
-def join_candidates_features(candidates: pl.DataFrame, prices: pl.DataFrame, quantities: pl.DataFrame, popularity: pl.DataFrame) -> pl.DataFrame:
-    return candidates.join(
-            prices,
-            how="left",
-            on="item_id"
-        ).join(
-            quantities, 
-            how="left",
-            on="item_id"
-        ).join(
-            popularity, 
-            how="left",
-            on="item_id"
-        )
-
-def join_context_features(context: pl.DataFrame, prices: pl.DataFrame, quantities: pl.DataFrame, popularity :pl.DataFrame) -> pl.DataFrame:
-    return context.explode("context").join(
-            prices.rename({"price": "context_price"}),
-            how="left",
-            left_on="context",
-            right_on="item_id"
-        ).join(
-            quantities.rename({"quantity": "context_quantity"}), 
-            how="left",
-            left_on="context",
-            right_on="item_id"
-        ).join(
-            popularity.rename({"popularity": "context_popularity"}), 
-            how="left",
-            left_on="context",
-            right_on="item_id"
-        ).group_by("receipt_id").agg(
-            [pl.col("context")] + \
-            [pl.col(col).mean() for col in ["context_price", "context_quantity", "context_popularity"]]
-        )
\ No newline at end of file
+    with profile_step("popularity", rows=full_li.shape[0]):
+        popularity = PopularityIndex.fit(full_li)
+    with profile_step("rpi", rows=full_li.shape[0]):
+        rpi = prepare_rpi(full_li).sort(["receipt_id", "item_id"])
+    with profile_step("encode", rows=rpi.shape[0]):
+        spmat_norm, spmat, encoders = create_sparse_matrices(rpi)
+    return rpi, spmat, spmat_norm, encoders, popularity
+
+
+def partition_receipts(paths: List[str], schema: Dict[str, pl.PolarsDataType], last_ids: np.ndarray, out_dir: str) -> List[str]:
+    # a single pass over the files: every batch is split by the receipt range it falls in and its parts are
+    # written to the range's directory, so chunks are read back without parsing the sources again
+    chunk_dirs = [join(out_dir, f"chunk_{chunk}") for chunk in range(last_ids.shape[0])]
+    for chunk_dir in chunk_dirs:
+        os.makedirs(chunk_dir)
+    for path_no, path in enumerate(paths):
+        reader = pl.read_csv_batched(path, separator="\t", dtypes=schema)
+        batch_no = 0
+        while batches := reader.next_batches(1):
+            for batch in batches:
+                chunks = pl.Series(name="chunk", values=np.searchsorted(last_ids, batch["receipt_id"].to_numpy()))
+                for chunk, part in batch.with_columns(chunks).partition_by("chunk", as_dict=True).items():
+                    part.drop("chunk").write_parquet(join(chunk_dirs[chunk], f"{path_no}_{batch_no}.pq"))
+                batch_no += 1
+    return chunk_dirs
+
+
+def load_data_streaming(
+    train_data_path: str,
+    val_data_path: Optional[str],
+    memory_budget_mb: float,
+    write_rpi: Callable[[pl.DataFrame], None],
+) -> Tuple[csr_matrix, csr_matrix, Dict[str, IdEncoder], PopularityIndex]:
+    paths = [path for path in (train_data_path, val_data_path) if path]
+    line_items = pl.concat([pl.scan_csv(path, separator="\t") for path in paths])
+
+    encoders = {
+        key: IdEncoder.fit(line_items.select(pl.col(key).unique()).collect(streaming=True)[key])
+        for key in ("receipt_id", "item_id")
+    }
+    popularity = PopularityIndex.fit(line_items)
+
+    # receipts are split into contiguous code ranges, so every chunk holds complete receipts
+    # (exact normalization) and its rows form one contiguous block of the final matrices
+    n_receipts, n_items = len(encoders["receipt_id"]), len(encoders["item_id"])
+    input_bytes = sum(os.path.getsize(path) for path in paths)
+    n_chunks = min(max(1, math.ceil(input_bytes * STREAMING_MEMORY_FACTOR / (memory_budget_mb * 2 ** 20))), max(n_receipts, 1))
+    bounds = np.linspace(0, n_receipts, n_chunks + 1).astype(np.int64)
+    bounds = [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if lo < hi]
+    receipt_ids = encoders["receipt_id"].ids
+    blocks, blocks_norm = [], []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with profile_step("partition", rows=n_receipts):
+            chunk_dirs = partition_receipts(paths, line_items.schema, receipt_ids[[hi - 1 for _, hi in bounds]], tmp_dir)
+        for (lo, hi), chunk_dir in zip(bounds, chunk_dirs):
+            chunk = pl.read_parquet(join(chunk_dir, "*.pq"))
+            rpi = prepare_rpi(chunk).sort(["receipt_id", "item_id"])
+            write_rpi(rpi)
+
+            rows = encoders["receipt_id"].encode(rpi["receipt_id"], unknown="raise") - lo
+            cols = encoders["item_id"].encode(rpi["item_id"], unknown="raise")
+            shape = (hi - lo, n_items)
+            blocks.append(csr_matrix((rpi["interaction_score"].to_numpy(), (rows, cols)), shape=shape, dtype=np.float32))
+            blocks_norm.append(csr_matrix((rpi["interaction_score_norm"].to_numpy(), (rows, cols)), shape=shape, dtype=np.float32))
+
+    spmat = vstack(blocks, format="csr", dtype=np.float32)
+    spmat_norm = vstack(blocks_norm, format="csr", dtype=np.float32)
+    return spmat, spmat_norm, encoders, popularity
+
+
+def append_line_items(
+    line_items: pl.DataFrame, spmat: csr_matrix, spmat_norm: csr_matrix, encoders: Dict[str, IdEncoder]
+) -> Tuple[pl.DataFrame, csr_matrix, csr_matrix, Dict[str, IdEncoder], np.ndarray, np.ndarray]:
+    known_receipts = encoders["receipt_id"].contains(line_items["receipt_id"].unique().to_numpy())
+    if known_receipts.any():
+        raise ValueError(f"{known_receipts.sum()} receipts are already loaded, only new receipts can be appended")
+
+    # extended encoders keep existing codes, new receipts and items get codes after them
+    rpi = prepare_rpi(line_items).sort(["receipt_id", "item_id"])
+    n_receipts = len(encoders["receipt_id"])
+    encoders = {key: encoders[key].extend(rpi[key]) for key in ("receipt_id", "item_id")}
+    new_spmat_norm, new_spmat = rpi2sparse(rpi, encoders, row_offset=n_receipts)
+
+    n_items = len(encoders["item_id"])
+    spmat = vstack((resize_csr(spmat, (spmat.shape[0], n_items)), new_spmat), format="csr", dtype=np.float32)
+    spmat_norm = vstack((resize_csr(spmat_norm, (spmat_norm.shape[0], n_items)), new_spmat_norm), format="csr", dtype=np.float32)
+
+    new_receipts = np.arange(n_receipts, len(encoders["receipt_id"]))
+    touched_items = np.unique(new_spmat.indices)
+    return rpi, spmat, spmat_norm, encoders, new_receipts, touched_items
+
+
+def generate_features(
+    train: pl.DataFrame, val: pl.DataFrame, n_negatives: int = NEGATIVES_PER_POSITIVE, popularity: Optional[PopularityIndex] = None
+) -> Tuple[pl.DataFrame, ItemFeatureStore]:
+    with profile_step("pairs") as record:
+        mapping, full_li = get_pairs_with_context(train, val, n_negatives=n_negatives)
+        record["rows"] = mapping.shape[0]
+    with profile_step("fit.item_features", rows=full_li.shape[0]):
+        store = ItemFeatureStore.fit(full_li, popularity=popularity)
+
+    context_lengths = mapping["context"].list.lengths().to_numpy()
+    context_segments = np.repeat(np.arange(mapping.shape[0]), context_lengths)
+    context = store.segment_mean(mapping["context"].explode(), context_segments, mapping.shape[0])
+    positives = store.gather(mapping["positives"])
+    negatives = store.gather(mapping["negatives"].explode())
+
+    dtype = DataSchema().feature_dtype
+    return mapping.with_columns(
+        [pl.Series(f"pos_{name}", values, dtype=dtype) for name, values in positives.items()] + \
+        [pl.Series(f"context_{name}", values, dtype=dtype) for name, values in context.items()] + \
+        [pl.Series(f"neg_{name}", values, dtype=dtype).reshape((mapping.shape[0], n_negatives)) for name, values in negatives.items()]
+    ), store
+
+
+def join_candidates_features(candidates: pl.DataFrame, store: ItemFeatureStore) -> pl.DataFrame:
+    dtype = DataSchema().feature_dtype
+    return candidates.with_columns([pl.Series(name, values, dtype=dtype) for name, values in store.gather(candidates["item_id"]).items()])
+
+
+def join_context_features(context: pl.DataFrame, store: ItemFeatureStore) -> pl.DataFrame:
+    # context holds one row per line item, features are averaged over each receipt
+    receipt_ids, segments = np.unique(context["receipt_id"].to_numpy(), return_inverse=True)
+    means = store.segment_mean(context["item_id"], segments, receipt_ids.shape[0])
+    dtype = DataSchema().feature_dtype
+    return pl.DataFrame(
+        [pl.Series("receipt_id", receipt_ids)] + \
+        [pl.Series(f"context_{name}", values, dtype=dtype) for name, values in means.items()]
+    )
+
+
+def embed_item_names(catalogue: pl.DataFrame, embeddings_path: str, name_column: str = "name") -> ItemEmbeddings:
+    catalogue = catalogue.unique(subset="item_id", keep="first", maintain_order=True)
+    with profile_step("clean.names", rows=catalogue.shape[0]):
+        names = process_names(catalogue[name_column].cast(pl.Utf8).fill_null(""))
+    with profile_step("read.word_embeddings") as record:
+        vocab, word_vectors = load_word_embeddings(embeddings_path)
+        record["rows"] = word_vectors.shape[0]
+
+    # items sharing a cleaned name share one pooled vector
+    unique_names, name_idxs = np.unique(names.to_numpy().astype(str), return_inverse=True)
+    with profile_step("embed.names", rows=unique_names.shape[0]):
+        name_vectors = sentence_embeddings(unique_names.tolist(), vocab, word_vectors)
+    return ItemEmbeddings.fit(catalogue["item_id"], name_vectors[name_idxs])
+
+
+def join_cart_similarity(candidates: pl.DataFrame, context: pl.DataFrame, embeddings: ItemEmbeddings) -> pl.DataFrame:
+    return candidates.with_columns(pl.Series("cart_similarity", embeddings.cart_similarity(context=context, candidates=candidates)))
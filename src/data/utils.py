@@ -1,32 +1,36 @@
 import typing as tp
-from typing import Dict, Tuple, Any
+from typing import Dict, Tuple
 
 import polars as pl
 import numpy as np
 from scipy.sparse import csr_matrix
 
+from configs.model import RANDOM_STATE, NEGATIVES_PER_POSITIVE
+from data.encoders import IdEncoder
 from data.proc_text import (
     process_sentence,
     get_sentence_embedding
 )
 
 
-def df2encoder(df: pl.DataFrame, key: str) -> tp.Dict[int, int]:
-    return {key_id: enc_key_id for enc_key_id, key_id in enumerate(df[key].unique())}
+def df2encoder(df: pl.DataFrame, key: str) -> IdEncoder:
+    return IdEncoder.fit(df[key])
 
 
-def encoder2df(encoder: tp.Dict[int, int], key: str, enc_key: str, dtype: type = pl.Int64) -> pl.DataFrame:
-    return pl.DataFrame(data=list(encoder.items()), schema={key: dtype, enc_key: dtype}, orient="row")
+def encoder2df(encoder: IdEncoder, key: str, enc_key: str, dtype: type = pl.Int64) -> pl.DataFrame:
+    return encoder.to_frame(key=key, enc_key=enc_key, dtype=dtype)
 
 
-def df2sparse(df: pl.DataFrame, row: str, col: str, score: str, normalize=False) -> csr_matrix:
+def df2sparse(
+    df: pl.DataFrame, row: str, col: str, score: str, normalize=False, shape: tp.Optional[Tuple[int, int]] = None
+) -> csr_matrix:
     if normalize:
         row_sums = df.group_by(row).agg(pl.col(score).sum().alias("sum"))
         df = df.join(row_sums, on=row)
         vls = (df[score] / df["sum"]).to_numpy()
     else:
         vls = df[score].to_numpy()
-    return csr_matrix((vls, (df[row].to_numpy(), df[col].to_numpy())), dtype=np.float32)
+    return csr_matrix((vls, (df[row].to_numpy(), df[col].to_numpy())), shape=shape, dtype=np.float32)
 
 
 def prepare_rpi(line_itmes: pl.DataFrame) -> pl.DataFrame:
@@ -43,59 +47,96 @@ def prepare_rpi(line_itmes: pl.DataFrame) -> pl.DataFrame:
     return df
 
 
-def create_sparse_matrices(rpi: pl.DataFrame) -> Tuple[csr_matrix, csr_matrix, Dict[Any, Any]]:
+def rpi2sparse(rpi: pl.DataFrame, encoders: Dict[str, IdEncoder], row_offset: int = 0) -> Tuple[csr_matrix, csr_matrix]:
+    # rows are receipt codes shifted by row_offset, so a block of new receipts can be built on its own
+    rpi = rpi.with_columns([
+        pl.Series(name="receipt_id_enc", values=encoders["receipt_id"].encode(rpi["receipt_id"], unknown="raise") - row_offset),
+        pl.Series(name="item_id_enc", values=encoders["item_id"].encode(rpi["item_id"], unknown="raise")),
+    ])
+    shape = (len(encoders["receipt_id"]) - row_offset, len(encoders["item_id"]))
 
-    encoders = {"receipt_id": df2encoder(rpi, "receipt_id"), "item_id": df2encoder(rpi, "item_id")}
-    rpi = rpi.join(encoder2df(encoder=encoders["receipt_id"], key="receipt_id", enc_key="receipt_id_enc"), on=["receipt_id"])
-    rpi = rpi.join(
-        encoder2df(encoder=encoders["item_id"], key="item_id", enc_key="item_id_enc"), on=["item_id"]
-    )
+    spmat_norm: csr_matrix = df2sparse(df=rpi, row="receipt_id_enc", col="item_id_enc", score="interaction_score_norm", shape=shape)
+    spmat: csr_matrix = df2sparse(df=rpi, row="receipt_id_enc", col="item_id_enc", score="interaction_score", shape=shape)
+    return spmat_norm, spmat
 
-    spmat_norm: csr_matrix = df2sparse(df=rpi, row="receipt_id_enc", col="item_id_enc", score="interaction_score_norm")
-    spmat: csr_matrix = df2sparse(df=rpi, row="receipt_id_enc", col="item_id_enc", score="interaction_score")
+
+def create_sparse_matrices(rpi: pl.DataFrame) -> Tuple[csr_matrix, csr_matrix, Dict[str, IdEncoder]]:
+    encoders = {"receipt_id": df2encoder(rpi, "receipt_id"), "item_id": df2encoder(rpi, "item_id")}
+    spmat_norm, spmat = rpi2sparse(rpi, encoders)
     return spmat_norm, spmat, encoders
 
 
+def resize_csr(mat: csr_matrix, shape: Tuple[int, int]) -> csr_matrix:
+    # grows a matrix with empty rows and columns without copying its data
+    if shape[0] < mat.shape[0] or shape[1] < mat.shape[1]:
+        raise ValueError(f"Can't shrink a matrix of shape {mat.shape} to {shape}")
+    indptr = np.concatenate((mat.indptr, np.full(shape[0] - mat.shape[0], mat.indptr[-1], dtype=mat.indptr.dtype)))
+    return csr_matrix((mat.data, mat.indices, indptr), shape=shape, copy=False)
+
+
+def build_sampling_cdf(probs: np.ndarray) -> np.ndarray:
+    cdf = np.cumsum(probs, dtype=np.float64)
+    return cdf / cdf[-1]
+
+
+def sample_negatives(
+    cart_codes: np.ndarray, cart_lengths: np.ndarray, cdf: np.ndarray, n_negatives: int, rng: np.random.Generator
+) -> np.ndarray:
+    n_items = cdf.shape[0]
+    n_carts = cart_lengths.shape[0]
+    cart_idx = np.repeat(np.arange(n_carts, dtype=np.int64), cart_lengths)
+    cart_keys = np.sort(cart_idx * n_items + cart_codes)
+
+    sample_carts = np.repeat(np.arange(n_carts, dtype=np.int64), n_negatives)
+    negatives = np.searchsorted(cdf, rng.random(sample_carts.shape[0]), side="right")
+    pending = np.arange(sample_carts.shape[0])
+    while pending.shape[0] > 0:
+        keys = sample_carts[pending] * n_items + negatives[pending]
+        found = np.searchsorted(cart_keys, keys).clip(max=cart_keys.shape[0] - 1)
+        pending = pending[cart_keys[found] == keys]
+        negatives[pending] = np.searchsorted(cdf, rng.random(pending.shape[0]), side="right")
+    return negatives.reshape(n_carts, n_negatives)
+
+
 def get_pairs_with_context(
     train: pl.DataFrame,
-    val: pl.DataFrame
+    val: pl.DataFrame,
+    n_negatives: int = NEGATIVES_PER_POSITIVE,
+    seed: int = RANDOM_STATE,
 ) -> Tuple[pl.DataFrame, pl.DataFrame]:
-    def sample_neg(cart_items, items, probs):
-        neg_item = np.random.choice(items, p=probs)
-        while neg_item in cart_items:
-            neg_item = np.random.choice(items, p=probs)
-        return neg_item
-
+    rng = np.random.default_rng(seed)
     full_li = pl.concat((train, val))
 
-    tmp = full_li["item_id"].value_counts().with_columns((pl.col("counts") / pl.col("counts").sum()).alias("prob"))
+    tmp = full_li["item_id"].value_counts().sort("item_id").with_columns((pl.col("counts") / pl.col("counts").sum()).alias("prob"))
     items = tmp["item_id"].to_numpy()
-    probs = tmp["prob"].to_numpy()
+    cdf = build_sampling_cdf(tmp["prob"].to_numpy())
 
     r2i_desc = full_li.group_by(["receipt_id", "item_id"]).agg(pl.col("quantity").sum())
 
-    non_empty_cart = r2i_desc.group_by(["receipt_id"]).agg(pl.col("item_id")).filter(pl.col("item_id").list.lengths() > 1)
-
-    context = []
-    positives = []
-    negatives = []
-    for cart_items in non_empty_cart["item_id"]:
-        items_np = np.asarray(cart_items)
-        mask = np.zeros(len(cart_items)).astype(bool)
-        pos_idx = np.random.randint(0, items_np.shape[0])
-        mask[pos_idx] = True
+    non_empty_cart = (
+        r2i_desc.group_by(["receipt_id"])
+        .agg(pl.col("item_id").sort())
+        .filter(pl.col("item_id").list.lengths() > 1)
+        .sort("receipt_id")
+    )
+    cart_items = non_empty_cart.explode("item_id")
 
-        context.append(items_np[~mask])
-        positives.append(items_np[pos_idx])
+    lengths = non_empty_cart["item_id"].list.lengths().to_numpy().astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pos_idx = offsets + (rng.random(lengths.shape[0]) * lengths).astype(np.int64)
+    context_mask = np.ones(cart_items.shape[0], dtype=bool)
+    context_mask[pos_idx] = False
 
-        neg_item = sample_neg(cart_items, items, probs)
-        negatives.append(neg_item)
+    flat_items = cart_items["item_id"].to_numpy()
+    negatives = sample_negatives(
+        cart_codes=np.searchsorted(items, flat_items), cart_lengths=lengths, cdf=cdf, n_negatives=n_negatives, rng=rng
+    )
 
+    context = cart_items.filter(pl.Series(values=context_mask)).group_by("receipt_id", maintain_order=True).agg(pl.col("item_id").alias("context"))
     res = pl.DataFrame({
         "receipt_id": non_empty_cart["receipt_id"],
-        "context": context,
-        "positives": positives,
-        "negatives": negatives
-    })
+        "positives": flat_items[pos_idx],
+        "negatives": pl.Series(values=items[negatives].ravel()).reshape((lengths.shape[0], n_negatives)),
+    }).join(context, on="receipt_id")
 
     return res, full_li
@@ -0,0 +1,53 @@
+import typing as tp
+
+import polars as pl
+
+from evaluation.utils import candidate_hits, candidate_metrics, explode_ranks, ranked_hits, ranking_metrics
+
+
+METRIC_KS = (1, 5, 10)
+CANDIDATE_CUTOFFS = (5, 10, 20, 30, 50)
+
+
+def evaluate_recommendations(
+    recommendations: pl.DataFrame, target: pl.DataFrame, n_items: int, ks: tp.Sequence[int] = METRIC_KS
+) -> tp.Dict[str, float]:
+    ranked = explode_ranks(recommendations)
+    n_target_rows, target = target.shape[0], target.select(["receipt_id", "item_id"]).unique()
+    hits = ranked_hits(ranked, target)
+    relevant = target.group_by("receipt_id").agg(pl.count().alias("n_relevant"))
+    # an item is covered at k when some receipt gets it within its first k positions
+    best_ranks = ranked.group_by("item_id").agg(pl.col("rank").min())["rank"].to_numpy()
+
+    # top-1 accuracy over target rows, the metric this command reported before
+    metrics = {"accuracy": hits.filter(pl.col("rank") == 1).shape[0] / max(n_target_rows, 1)}
+    for k in ks:
+        metrics.update(ranking_metrics(hits, relevant, k))
+        metrics[f"coverage@{k}"] = int((best_ranks <= k).sum()) / n_items
+    return metrics
+
+
+def evaluate_candidates(
+    candidates_by_model: tp.Dict[str, pl.DataFrame], target: pl.DataFrame, cutoffs: tp.Sequence[int] = CANDIDATE_CUTOFFS
+) -> pl.DataFrame:
+    target = target.select(["receipt_id", "item_id"]).unique()
+    # a hit is exclusive when no other generator retrieves the same target pair
+    hits = pl.concat([
+        candidate_hits(candidates, target).with_columns(pl.lit(model_name).alias("model_name"))
+        for model_name, candidates in candidates_by_model.items()
+        if model_name != "union"
+    ])
+    exclusive = (
+        hits.group_by(["receipt_id", "item_id"]).agg([pl.count().alias("n_models"), pl.col("model_name").first()])
+        .filter(pl.col("n_models") == 1)["model_name"].value_counts()
+    )
+    exclusive = dict(zip(exclusive["model_name"], exclusive["counts"]))
+
+    return pl.DataFrame([
+        {
+            "model_name": model_name,
+            **candidate_metrics(candidates, target, cutoffs),
+            "exclusive_recall": exclusive.get(model_name, 0) / max(target.shape[0], 1) if model_name != "union" else None,
+        }
+        for model_name, candidates in candidates_by_model.items()
+    ])
@@ -0,0 +1,71 @@
+import typing as tp
+
+import numpy as np
+import polars as pl
+
+
+def explode_ranks(recommendations: pl.DataFrame) -> pl.DataFrame:
+    # (receipt_id, [item_id, ...]) -> one row per recommended item with its 1-based position
+    lengths = recommendations["item_id"].list.lengths().to_numpy().astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return recommendations.select(["receipt_id", "item_id"]).explode("item_id").drop_nulls("item_id").with_columns(
+        pl.Series(name="rank", values=np.arange(lengths.sum()) - np.repeat(offsets, lengths) + 1, dtype=pl.Int64)
+    )
+
+
+def ideal_dcg(n_relevant: np.ndarray, k: int) -> np.ndarray:
+    gains = np.concatenate(([0.0], np.cumsum(1 / np.log2(np.arange(2, k + 2)))))
+    return gains[np.minimum(n_relevant, k)]
+
+
+def ranked_hits(ranked: pl.DataFrame, target: pl.DataFrame) -> pl.DataFrame:
+    # recommended target items with their position and their position among the receipt's hits
+    return (
+        target.join(ranked, on=["receipt_id", "item_id"])
+        .with_columns(pl.col("rank").rank("ordinal").over("receipt_id").alias("hit_idx"))
+    )
+
+
+def ranking_metrics(hits: pl.DataFrame, relevant: pl.DataFrame, k: int) -> tp.Dict[str, float]:
+    # relevant holds n_relevant for every target receipt, receipts without hits count as misses
+    per_receipt = relevant.join(
+        hits.filter(pl.col("rank") <= k).group_by("receipt_id").agg([
+            pl.count().alias("hits"),
+            (1 / (pl.col("rank") + 1).log(2)).sum().alias("dcg"),
+            (pl.col("hit_idx") / pl.col("rank")).sum().alias("precision_sum"),
+        ]),
+        on="receipt_id",
+        how="left",
+    ).fill_null(0)
+
+    n_relevant = per_receipt["n_relevant"].to_numpy().astype(np.int64)
+    n_hits = per_receipt["hits"].to_numpy().astype(np.float64)
+    return {
+        f"recall@{k}": float(np.mean(n_hits / n_relevant)),
+        f"precision@{k}": float(np.mean(n_hits / k)),
+        f"map@{k}": float(np.mean(per_receipt["precision_sum"].to_numpy() / np.minimum(n_relevant, k))),
+        f"ndcg@{k}": float(np.mean(per_receipt["dcg"].to_numpy() / ideal_dcg(n_relevant, k))),
+    }
+
+
+def candidate_hits(candidates: pl.DataFrame, target: pl.DataFrame) -> pl.DataFrame:
+    return target.select(["receipt_id", "item_id"]).unique().join(
+        candidates.select(["receipt_id", "item_id"]).unique(), on=["receipt_id", "item_id"]
+    )
+
+
+def candidate_metrics(candidates: pl.DataFrame, target: pl.DataFrame, cutoffs: tp.Sequence[int] = ()) -> tp.Dict[str, float]:
+    target = target.select(["receipt_id", "item_id"]).unique()
+    # candidates are only judged on the receipts the target covers
+    candidates = candidates.join(target.select("receipt_id").unique(), on="receipt_id")
+    n_receipts = candidates["receipt_id"].n_unique()
+    hits = candidates.join(target, on=["receipt_id", "item_id"]).unique(subset=["receipt_id", "item_id"])
+    metrics = {
+        "recall": hits.shape[0] / max(target.shape[0], 1),
+        "receipts_covered": n_receipts / max(target["receipt_id"].n_unique(), 1),
+        "candidates_per_receipt": candidates.shape[0] / max(n_receipts, 1),
+    }
+    # recall of the first n candidates, what a smaller N_CANDIDATES or budget would keep
+    for n in cutoffs:
+        metrics[f"recall@{n}"] = hits.filter(pl.col("rank") <= n).shape[0] / max(target.shape[0], 1)
+    return metrics
@@ -0,0 +1,145 @@
+import json
+import os
+import tempfile
+import typing as tp
+from os.path import join
+
+import numpy as np
+
+if tp.TYPE_CHECKING:
+    from catboost import CatBoostRanker
+
+
+RANKER_ARRAYS = ("borders", "border_offsets", "nan_bins", "split_features", "split_bins", "leaf_values")
+# split bin of the padding splits in trees shallower than the deepest one, never exceeded
+PADDING_BIN = np.iinfo(np.int32).max
+
+
+class CompiledRanker:
+    def __init__(
+        self,
+        feature_names: tp.List[str],
+        borders: np.ndarray,
+        border_offsets: np.ndarray,
+        nan_bins: np.ndarray,
+        split_features: np.ndarray,
+        split_bins: np.ndarray,
+        leaf_values: np.ndarray,
+        scale: float = 1.0,
+        bias: float = 0.0,
+        metadata: tp.Optional[tp.Dict[str, str]] = None,
+    ):
+        # borders of feature f are borders[border_offsets[f]:border_offsets[f + 1]], sorted ascending;
+        # a split of tree t at depth d is true when the bin of feature split_features[t, d] exceeds split_bins[t, d]
+        self.feature_names = feature_names
+        self.borders = borders
+        self.border_offsets = border_offsets
+        self.nan_bins = nan_bins
+        self.split_features = split_features
+        self.split_bins = split_bins
+        self.leaf_values = leaf_values
+        self.scale = scale
+        self.bias = bias
+        self.metadata = metadata or {}
+
+        # leaf index of a tree is the sum of independent per-feature contributions, so each feature
+        # gets a (bins, trees) table and scoring is one row gather per feature plus one leaf gather
+        n_trees, depth = split_features.shape
+        table_dtype = np.uint8 if depth <= 8 else np.uint16
+        depth_weights = (1 << np.arange(depth)).astype(table_dtype)
+        self._borders = [np.asarray(borders[border_offsets[idx]:border_offsets[idx + 1]]) for idx in range(len(feature_names))]
+        self._leaf_tables = [
+            ((split_features[None] == idx) & (np.arange(len(feature_borders) + 1)[:, None, None] > split_bins[None])).astype(table_dtype) @ depth_weights
+            for idx, feature_borders in enumerate(self._borders)
+        ]
+        self._leaf_offsets = np.arange(n_trees, dtype=np.int64) << depth
+        self._flat_leaf_values = np.array(leaf_values, dtype=np.float64).ravel()
+
+    @classmethod
+    def from_catboost(cls, ranker: "CatBoostRanker") -> "CompiledRanker":
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "model.json")
+            ranker.save_model(path, format="json")
+            with open(path) as f:
+                model = json.load(f)
+        compiled = cls.from_json(model)
+        compiled.metadata = {key: ranker.get_metadata()[key] for key in ("item_features_version",) if key in ranker.get_metadata()}
+        return compiled
+
+    @classmethod
+    def from_json(cls, model: tp.Dict[str, tp.Any]) -> "CompiledRanker":
+        features = sorted(model["features_info"]["float_features"], key=lambda feature: feature["flat_feature_index"])
+        borders = [np.asarray(feature.get("borders") or [], dtype=np.float32) for feature in features]
+        # the bin of a value is the number of borders below it, NaN goes to the bin its treatment implies
+        nan_bins = np.array(
+            [len(feature_borders) if feature["nan_value_treatment"] == "AsTrue" else 0 for feature, feature_borders in zip(features, borders)],
+            dtype=np.int32,
+        )
+
+        trees = model["oblivious_trees"]
+        depth = max(len(tree["splits"]) for tree in trees)
+        split_features = np.zeros((len(trees), depth), dtype=np.int32)
+        split_bins = np.full((len(trees), depth), PADDING_BIN, dtype=np.int32)
+        leaf_values = np.zeros((len(trees), 1 << depth), dtype=np.float64)
+        for tree_idx, tree in enumerate(trees):
+            for split_idx, split in enumerate(tree["splits"]):
+                if split["split_type"] != "FloatFeature":
+                    raise ValueError(f"Only float feature splits can be compiled, got {split['split_type']}")
+                feature = split["float_feature_index"]
+                split_features[tree_idx, split_idx] = feature
+                split_bins[tree_idx, split_idx] = np.searchsorted(borders[feature], np.float32(split["border"]))
+            leaf_values[tree_idx, :len(tree["leaf_values"])] = tree["leaf_values"]
+
+        scale, bias = model.get("scale_and_bias", [1.0, [0.0]])
+        return cls(
+            feature_names=[feature.get("feature_id") or str(feature["flat_feature_index"]) for feature in features],
+            borders=np.concatenate(borders) if borders else np.empty(0, dtype=np.float32),
+            border_offsets=np.concatenate(([0], np.cumsum([len(feature_borders) for feature_borders in borders]))).astype(np.int64),
+            nan_bins=nan_bins,
+            split_features=split_features,
+            split_bins=split_bins,
+            leaf_values=leaf_values,
+            scale=float(scale),
+            bias=float(bias[0] if isinstance(bias, list) else bias),
+        )
+
+    def get_metadata(self) -> tp.Dict[str, str]:
+        return self.metadata
+
+    def binarize(self, features: np.ndarray) -> np.ndarray:
+        features = np.asarray(features, dtype=np.float32)
+        bins = np.empty(features.shape, dtype=np.intp)
+        for idx, feature_borders in enumerate(self._borders):
+            bins[:, idx] = np.searchsorted(feature_borders, features[:, idx])
+        nans = np.isnan(features)
+        if nans.any():
+            bins[nans] = np.broadcast_to(self.nan_bins, features.shape)[nans]
+        return bins
+
+    def predict(self, features: np.ndarray) -> np.ndarray:
+        bins = self.binarize(features)
+        leaf_idx = self._leaf_tables[0][bins[:, 0]]
+        for idx in range(1, len(self._leaf_tables)):
+            leaf_idx += self._leaf_tables[idx][bins[:, idx]]
+        scores = np.take(self._flat_leaf_values, self._leaf_offsets + leaf_idx).sum(axis=1)
+        return scores * self.scale + self.bias
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in RANKER_ARRAYS:
+            np.save(join(path, f"{name}.npy"), getattr(self, name))
+        with open(join(path, "meta.json"), "w") as f:
+            json.dump({
+                "kind": "compiled_ranker",
+                "feature_names": self.feature_names,
+                "scale": self.scale,
+                "bias": self.bias,
+                "metadata": self.metadata,
+            }, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "CompiledRanker":
+        with open(join(path, "meta.json")) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(join(path, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in RANKER_ARRAYS}
+        return cls(feature_names=meta["feature_names"], scale=meta["scale"], bias=meta["bias"], metadata=meta["metadata"], **arrays)
@@ -0,0 +1,104 @@
+import typing as tp
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+# columns of the first score tile used to bound the k-th score of users without a top-k yet
+THRESHOLD_SAMPLE = 1024
+
+
+class FactorIndex:
+    def __init__(self, item_factors: np.ndarray, quantize: bool = False):
+        # quantized items keep int8 codes with one float32 scale per item, a quarter of the float32 index
+        self.quantize = quantize
+        item_factors = np.asarray(item_factors, dtype=np.float32)
+        if quantize:
+            scales = np.abs(item_factors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.codes = np.round(item_factors / scales[:, None]).astype(np.int8)
+            self.scales = scales.astype(np.float32)
+        else:
+            self.codes = item_factors
+            self.scales = None
+
+    @property
+    def n_items(self) -> int:
+        return self.codes.shape[0]
+
+    def _score_block(self, user_factors: np.ndarray, start: int, end: int) -> np.ndarray:
+        scores = user_factors @ self.codes[start:end].astype(np.float32, copy=False).T
+        if self.scales is not None:
+            scores *= self.scales[start:end]
+        return scores
+
+    def search(
+        self,
+        user_factors: np.ndarray,
+        k: int,
+        exclude: tp.Optional[csr_matrix] = None,
+        allowed_items: tp.Optional[np.ndarray] = None,
+        block_size: int = 512,
+        item_block_size: int = 8192,
+    ) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # users stream through the index in (block_size, item_block_size) score tiles and only a running
+        # top-k per user survives a tile; exclude holds per-user items (e.g. the cart), allowed_items
+        # a boolean item mask (e.g. in stock), filtered items never make it into the result
+        user_factors = np.asarray(user_factors, dtype=np.float32)
+        k = min(k, self.n_items)
+        results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))]
+        for user_start in range(0, user_factors.shape[0], block_size):
+            user_end = min(user_start + block_size, user_factors.shape[0])
+            block_exclude = exclude[user_start:user_end].tocoo() if exclude is not None else None
+            rows, items, scores = results[0]
+            kth = np.full(user_end - user_start, -np.inf, dtype=np.float32)
+
+            for item_start in range(0, self.n_items, item_block_size):
+                item_end = min(item_start + item_block_size, self.n_items)
+                block_scores = self._score_block(user_factors[user_start:user_end], item_start, item_end)
+                if allowed_items is not None:
+                    block_scores[:, ~allowed_items[item_start:item_end]] = -np.inf
+                if block_exclude is not None:
+                    in_block = (block_exclude.col >= item_start) & (block_exclude.col < item_end)
+                    block_scores[block_exclude.row[in_block], block_exclude.col[in_block] - item_start] = -np.inf
+
+                # the k-th score among the first columns bounds the final k-th score from below, so users
+                # without a full top-k yet get a threshold that still prunes most of the tile
+                threshold = kth.copy()
+                unfilled = np.isneginf(kth)
+                if unfilled.any() and block_scores.shape[1] >= k:
+                    sample = block_scores[unfilled, :max(k, THRESHOLD_SAMPLE)]
+                    threshold[unfilled] = -np.partition(-sample, k - 1, axis=1)[:, k - 1]
+                candidate_rows, candidate_cols = np.divmod(np.flatnonzero(block_scores >= threshold[:, None]), block_scores.shape[1])
+
+                rows, items, scores, ranks = _merge_topk(
+                    np.concatenate((rows, candidate_rows)),
+                    np.concatenate((items, candidate_cols + item_start)),
+                    np.concatenate((scores, block_scores[candidate_rows, candidate_cols])),
+                    k,
+                )
+                kth[rows[ranks == k - 1]] = scores[ranks == k - 1]
+            results.append((rows + user_start, items, scores))
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+
+def _merge_topk(
+    rows: np.ndarray, items: np.ndarray, scores: np.ndarray, k: int
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # best k finite scores of every row, ordered by row and descending score
+    finite = np.isfinite(scores)
+    rows, items, scores = rows[finite], items[finite], scores[finite]
+    order = np.lexsort((items, -scores, rows))
+    rows, items, scores = rows[order], items[order], scores[order]
+    ranks = np.arange(rows.shape[0]) - np.searchsorted(rows, rows, side="left")
+    keep = ranks < k
+    return rows[keep], items[keep], scores[keep], ranks[keep]
+
+
+def search_recall(
+    approx: tp.Tuple[np.ndarray, np.ndarray], exact: tp.Tuple[np.ndarray, np.ndarray], n_items: int
+) -> float:
+    # share of the exact (user, item) results that the approximate search also returns
+    approx_keys = approx[0] * n_items + approx[1]
+    exact_keys = exact[0] * n_items + exact[1]
+    return float(np.isin(exact_keys, approx_keys).mean()) if exact_keys.shape[0] else 1.0
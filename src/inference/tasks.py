@@ -1,56 +1,502 @@
+import os
+import tempfile
 import typing as tp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from os.path import join
 
+import numpy as np
 import polars as pl
 from scipy.sparse import csr_matrix
 
-from configs.model import N_CANDIDATES
-from inference.utils import nearest_neighbours_inference, alternating_least_squares_inference
-from data.utils import encoder2df
+from configs.model import (
+    ALS_QUANTIZED_INDEX,
+    ALS_RECALL_SAMPLE,
+    CANDIDATE_GENERATORS,
+    N_CANDIDATES,
+    CANDIDATES_BLOCK_SIZE,
+    CANDIDATES_BUDGET,
+    CANDIDATE_NEGATIVES,
+    COMPILED_RANKER_TOLERANCE,
+    RANKER_BATCH_SIZE,
+    RANDOM_STATE,
+    RRF_K,
+    TEXT_FEATURES,
+    als_inference_config,
+    nn_inference_config,
+)
+from configs.schema import DataSchema
+from inference.ranker import CompiledRanker
+from inference.retrieval import FactorIndex, search_recall
+from profiling.utils import profile_step
+from inference.utils import (
+    alternating_least_squares_candidates,
+    build_cart_matrices,
+    candidates_frame,
+    nearest_neighbours_candidates,
+    decode,
+    get_receipt_indexes,
+    receipt_shards,
+    split_list_to_blocks,
+)
+from data.artifacts import load_artifact
+from data.encoders import IdEncoder
+from data.features import ItemEmbeddings, ItemFeatureStore, PopularityIndex
+from data.tasks import join_candidates_features, join_cart_similarity, join_context_features
+
+# CatBoost and implicit only annotate here, commands that never score or fit do not import them
+if tp.TYPE_CHECKING:
+    from catboost import CatBoostRanker
+    from implicit.als import AlternatingLeastSquares
+
+
+# read-only inputs of the running get_candidates call, inherited by forked workers
+_shared: tp.Dict[str, tp.Any] = {}
+
+
+def generate_block_candidates(model_name: str, user_indexes: tp.List[int]) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    models, uim, uim_norm = _shared["models"], _shared["uim"], _shared["uim_norm"]
+    if model_name == "als":
+        return alternating_least_squares_candidates(
+            model=models["als"], uim=uim, user_idxs=user_indexes, n_candidates_default=N_CANDIDATES,
+            recalculate_user=_shared["fold_in"], index=_shared["als_index"], allowed_items=_shared["allowed_items"],
+            **als_inference_config
+        )
+    return nearest_neighbours_candidates(
+        model=models[model_name], uim=uim_norm, user_idxs=user_indexes, n_candidates_default=N_CANDIDATES,
+        **nn_inference_config
+    )
+
+
+def _init_process_worker():
+    # OpenMP and polars thread pools do not survive fork: workers score single-threaded
+    # and return plain arrays, frames are only built in the parent process
+    for model in _shared["models"].values():
+        if hasattr(model, "num_threads"):
+            model.num_threads = 1
+
+
+def als_index_recall(
+    model: "AlternatingLeastSquares", index: FactorIndex, uim: csr_matrix, user_indexes: tp.List[int], fold_in: bool, allowed_items: tp.Optional[np.ndarray]
+) -> float:
+    sample = user_indexes[:ALS_RECALL_SAMPLE]
+    approx, exact = (
+        alternating_least_squares_candidates(
+            model=model, uim=uim, user_idxs=sample, n_candidates_default=N_CANDIDATES, recalculate_user=fold_in,
+            index=sample_index, allowed_items=allowed_items, **als_inference_config
+        )
+        for sample_index in (index, FactorIndex(model.item_factors))
+    )
+    return search_recall(approx[:2], exact[:2], n_items=uim.shape[1])
 
 
 def get_candidates(
-    models: tp.Dict, uim: csr_matrix, uim_norm: csr_matrix, user_indexes: tp.List[int]
+    models: tp.Dict,
+    uim: csr_matrix,
+    uim_norm: csr_matrix,
+    user_indexes: tp.List[int],
+    workers: int = 1,
+    executor: str = "thread",
+    fold_in: bool = False,
+    allowed_items: tp.Optional[np.ndarray] = None,
+    quantize: bool = ALS_QUANTIZED_INDEX,
 ) -> tp.Dict[str, pl.DataFrame]:
+    if executor not in ("thread", "process"):
+        raise ValueError(f"Unknown executor '{executor}', expected 'thread' or 'process'")
+
+    als_index = FactorIndex(models["als"].item_factors, quantize=quantize)
+    if quantize and user_indexes:
+        with profile_step("candidates.als_recall"):
+            recall = als_index_recall(models["als"], als_index, uim, user_indexes, fold_in, allowed_items)
+        print(f"als int8 index recall@{N_CANDIDATES} against exact search = {recall:.4f}")
+
+    tasks = [
+        (model_name, block)
+        for model_name in CANDIDATE_GENERATORS
+        for block in split_list_to_blocks(user_indexes, CANDIDATES_BLOCK_SIZE)
+    ]
+    _shared.update(models=models, uim=uim, uim_norm=uim_norm, fold_in=fold_in, als_index=als_index, allowed_items=allowed_items)
+    try:
+        if workers <= 1:
+            # tasks are grouped by model, so the serial path can time every generator on its own
+            results = []
+            for model_name in CANDIDATE_GENERATORS:
+                with profile_step(f"candidates.{model_name}") as record:
+                    model_results = [generate_block_candidates(*task) for task in tasks if task[0] == model_name]
+                    record["rows"] = sum(receipt_idxs.shape[0] for receipt_idxs, _, _ in model_results)
+                results.extend(model_results)
+        elif executor == "thread":
+            with profile_step("candidates"), ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(generate_block_candidates, *zip(*tasks)))
+        else:
+            with profile_step("candidates"), ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context("fork"), initializer=_init_process_worker
+            ) as pool:
+                results = list(pool.map(generate_block_candidates, *zip(*tasks)))
+    finally:
+        _shared.clear()
 
-    bm25_recs = nearest_neighbours_inference(
-        model=models["bm25"], uim=uim_norm, user_idxs=user_indexes, model_name="bm25", n_candidates_default=N_CANDIDATES
+    candidates = {}
+    for model_name in CANDIDATE_GENERATORS:
+        blocks = [recs for (name, _), recs in zip(tasks, results) if name == model_name] or [(np.empty(0, dtype=np.int64),) * 3]
+        receipt_idxs, item_idxs, scores = (np.concatenate(arrays) for arrays in zip(*blocks))
+        candidates[model_name] = candidates_frame(receipt_idxs=receipt_idxs, item_idxs=item_idxs, model_name=model_name, scores=scores)
+    return candidates
+
+
+def get_cart_candidates(
+    models: tp.Dict,
+    line_items: pl.DataFrame,
+    item_encoder: IdEncoder,
+    n_items: int,
+    workers: int = 1,
+    executor: str = "thread",
+    allowed_items: tp.Optional[np.ndarray] = None,
+    quantize: bool = ALS_QUANTIZED_INDEX,
+) -> tp.Dict[str, pl.DataFrame]:
+    receipt_ids, cart_uim, cart_uim_norm = build_cart_matrices(line_items=line_items, item_encoder=item_encoder, n_items=n_items)
+    candidates_by_model = get_candidates(
+        models=models,
+        uim=cart_uim,
+        uim_norm=cart_uim_norm,
+        user_indexes=list(range(receipt_ids.shape[0])),
+        workers=workers,
+        executor=executor,
+        fold_in=True,
+        allowed_items=allowed_items,
+        quantize=quantize,
     )
+    return {
+        model_name: candidates.with_columns(
+            pl.Series(name="receipt_id", values=receipt_ids[candidates["receipt_id_enc"].to_numpy()])
+        ).drop("receipt_id_enc")
+        for model_name, candidates in candidates_by_model.items()
+    }
+
 
-    tfidf_recs = nearest_neighbours_inference(
-        model=models["tfidf"], uim=uim_norm, user_idxs=user_indexes, model_name="tfidf", n_candidates_default=N_CANDIDATES
+def union_candidates(
+    candidates_by_model: tp.Dict[str, pl.DataFrame], budget: tp.Optional[int] = CANDIDATES_BUDGET, rrf_k: int = RRF_K
+) -> pl.DataFrame:
+    # one row per (receipt, item) with the score and rank of every generator that proposed it (null otherwise);
+    # reciprocal-rank fusion orders the union and the budget keeps the best rows of every receipt,
+    # generators are told apart by a UInt8 code instead of a string column on every row
+    schema = DataSchema()
+    candidates = pl.concat([
+        candidates.select(["receipt_id", "item_id", pl.col("score").cast(schema.score_dtype), pl.col("rank").cast(schema.rank_dtype)])
+        .with_columns(pl.lit(model_code, dtype=pl.UInt8).alias("model_code"))
+        for model_code, candidates in enumerate(candidates_by_model.values())
+    ])
+    union = candidates.group_by(["receipt_id", "item_id"]).agg(
+        [
+            pl.col(column).filter(pl.col("model_code") == model_code).first().alias(f"{model_name}_{column}")
+            for model_code, model_name in enumerate(candidates_by_model)
+            for column in ("score", "rank")
+        ] + [(1 / (rrf_k + pl.col("rank"))).sum().cast(schema.score_dtype).alias("rrf")]
+    ).sort(["receipt_id", "rrf", "item_id"], descending=[False, True, False])
+    union = union.with_columns(pl.col("rrf").rank("ordinal", descending=True).over("receipt_id").cast(schema.rank_dtype).alias("rank"))
+    if budget is not None:
+        union = union.filter(pl.col("rank") <= budget)
+    return union
+
+
+def candidate_training_pairs(
+    positives: pl.DataFrame, candidates: pl.DataFrame, n_negatives: int = CANDIDATE_NEGATIVES, seed: int = RANDOM_STATE
+) -> pl.DataFrame:
+    # negatives come from the receipt's own candidates so training rows look like the rows scored at inference;
+    # positives no generator retrieved are dropped, with null generator columns they would mark the target exactly,
+    # and so are receipts left without a positive, they make no pairs
+    rng = np.random.default_rng(seed)
+    keys = positives.select(["receipt_id", "item_id"])
+    retrieved = candidates.join(keys, on=["receipt_id", "item_id"], how="semi")
+    negatives = (
+        candidates
+            .join(keys, on=["receipt_id", "item_id"], how="anti")
+            .join(retrieved.select("receipt_id"), on="receipt_id", how="semi")
+    )
+    negatives = (
+        negatives.with_columns(pl.Series("sample_order", rng.random(negatives.shape[0])))
+        .filter(pl.col("sample_order").rank("ordinal").over("receipt_id") <= n_negatives)
+        .drop("sample_order")
     )
+    return pl.concat([
+        retrieved.with_columns(pl.lit(1).alias("target")),
+        negatives.with_columns(pl.lit(0).alias("target")),
+    ]).sort(["receipt_id", "target"], descending=[False, True])
 
-    cosine_recs = nearest_neighbours_inference(
-        model=models["cosine"], uim=uim_norm, user_idxs=user_indexes, model_name="cosine", n_candidates_default=N_CANDIDATES
+
+def generate_candidates(
+    line_items: pl.DataFrame,
+    models: tp.Dict,
+    spmat: csr_matrix,
+    spmat_norm: csr_matrix,
+    encoders: tp.Dict[str, IdEncoder],
+    popularity: PopularityIndex,
+    workers: int = 1,
+    executor: str = "thread",
+    score_carts: bool = False,
+    allowed_items: tp.Optional[np.ndarray] = None,
+    quantize: bool = ALS_QUANTIZED_INDEX,
+) -> tp.Dict[str, pl.DataFrame]:
+    df = (
+        line_items
+            .group_by(["receipt_id", "item_id"])
+            .agg([pl.col("quantity").sum()])
+            .select(["item_id", "receipt_id"])
+            .group_by("receipt_id")
+            .agg(pl.col("item_id"))
     )
 
-    als_recs = alternating_least_squares_inference(
-        model=models["als"], uim=uim, user_idxs=user_indexes, n_candidates_default=N_CANDIDATES
+    if score_carts:
+        user_indexes, cart_receipts = [], df["receipt_id"]
+    else:
+        user_indexes = get_receipt_indexes(receipt_ids=df["receipt_id"], encoder=encoders["receipt_id"])
+        cart_receipts = df["receipt_id"].filter(pl.Series(values=~encoders["receipt_id"].contains(df["receipt_id"].to_numpy())))
+
+    candidates_by_model = get_candidates(
+        models=models, uim=spmat, uim_norm=spmat_norm, user_indexes=user_indexes, workers=workers, executor=executor,
+        allowed_items=allowed_items, quantize=quantize
     )
+    for model_name, candidates in candidates_by_model.items():
+        candidates = decode(table=candidates, encoder=encoders["receipt_id"], key="receipt_id", enc_key="receipt_id_enc")
+        candidates = decode(
+            table=candidates, encoder=encoders["item_id"], key="item_id", enc_key="item_id_enc"
+        )
+        candidates_by_model[model_name] = candidates
+
+    if cart_receipts.shape[0] > 0:
+        cart_candidates_by_model = get_cart_candidates(
+            models=models,
+            line_items=line_items.filter(pl.col("receipt_id").is_in(cart_receipts)),
+            item_encoder=encoders["item_id"],
+            n_items=spmat.shape[1],
+            workers=workers,
+            executor=executor,
+            allowed_items=allowed_items,
+            quantize=quantize,
+        )
+        for model_name, candidates in cart_candidates_by_model.items():
+            candidates = decode(table=candidates, encoder=encoders["item_id"], key="item_id", enc_key="item_id_enc")
+            candidates_by_model[model_name] = pl.concat(
+                (candidates_by_model[model_name], candidates.select(candidates_by_model[model_name].columns))
+            )
+
+    # popular products of the receipt's segment (the global list without one) carry their position as rank and no score
+    schema = DataSchema()
+    receipt_segments = popularity.receipt_segments(line_items)
+    candidates_by_model["popular"] = receipt_segments.join(popularity.top_table(), on="segment").select([
+        pl.lit("popular").cast(schema.model_name_dtype).alias("model_name"),
+        "receipt_id",
+        "item_id",
+        pl.col("rank").cast(schema.rank_dtype),
+        pl.lit(None, dtype=schema.score_dtype).alias("score"),
+    ])
+    return candidates_by_model
+
 
-    return {"bm25": bm25_recs, "tfidf": tfidf_recs, "cosine": cosine_recs, "als": als_recs}
+def check_ranker_version(ranker: tp.Union["CatBoostRanker", CompiledRanker], item_features: ItemFeatureStore) -> None:
+    ranker_version = ranker.get_metadata().get("item_features_version")
+    if ranker_version != item_features.version:
+        raise ValueError(f"Ranker was trained on item features {ranker_version}, found {item_features.version}")
 
 
-def union_candidates(candidates: tp.Sequence[pl.DataFrame]) -> pl.DataFrame:
-    union_candidates = (
-        pl.concat(candidates).select([pl.col("user_id"), pl.col("item_id")]).unique(maintain_order=False)
+def rank_candidates(
+    context: pl.DataFrame,
+    candidates: pl.DataFrame,
+    item_features: ItemFeatureStore,
+    ranker: tp.Union["CatBoostRanker", CompiledRanker],
+    batch_size: int = RANKER_BATCH_SIZE,
+    per_receipt: bool = False,
+    k: int = 10,
+    item_embeddings: tp.Optional[ItemEmbeddings] = None,
+    progress: bool = True,
+) -> pl.DataFrame:
+    if uses_text_features(ranker) and item_embeddings is None:
+        raise ValueError("The ranker was trained with text features, item embeddings from embed-items are required")
+    with profile_step("features", rows=candidates.shape[0]):
+        context_with_features = join_context_features(context=context, store=item_features)
+        candidates_with_features = join_candidates_features(candidates=candidates, store=item_features)
+        if item_embeddings is not None:
+            candidates_with_features = join_cart_similarity(candidates_with_features, context=context, embeddings=item_embeddings)
+        ds = candidates_with_features.join(context_with_features, on="receipt_id")
+
+    with profile_step("predict", rows=ds.shape[0]):
+        if per_receipt:
+            predictions = score_candidates_per_receipt(ranker=ranker, ds=ds, progress=progress)
+        else:
+            predictions = score_candidates(ranker=ranker, ds=ds, batch_size=batch_size, progress=progress)
+    with profile_step("top_k") as record:
+        recommendations = top_k_by_receipt(predictions, k=k)
+        record["rows"] = recommendations.shape[0]
+    return recommendations
+
+
+def ranker_features(ranker: tp.Union["CatBoostRanker", CompiledRanker]) -> tp.List[str]:
+    return list(ranker.feature_names if isinstance(ranker, CompiledRanker) else ranker.feature_names_)
+
+
+def uses_text_features(ranker: tp.Union["CatBoostRanker", CompiledRanker]) -> bool:
+    return any(feature in TEXT_FEATURES for feature in ranker_features(ranker))
+
+
+def predict_scores(
+    ranker: tp.Union["CatBoostRanker", CompiledRanker], ds: pl.DataFrame, features: tp.Optional[tp.List[str]] = None
+) -> np.ndarray:
+    # the compiled ranker works on a float32 matrix directly, CatBoost gets a pandas frame
+    features = features or ranker_features(ranker)
+    if isinstance(ranker, CompiledRanker):
+        return ranker.predict(ds.select(features).to_numpy().astype(np.float32))
+    return ranker.predict(ds.select(features).to_pandas())
+
+
+def score_candidates(
+    ranker: tp.Union["CatBoostRanker", CompiledRanker],
+    ds: pl.DataFrame,
+    features: tp.Optional[tp.List[str]] = None,
+    batch_size: int = RANKER_BATCH_SIZE,
+    progress: bool = True,
+) -> pl.DataFrame:
+    from tqdm import tqdm
+
+    features = features or ranker_features(ranker)
+    scores = [
+        predict_scores(ranker, chunk, features)
+        for chunk in tqdm(ds.iter_slices(n_rows=batch_size), total=-(-ds.shape[0] // batch_size), disable=not progress)
+    ]
+    scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float64)
+    return ds.select(["receipt_id", "item_id"]).with_columns(pl.Series(name="score", values=scores))
+
+
+def score_candidates_per_receipt(
+    ranker: tp.Union["CatBoostRanker", CompiledRanker],
+    ds: pl.DataFrame,
+    features: tp.Optional[tp.List[str]] = None,
+    progress: bool = True,
+) -> pl.DataFrame:
+    from tqdm import tqdm
+
+    features = features or ranker_features(ranker)
+    predictions = {
+        "receipt_id": [],
+        "item_id": [],
+        "score": []
+    }
+    for receipt_id in tqdm(ds["receipt_id"].unique(), disable=not progress):
+        receipt_items = ds.filter(pl.col("receipt_id") == receipt_id)
+        score = predict_scores(ranker, receipt_items, features)
+        predictions["receipt_id"].append(receipt_id)
+        predictions["item_id"].append(receipt_items["item_id"].to_list())
+        predictions["score"].append(score)
+
+    return pl.DataFrame(predictions).explode(["item_id", "score"])
+
+
+def top_k_by_receipt(predictions: pl.DataFrame, k: int) -> pl.DataFrame:
+    return (
+        predictions
+        .sort("score", descending=True)
+        .group_by("receipt_id")
+        .agg(pl.col("item_id").head(k))
     )
-    return union_candidates
 
 
-def decode(table: pl.DataFrame, encoder: tp.Dict[int, int], key: str, enc_key: str) -> pl.DataFrame:
-    encoder_table = encoder2df(encoder=encoder, key=key, enc_key=enc_key)
-    table = table.join(encoder_table, on=[enc_key]).drop(enc_key)
-    return table
+def compile_ranker(
+    ranker: "CatBoostRanker", n_rows: int = 10_000, tolerance: float = COMPILED_RANKER_TOLERANCE, seed: int = RANDOM_STATE
+) -> tp.Tuple[CompiledRanker, float]:
+    compiled = CompiledRanker.from_catboost(ranker)
 
+    # values on, just below and just above every border plus missing values exercise each split both ways
+    rng = np.random.default_rng(seed)
+    features = np.empty((n_rows, len(compiled.feature_names)), dtype=np.float32)
+    for idx in range(features.shape[1]):
+        feature_borders = compiled.borders[compiled.border_offsets[idx]:compiled.border_offsets[idx + 1]]
+        values = (rng.choice(feature_borders, n_rows) if feature_borders.shape[0] > 0 else rng.normal(size=n_rows)).astype(np.float32)
+        direction = rng.choice(np.array([-np.inf, 0, np.inf], dtype=np.float32), n_rows)
+        features[:, idx] = np.where(direction == 0, values, np.nextafter(values, direction))
+    features[rng.random(features.shape) < 0.05] = np.nan
 
-def split_list_to_blocks(lst: tp.List[int], block_size: int):  # -> tp.Generator[tp.List[int]]:
-    for i in range(0, len(lst), block_size):
-        yield lst[i : i + block_size]
+    max_diff = float(np.abs(ranker.predict(pl.DataFrame(features, schema=compiled.feature_names).to_pandas()) - compiled.predict(features)).max())
+    if max_diff > tolerance:
+        raise ValueError(f"Compiled ranker differs from CatBoost by {max_diff}, tolerance is {tolerance}")
+    return compiled, max_diff
 
 
-def union_candidates(candidates: tp.Sequence[pl.DataFrame]) -> pl.DataFrame:
-    union_candidates = (
-        pl.concat(candidates).select([pl.col("receipt_id"), pl.col("item_id")]).unique(maintain_order=False)
+def run_inference_shard(
+    shard_path: str, compiled: bool = False, batch_size: int = RANKER_BATCH_SIZE, score_carts: bool = False
+) -> tp.Tuple[tp.Dict[str, pl.DataFrame], pl.DataFrame]:
+    # matrices, encoders, factors and item features are memory-mapped, so workers share their pages
+    schema = DataSchema()
+    line_items = pl.read_parquet(shard_path)
+    candidates_by_model = generate_candidates(
+        line_items=line_items,
+        models=load_artifact("models.implicit_models", schema),
+        spmat=load_artifact("models.spmat", schema),
+        spmat_norm=load_artifact("models.spmat_norm", schema),
+        encoders=load_artifact("models.encoders", schema),
+        popularity=load_artifact("models.popularity", schema),
+        score_carts=score_carts,
     )
-    return union_candidates
\ No newline at end of file
+
+    item_features = load_artifact("models.item_features", schema)
+    ranker = load_artifact("models.ranker_compiled" if compiled else "models.ranker", schema)
+    check_ranker_version(ranker, item_features)
+    recommendations = rank_candidates(
+        context=line_items.select(["receipt_id", "item_id"]),
+        candidates=union_candidates(candidates_by_model),
+        item_features=item_features,
+        ranker=ranker,
+        batch_size=batch_size,
+        item_embeddings=load_artifact("models.item_embeddings", schema) if uses_text_features(ranker) else None,
+    )
+    return candidates_by_model, recommendations
+
+
+@contextmanager
+def spawn_worker_pool(workers: int, **pool_kwargs: tp.Any) -> tp.Iterator[ProcessPoolExecutor]:
+    # workers are spawned rather than forked (polars and OpenMP thread pools do not survive a fork)
+    # and split the cores between them
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+    thread_env = {name: threads for name in ("POLARS_MAX_THREADS", "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")}
+    saved_env = {name: os.environ.get(name) for name in thread_env}
+    os.environ.update(thread_env)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), **pool_kwargs) as pool:
+            yield pool
+    finally:
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_sharded_inference(
+    line_items: pl.DataFrame,
+    n_shards: int,
+    workers: int,
+    compiled: bool = False,
+    batch_size: int = RANKER_BATCH_SIZE,
+    score_carts: bool = False,
+) -> tp.Tuple[tp.Dict[str, pl.DataFrame], pl.DataFrame]:
+    shards = line_items.with_columns(
+        pl.Series(name="shard", values=receipt_shards(line_items["receipt_id"].to_numpy(), n_shards))
+    ).partition_by("shard", as_dict=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shard_paths = []
+        for shard, shard_items in shards.items():
+            shard_paths.append(join(tmp_dir, f"shard_{shard}.pq"))
+            shard_items.drop("shard").write_parquet(shard_paths[-1])
+
+        with spawn_worker_pool(workers) as pool:
+            futures = [
+                pool.submit(run_inference_shard, shard_path, compiled, batch_size, score_carts) for shard_path in shard_paths
+            ]
+            results = [future.result() for future in futures]
+
+    candidates_by_model = {
+        model_name: pl.concat([shard_candidates[model_name] for shard_candidates, _ in results])
+        for model_name in results[0][0]
+    } if results else {}
+    recommendations = pl.concat([shard_recommendations for _, shard_recommendations in results]) if results else pl.DataFrame()
+    return candidates_by_model, recommendations
@@ -3,11 +3,16 @@ import typing as tp
 import numpy as np
 import polars as pl
 
-from implicit.als import AlternatingLeastSquares
-from implicit.nearest_neighbours import ItemItemRecommender
-from scipy.sparse import csr_matrix, find
+from scipy.sparse import csr_matrix
 
-from data.utils import encoder2df
+from configs.schema import DataSchema
+from data.encoders import MISSING_CODE, IdEncoder
+from data.utils import prepare_rpi
+from inference.retrieval import FactorIndex
+
+if tp.TYPE_CHECKING:
+    from implicit.als import AlternatingLeastSquares
+    from implicit.nearest_neighbours import ItemItemRecommender
 
 
 def split_list_to_blocks(lst: tp.List[int], block_size: int):  # -> tp.Generator[tp.List[int]]:
@@ -15,72 +20,192 @@ def split_list_to_blocks(lst: tp.List[int], block_size: int):  # -> tp.Generator
         yield lst[i : i + block_size]
         
 
-def alternating_least_squares_inference(
-    model: AlternatingLeastSquares, uim: csr_matrix, user_idxs: tp.List[int], n_candidates_default: int = 100
-) -> pl.DataFrame:
-
-    n_items = uim.shape[1]
-    n_candidates = min(n_candidates_default, n_items)
-    recommend_items, _ = model.recommend(user_idxs, None, N=n_candidates, filter_already_liked_items=False)
-    recommends = pl.DataFrame(
+def candidates_frame(receipt_idxs: np.ndarray, item_idxs: np.ndarray, model_name: str, scores: np.ndarray) -> pl.DataFrame:
+    # rank is the 1-based position of the item among the generator's candidates for the receipt
+    schema = DataSchema()
+    return pl.DataFrame(
         [
-            pl.Series(name="receipt_id_enc", values=np.repeat(user_idxs, n_candidates), dtype=pl.Int64),
-            pl.Series(name="item_id_enc", values=recommend_items.flatten(), dtype=pl.Int64),
-            pl.Series(name="model_name", values=['als'] * recommend_items.flatten().shape[0])
+            pl.Series(name="receipt_id_enc", values=receipt_idxs, dtype=schema.code_dtype),
+            pl.Series(name="item_id_enc", values=item_idxs, dtype=schema.code_dtype),
+            pl.Series(name="score", values=scores, dtype=schema.score_dtype),
         ]
+    ).with_columns([
+        pl.lit(f"{model_name}").cast(schema.model_name_dtype).alias("model_name"),
+        pl.col("score").rank("ordinal", descending=True).over("receipt_id_enc").cast(schema.rank_dtype).alias("rank"),
+    ])
+
+
+def alternating_least_squares_candidates(
+    model: "AlternatingLeastSquares",
+    uim: csr_matrix,
+    user_idxs: tp.List[int],
+    n_candidates_default: int = 100,
+    recalculate_user: bool = False,
+    index: tp.Optional[FactorIndex] = None,
+    block_size: int = 512,
+    item_block_size: int = 8192,
+    filter_cart_items: bool = False,
+    allowed_items: tp.Optional[np.ndarray] = None,
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    user_idxs = np.asarray(user_idxs, dtype=np.int64)
+    if user_idxs.shape[0] == 0:
+        return user_idxs, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    if recalculate_user:
+        # fold-in: user factors are solved from the given rows instead of read from the model
+        user_factors = model.recalculate_user(np.arange(user_idxs.shape[0]), uim[user_idxs])
+    else:
+        user_factors = model.user_factors[user_idxs]
+
+    index = index or FactorIndex(model.item_factors)
+    rows, item_idxs, scores = index.search(
+        user_factors,
+        min(n_candidates_default, uim.shape[1]),
+        exclude=uim[user_idxs] if filter_cart_items else None,
+        allowed_items=allowed_items,
+        block_size=block_size,
+        item_block_size=item_block_size,
     )
-    return recommends
+    return user_idxs[rows], item_idxs, scores
 
 
-def nearest_neighbours_inference(
-    model: ItemItemRecommender, uim: csr_matrix, user_idxs: tp.List[int], model_name, n_candidates_default: int = 100
+def alternating_least_squares_inference(
+    model: "AlternatingLeastSquares", uim: csr_matrix, user_idxs: tp.List[int], n_candidates_default: int = 100
 ) -> pl.DataFrame:
-    def compute(uim_sample: csr_matrix, user_idx: tp.List[int], model_sim: csr_matrix, n_cand: int):
-        user_ids, item_ids, scores = find(uim_sample.dot(model_sim))
-        recs = (
-            pl.DataFrame(
-                [
-                    pl.Series(name="internal_receipt_id", values=user_ids, dtype=pl.Int64),
-                    pl.Series(name="item_id_enc", values=item_ids, dtype=pl.Int64),
-                    pl.Series(name="score", values=scores, dtype=pl.Float32),
-                ]
-            )
-            .with_columns([pl.col("score").rank(method="ordinal", descending=True).over("internal_receipt_id").alias("rank")])
-            .filter(pl.col("rank") <= n_cand)
-            .join(
-                pl.DataFrame(
-                    [
-                        pl.Series(name="receipt_id_enc", values=user_idx, dtype=pl.Int64),
-                        pl.Series(name="internal_receipt_id", values=np.arange(len(user_idx)), dtype=pl.Int64),
-                    ]
-                ),
-                on=["internal_receipt_id"],
-            )
-            .drop(["score", "rank", "internal_receipt_id"])
+    receipt_idxs, item_idxs, scores = alternating_least_squares_candidates(model, uim, user_idxs, n_candidates_default)
+    return candidates_frame(receipt_idxs, item_idxs, "als", scores)
+
+
+def split_rows_by_budget(
+    uim: csr_matrix, user_idxs: tp.List[int], similarity: csr_matrix, block_size: int, max_block_mb: tp.Optional[float] = None
+):  # -> tp.Generator[np.ndarray]:
+    user_idxs = np.asarray(user_idxs, dtype=np.int64)
+    if max_block_mb is None:
+        yield from split_list_to_blocks(user_idxs, block_size)
+        return
+
+    # upper bound on the non-zeros of every product row: data (float32) + indices (int32)
+    sim_row_nnz = np.diff(similarity.indptr).astype(np.float64)
+    user_rows = uim[user_idxs]
+    row_cost = np.minimum(
+        csr_matrix((np.ones_like(user_rows.data, dtype=np.float64), user_rows.indices, user_rows.indptr), shape=user_rows.shape) @ sim_row_nnz,
+        similarity.shape[1],
+    ) * 8
+    cum_cost = np.concatenate(([0.0], np.cumsum(row_cost)))
+    budget = max_block_mb * 2 ** 20
+
+    start = 0
+    while start < user_idxs.shape[0]:
+        end = np.searchsorted(cum_cost, cum_cost[start] + budget, side="right") - 1
+        end = min(max(end, start + 1), start + block_size)
+        yield user_idxs[start:end]
+        start = end
+
+
+def csr_row_topk(
+    mat: csr_matrix, n: int, exclude: tp.Optional[csr_matrix] = None
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rows = np.repeat(np.arange(mat.shape[0], dtype=np.int64), np.diff(mat.indptr))
+    indices, data = mat.indices, mat.data
+
+    keep = data != 0
+    if exclude is not None and exclude.nnz > 0:
+        n_cols = mat.shape[1]
+        excluded = np.sort(np.repeat(np.arange(exclude.shape[0], dtype=np.int64), np.diff(exclude.indptr)) * n_cols + exclude.indices)
+        keys = rows * n_cols + indices
+        keep &= excluded[np.searchsorted(excluded, keys).clip(max=excluded.shape[0] - 1)] != keys
+    if not keep.all():
+        rows, indices, data = rows[keep], indices[keep], data[keep]
+
+    row_nnz = np.bincount(rows, minlength=mat.shape[0])
+    indptr = np.concatenate(([0], np.cumsum(row_nnz)))
+    selected = np.ones(data.shape[0], dtype=bool)
+    for row in np.flatnonzero(row_nnz > n):
+        lo, hi = indptr[row], indptr[row + 1]
+        row_selected = np.zeros(hi - lo, dtype=bool)
+        row_selected[np.argpartition(-data[lo:hi], n - 1)[:n]] = True
+        selected[lo:hi] = row_selected
+
+    return rows[selected], indices[selected], data[selected]
+
+
+def nearest_neighbours_candidates(
+    model: "ItemItemRecommender",
+    uim: csr_matrix,
+    user_idxs: tp.List[int],
+    n_candidates_default: int = 100,
+    block_size: int = 1000,
+    max_block_mb: tp.Optional[float] = None,
+    filter_cart_items: bool = False,
+) -> tp.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n_cand = min(n_candidates_default, model.similarity.shape[1])
+    receipt_idxs, item_idxs, scores = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.float32)]
+    for user_idx in split_rows_by_budget(uim, user_idxs, model.similarity, block_size, max_block_mb):
+        uim_sample = uim[user_idx]
+        rows, item_ids, item_scores = csr_row_topk(
+            uim_sample.dot(model.similarity), n_cand, exclude=uim_sample if filter_cart_items else None
         )
-        return recs
+        receipt_idxs.append(user_idx[rows])
+        item_idxs.append(item_ids)
+        scores.append(item_scores)
+    return np.concatenate(receipt_idxs), np.concatenate(item_idxs), np.concatenate(scores)
+
+
+def nearest_neighbours_inference(
+    model: "ItemItemRecommender",
+    uim: csr_matrix,
+    user_idxs: tp.List[int],
+    model_name,
+    n_candidates_default: int = 100,
+    block_size: int = 1000,
+    max_block_mb: tp.Optional[float] = None,
+    filter_cart_items: bool = False,
+) -> pl.DataFrame:
+    receipt_idxs, item_idxs, scores = nearest_neighbours_candidates(
+        model, uim, user_idxs, n_candidates_default, block_size, max_block_mb, filter_cart_items
+    )
+    return candidates_frame(receipt_idxs, item_idxs, model_name, scores)
+
+
+def build_cart_matrices(
+    line_items: pl.DataFrame, item_encoder: IdEncoder, n_items: int
+) -> tp.Tuple[np.ndarray, csr_matrix, csr_matrix]:
+    rpi = prepare_rpi(line_items)
+    rpi = rpi.with_columns(
+        pl.Series(name="item_id_enc", values=item_encoder.encode(rpi["item_id"], unknown="missing"))
+    ).filter(pl.col("item_id_enc") != MISSING_CODE)
+    receipt_ids = rpi["receipt_id"].unique(maintain_order=True)
+    rpi = rpi.join(
+        pl.DataFrame(
+            [
+                pl.Series(name="receipt_id", values=receipt_ids),
+                pl.Series(name="cart_idx", values=np.arange(receipt_ids.shape[0]), dtype=DataSchema().code_dtype),
+            ]
+        ),
+        on=["receipt_id"],
+    )
+
+    rows, cols = rpi["cart_idx"].to_numpy(), rpi["item_id_enc"].to_numpy()
+    shape = (receipt_ids.shape[0], n_items)
+    cart_uim = csr_matrix((rpi["interaction_score"].to_numpy(), (rows, cols)), shape=shape, dtype=np.float32)
+    cart_uim_norm = csr_matrix((rpi["interaction_score_norm"].to_numpy(), (rows, cols)), shape=shape, dtype=np.float32)
+    return receipt_ids.to_numpy(), cart_uim, cart_uim_norm
+
 
-    recommends = [
-        compute(uim[user_idx], user_idx, model.similarity, min(n_candidates_default, model.similarity.shape[1]))
-        for user_idx in split_list_to_blocks(user_idxs, 1000)
-    ]
+def allowed_items_mask(item_ids: pl.Series, encoder: IdEncoder, n_items: int) -> np.ndarray:
+    mask = np.zeros(n_items, dtype=bool)
+    mask[encoder.encode(item_ids, unknown="drop")] = True
+    return mask
 
-    recommends_df: pl.DataFrame = pl.concat(recommends).select(
-        [pl.col("receipt_id_enc").cast(pl.Int64), pl.col("item_id_enc").cast(pl.Int64)]
-    ).with_columns([pl.lit(f"{model_name}").alias("model_name")])
-    return recommends_df
 
+def get_receipt_indexes(receipt_ids: pl.Series, encoder: IdEncoder) -> tp.List[int]:
+    return encoder.encode(receipt_ids, unknown="drop").tolist()
 
-def get_receipt_indexes(receipt_ids: pl.Series, encoder: tp.Dict[int, int]) -> tp.List[int]:
-    receipt_indexes = []
-    for receipt_id in receipt_ids.to_list():
-        receipt_index = encoder.get(receipt_id)
-        if receipt_index is not None:
-            receipt_indexes.append(receipt_index)
-    return receipt_indexes
 
+def decode(table: pl.DataFrame, encoder: IdEncoder, key: str, enc_key: str) -> pl.DataFrame:
+    table = table.with_columns(pl.Series(name=key, values=encoder.decode(table[enc_key]), dtype=pl.Int64)).drop(enc_key)
+    return table
 
-def decode(table: pl.DataFrame, encoder: tp.Dict[int, int], key: str, enc_key: str) -> pl.DataFrame:
-    encoder_table = encoder2df(encoder=encoder, key=key, enc_key=enc_key)
-    table = table.join(encoder_table, on=[enc_key]).drop(enc_key)
-    return table
\ No newline at end of file
+def receipt_shards(receipt_ids: np.ndarray, n_shards: int) -> np.ndarray:
+    # multiplicative hash, stable across processes and runs unlike python's hash
+    hashed = np.asarray(receipt_ids, dtype=np.int64).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    return ((hashed >> np.uint64(32)) % np.uint64(n_shards)).astype(np.int64)
@@ -0,0 +1,216 @@
+import os
+import time
+import typing as tp
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from os.path import join
+
+import polars as pl
+
+from configs.model import RANKER_CANDIDATE_FEATURES
+from configs.schema import DataSchema
+from data.artifacts import in_memory_artifacts, load_artifact, save_artifact
+from pipeline.utils import config_values, file_fingerprint, fingerprint, path_stats, run_stage, source_fingerprint
+from profiling.utils import peak_rss_mb, reset_peak_rss
+
+
+# CLI stages in topological order: "{name}" placeholders in args are replaced with the input paths,
+# a stage reruns when its inputs, the listed configs.model values, the code or an upstream stage change
+STAGES = {
+    "load": {
+        "args": ["--train-data-path", "{train}", "--val-data-path", "{val}"],
+        "inputs": ("train", "val"),
+        "upstream": (),
+        "config": ("N_POPULAR_PRODUCTS", "POPULARITY_HALF_LIFE_DAYS", "POPULARITY_SEGMENT", "POPULARITY_PRICE_BANDS"),
+        "outputs": ("data.rpi", "models.spmat", "models.spmat_norm", "models.encoders", "models.popularity"),
+    },
+    "train-candidate-models": {
+        "args": [],
+        "inputs": (),
+        "upstream": ("load",),
+        "config": ("RANDOM_STATE", "bm25_config", "tfidf_config", "cosine_config", "als_config"),
+        "outputs": ("models.implicit_models", "models.incremental_stats"),
+    },
+    "inference-candidates": {
+        "args": ["--inference-data-path", "{inference}"],
+        "inputs": ("inference",),
+        "upstream": ("load", "train-candidate-models"),
+        "config": (
+            "N_CANDIDATES", "CANDIDATES_BLOCK_SIZE", "nn_inference_config", "als_inference_config", "ALS_QUANTIZED_INDEX",
+            "CANDIDATES_BUDGET", "RRF_K",
+        ),
+        "outputs": (
+            "data.candidates", "data.candidates_tfidf", "data.candidates_cosine", "data.candidates_als", "data.candidates_bm25",
+        ),
+    },
+    "train-ranker": {
+        "args": ["--train-data-path", "{train}", "--val-data-path", "{val}"],
+        "inputs": ("train", "val"),
+        # item popularity comes from the load stage, generator features also need the candidate models
+        "upstream": ("load", "train-candidate-models") if RANKER_CANDIDATE_FEATURES else ("load",),
+        "config": (
+            "RANDOM_STATE", "NEGATIVES_PER_POSITIVE", "RANKER_FEATURES",
+            "RANKER_CANDIDATE_FEATURES", "CANDIDATE_FEATURES", "CANDIDATE_NEGATIVES", "RRF_K",
+            "RANKER_TEXT_FEATURES", "TEXT_FEATURES",
+        ),
+        "outputs": ("models.ranker", "models.item_features"),
+    },
+    "make-recommendations": {
+        # the context is the data the candidates were generated for, otherwise no receipt is ranked
+        "args": ["--val-data-path", "{inference}"],
+        "inputs": ("inference",),
+        "upstream": ("inference-candidates", "train-ranker"),
+        "config": ("RANKER_BATCH_SIZE", "RANKER_FEATURES"),
+        "outputs": ("data.recommendations", "data.recommendations_10"),
+    },
+    "evaluate-candidates-metrics": {
+        "args": ["--target-path", "{target}"],
+        "inputs": ("target",),
+        "upstream": ("inference-candidates",),
+        "config": (),
+        "outputs": ("metrics.candidates",),
+    },
+    "evaluate-common-metrics": {
+        "args": ["--target-path", "{target}"],
+        "inputs": ("target",),
+        "upstream": ("load", "make-recommendations"),
+        "config": (),
+        "outputs": ("metrics.common",),
+    },
+}
+
+REPORT_SCHEMA = {"stage": pl.Utf8, "status": pl.Utf8, "reason": pl.Utf8, "seconds": pl.Float64, "peak_rss_mb": pl.Float64}
+# what a single-process run leaves on disk unless every artifact is asked for
+PIPELINE_OUTPUTS = ("data.recommendations", "data.recommendations_10", "metrics.common", "metrics.candidates")
+
+
+def output_stats(stage: str, schema: DataSchema) -> tp.Dict[str, tp.Any]:
+    return {name: path_stats(schema.target_paths[name]) for name in STAGES[stage]["outputs"]}
+
+
+def plan_stages(
+    paths: tp.Dict[str, str],
+    manifest: tp.Dict[str, tp.Dict[str, tp.Any]],
+    schema: DataSchema,
+    stages: tp.Sequence[str] = tuple(STAGES),
+    hash_inputs: bool = False,
+    force: bool = False,
+) -> tp.Dict[str, tp.Dict[str, tp.Any]]:
+    code_version = source_fingerprint()
+    plan = {}
+    for stage in stages:
+        spec = STAGES[stage]
+        upstream = [plan[name] for name in spec["upstream"] if name in plan]
+        stage_fingerprint = fingerprint(
+            stage,
+            [arg.format(**paths) for arg in spec["args"]],
+            {name: file_fingerprint(paths[name], hash_contents=hash_inputs) for name in spec["inputs"]},
+            config_values(spec["config"]),
+            schema.low_memory,
+            code_version,
+            [entry["fingerprint"] for entry in upstream],
+        )
+
+        record = manifest.get(stage)
+        if force:
+            reason = "forced"
+        elif record is None:
+            reason = "new"
+        elif record["fingerprint"] != stage_fingerprint:
+            reason = "changed"
+        elif record["outputs"] != output_stats(stage, schema):
+            reason = "outputs"
+        elif any(entry["run"] for entry in upstream):
+            reason = "upstream"
+        else:
+            reason = None
+        plan[stage] = {"fingerprint": stage_fingerprint, "run": reason is not None, "reason": reason}
+    return plan
+
+
+def run_pipeline(
+    paths: tp.Dict[str, str],
+    stages: tp.Sequence[str] = tuple(STAGES),
+    workers: int = 2,
+    hash_inputs: bool = False,
+    force: bool = False,
+    schema: tp.Optional[DataSchema] = None,
+) -> pl.DataFrame:
+    schema = schema or DataSchema()
+    manifest_path = schema.target_paths["metrics.stages"]
+    manifest = load_artifact("metrics.stages", schema, mmap=False) if os.path.exists(manifest_path) else {}
+    plan = plan_stages(paths, manifest, schema, stages=stages, hash_inputs=hash_inputs, force=force)
+
+    log_dir = join(schema.export_dir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    report = {
+        stage: {"stage": stage, "status": "skipped", "reason": entry["reason"], "seconds": None, "peak_rss_mb": None}
+        for stage, entry in plan.items()
+    }
+    pending = [stage for stage in plan if plan[stage]["run"]]
+    done = {stage for stage in plan if not plan[stage]["run"]}
+    running, error = {}, None
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        while pending or running:
+            # stages start as soon as everything upstream of them has finished, a failure stops new starts
+            ready = [
+                stage for stage in pending
+                if error is None and all(name in done or name not in plan for name in STAGES[stage]["upstream"])
+            ]
+            for stage in ready:
+                pending.remove(stage)
+                args = [arg.format(**paths) for arg in STAGES[stage]["args"]]
+                running[pool.submit(run_stage, stage, args, os.getcwd(), log_dir)] = stage
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    result = future.result()
+                except RuntimeError as stage_error:
+                    error = error or stage_error
+                    report[stage]["status"] = "failed"
+                    continue
+                done.add(stage)
+                report[stage].update(status="ran", seconds=result["seconds"], peak_rss_mb=result["peak_rss_mb"])
+                print(f"{stage}: {plan[stage]['reason']}, ran in {result['seconds']:.1f} sec, peak rss {result['peak_rss_mb']:.0f} MB")
+                manifest[stage] = {
+                    "fingerprint": plan[stage]["fingerprint"],
+                    "outputs": output_stats(stage, schema),
+                    "finished_at": datetime.now().isoformat(timespec="seconds"),
+                    "seconds": result["seconds"],
+                }
+                save_artifact("metrics.stages", manifest, schema)
+
+    for stage in pending:
+        report[stage]["status"] = "cancelled"
+    report = pl.DataFrame(list(report.values()), schema=REPORT_SCHEMA)
+    if error is not None:
+        print(report)
+        raise error
+    return report
+
+
+def run_in_process(
+    paths: tp.Dict[str, str],
+    invoke: tp.Callable[[str, tp.List[str]], tp.Any],
+    stages: tp.Sequence[str] = tuple(STAGES),
+    save_artifacts: bool = False,
+) -> pl.DataFrame:
+    # every stage is invoked in this process in topological order, libraries are imported once
+    # and artifacts pass between stages in memory, the stage manifest is neither read nor updated;
+    # peak rss covers the artifacts earlier stages keep in memory
+    report = []
+    with in_memory_artifacts(persist=None if save_artifacts else PIPELINE_OUTPUTS):
+        for stage in stages:
+            reset_peak_rss()
+            start = time.perf_counter()
+            invoke(stage, [arg.format(**paths) for arg in STAGES[stage]["args"]])
+            report.append({
+                "stage": stage, "status": "ran", "reason": "in-process", "seconds": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb()
+            })
+            print(f"{stage}: ran in {report[-1]['seconds']:.1f} sec, peak rss {report[-1]['peak_rss_mb']:.0f} MB")
+    return pl.DataFrame(report, schema=REPORT_SCHEMA)
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import typing as tp
+from os.path import abspath, dirname, isdir, join
+
+import configs.model
+
+
+SRC_DIR = dirname(dirname(abspath(__file__)))
+
+
+def path_stats(path: str) -> tp.Optional[tp.Tuple[int, int]]:
+    # total size and latest mtime of a file or of every file below a directory artifact
+    if not os.path.exists(path):
+        return None
+    if not isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+    size, mtime = 0, os.stat(path).st_mtime_ns
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(join(root, name))
+            size, mtime = size + stat.st_size, max(mtime, stat.st_mtime_ns)
+    return size, mtime
+
+
+def file_fingerprint(path: str, hash_contents: bool = False) -> str:
+    # size and mtime are enough for files replaced as a whole, content hashing survives copies and touches
+    if not hash_contents:
+        return json.dumps(path_stats(path))
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_fingerprint(src_dir: str = SRC_DIR, exclude: tp.Sequence[str] = ("__pycache__", "configs")) -> str:
+    # config modules are left out, stages fingerprint only the config values they read
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = sorted(name for name in dirs if name not in exclude)
+        for name in sorted(files):
+            if name.endswith(".py"):
+                path = join(root, name)
+                digest.update(os.path.relpath(path, src_dir).encode())
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+    return digest.hexdigest()
+
+
+def config_values(names: tp.Sequence[str]) -> tp.Dict[str, tp.Any]:
+    return {name: getattr(configs.model, name) for name in names}
+
+
+def fingerprint(*parts: tp.Any) -> str:
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=repr).encode()).hexdigest()[:16]
+
+
+def run_stage(stage: str, args: tp.List[str], work_dir: str, log_dir: tp.Optional[str] = None) -> tp.Dict[str, tp.Any]:
+    log_path = join(log_dir or work_dir, f"{stage}.log")
+    env = {**os.environ, "PYTHONPATH": SRC_DIR}
+    start = time.perf_counter()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, join(SRC_DIR, "workflow.py"), stage, *args], cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        # wait4 reports the resources of this child alone, unlike RUSAGE_CHILDREN
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    seconds = time.perf_counter() - start
+    if process.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed with code {process.returncode}, see {log_path}")
+
+    return {
+        "seconds": seconds,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "rows": None,
+    }
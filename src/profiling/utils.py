@@ -0,0 +1,129 @@
+import cProfile
+import json
+import os
+import resource
+import time
+import typing as tp
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from os.path import dirname, join
+
+
+PROFILERS = ("cprofile", "pyinstrument")
+
+# settings of the profiled run, steps are no-ops until enable_profiling is called
+_state: tp.Dict[str, tp.Any] = {"enabled": False}
+# open steps of the current run, innermost last
+_stack: tp.List[tp.Dict[str, float]] = []
+
+
+def peak_rss_mb() -> float:
+    # peak resident set size of this process, since start or the last reset_peak_rss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss() -> bool:
+    # linux allows resetting the high-water mark, elsewhere the peak keeps counting from process start
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def enable_profiling(
+    command: str, output_path: str, profile_step: tp.Optional[str] = None, profiler: str = "cprofile"
+) -> None:
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler '{profiler}', expected one of {PROFILERS}")
+    os.makedirs(dirname(output_path) or ".", exist_ok=True)
+    _state.update(
+        enabled=True,
+        run_id=uuid.uuid4().hex[:12],
+        command=command,
+        output_path=output_path,
+        profile_step=profile_step,
+        profiler=profiler,
+    )
+
+
+def _start_profiler(step: str) -> tp.Any:
+    if step != _state["profile_step"]:
+        return None
+    if _state["profiler"] == "pyinstrument":
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        return profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler: tp.Any, step: str) -> None:
+    if profiler is None:
+        return
+    path = join(dirname(_state["output_path"]) or ".", f"profile_{_state['command']}_{step}")
+    if _state["profiler"] == "pyinstrument":
+        profiler.stop()
+        with open(f"{path}.html", "w") as f:
+            f.write(profiler.output_html())
+    else:
+        profiler.disable()
+        profiler.dump_stats(f"{path}.prof")
+
+
+@contextmanager
+def profile_step(step: str, rows: tp.Optional[int] = None) -> tp.Iterator[tp.Dict[str, tp.Any]]:
+    # the yielded record takes the step's output row count when it is only known at the end
+    record = {"rows": rows}
+    if not _state["enabled"]:
+        yield record
+        return
+
+    # the peak so far belongs to the enclosing step, it is handed over before the mark is reset
+    if _stack:
+        _stack[-1]["peak_rss_mb"] = max(_stack[-1]["peak_rss_mb"], peak_rss_mb())
+    frame = {"peak_rss_mb": 0.0}
+    parent = _stack[-1]["step"] if _stack else None
+    _stack.append({**frame, "step": step})
+    reset_peak_rss()
+
+    profiler = _start_profiler(step)
+    started_at = datetime.now().isoformat(timespec="milliseconds")
+    start_cpu, start = time.process_time(), time.perf_counter()
+    failed = False
+    try:
+        yield record
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        wall_seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+        _stop_profiler(profiler, step)
+        peak = max(peak_rss_mb(), _stack.pop()["peak_rss_mb"])
+        if _stack:
+            _stack[-1]["peak_rss_mb"] = max(_stack[-1]["peak_rss_mb"], peak)
+
+        with open(_state["output_path"], "a") as f:
+            f.write(json.dumps({
+                "run_id": _state["run_id"],
+                "command": _state["command"],
+                "step": step,
+                "parent": parent,
+                "started_at": started_at,
+                "wall_seconds": wall_seconds,
+                "cpu_seconds": cpu_seconds,
+                "peak_rss_mb": peak,
+                "rows": record["rows"],
+                "failed": failed,
+            }) + "\n")
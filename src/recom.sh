@@ -1,3 +1,8 @@
 #!/bin/bash
 
 PYTHONPATH=. python3 workflow_recom.py recom-by-receipt-id
+
+# online scoring of posted carts, micro-batched and with models swapped in when the artifacts change
+# PYTHONPATH=. python3 workflow_recom.py serve --carts --batch-window-ms 5
+# latency and throughput per batch window against the cart batcher, report in export/serving_load_test.pq
+# PYTHONPATH=. python3 workflow_recom.py load-test --carts-path $INFERENCE_DATA_PATH --windows-ms 0,2,5,10,20 --swap-interval 1
@@ -13,5 +13,22 @@ PYTHONPATH=. python3 workflow.py inference-candidates --inference-data-path $INF
 PYTHONPATH=. python3 workflow.py train-ranker --train-data-path $TRAIN_DATA_PATH --val-data-path $VAL_DATA_PATH
 PYTHONPATH=. python3 workflow.py make-recommendations --val-data-path $VAL_DATA_PATH
 PYTHONPATH=. python3 workflow.py evaluate-common-metrics --target-path $TARGET_PATH
+PYTHONPATH=. python3 workflow.py evaluate-candidates-metrics --target-path $TARGET_PATH
 
-# PYTHONPATH=. python3 main/prod_workflow.py evaluate-candidates-metrics
+# daily delta of new receipts on top of the trained candidate models and the decayed popularity index
+# PYTHONPATH=. python3 workflow.py update --delta-data-path $DELTA_DATA_PATH --elapsed-days 1 --compare-full-refit
+
+# the same pipeline as a DAG that skips stages whose inputs, configs and code are unchanged
+# PYTHONPATH=. python3 workflow.py run-all --target-path $TARGET_PATH --workers 2
+
+# candidate model configurations from configs.model sweep_space, leaderboard in export/sweep_leaderboard.pq
+# PYTHONPATH=. python3 workflow.py sweep-candidate-models --target-path $TARGET_PATH --search random --workers 4
+
+# item name embeddings for the cart_similarity ranker feature (train-ranker --text-features)
+# PYTHONPATH=. python3 workflow.py embed-items --catalogue-path $CATALOGUE_PATH --embeddings-path $WORD_EMBEDDINGS_PATH
+
+# every stage in one process: libraries are imported once and intermediate artifacts stay in memory
+# PYTHONPATH=. python3 workflow.py run-pipeline --target-path $TARGET_PATH
+
+# compact dtypes for smaller instances, run-all reports peak rss per stage
+# PYTHONPATH=. python3 workflow.py --low-memory run-all --target-path $TARGET_PATH --workers 1
@@ -0,0 +1,74 @@
+import time
+import typing as tp
+
+from configs.schema import DataSchema
+from data.artifacts import load_artifact
+from inference.tasks import check_ranker_version, uses_text_features
+from pipeline.utils import path_stats
+
+# artifacts a bundle is built from, a change to any of them triggers a reload
+MODEL_ARTIFACTS = (
+    "models.implicit_models",
+    "models.spmat",
+    "models.spmat_norm",
+    "models.encoders",
+    "models.popularity",
+    "models.item_features",
+    "models.item_embeddings",
+)
+
+
+class ModelBundle:
+    def __init__(self, schema: DataSchema, compiled: bool = False):
+        # arrays are read into memory instead of mapped: update and train-ranker rewrite
+        # the artifact files in place while batches are still scored with this bundle
+        self.models = load_artifact("models.implicit_models", schema, mmap=False)
+        self.spmat = load_artifact("models.spmat", schema, mmap=False)
+        self.spmat_norm = load_artifact("models.spmat_norm", schema, mmap=False)
+        self.encoders = load_artifact("models.encoders", schema, mmap=False)
+        self.popularity = load_artifact("models.popularity", schema, mmap=False)
+        self.item_features = load_artifact("models.item_features", schema, mmap=False)
+        self.ranker = load_artifact("models.ranker_compiled" if compiled else "models.ranker", schema, mmap=False)
+        check_ranker_version(self.ranker, self.item_features)
+        self.item_embeddings = (
+            load_artifact("models.item_embeddings", schema, mmap=False) if uses_text_features(self.ranker) else None
+        )
+        self.loaded_at = time.time()
+
+
+class ModelStore:
+    def __init__(self, schema: tp.Optional[DataSchema] = None, compiled: bool = False):
+        self.schema = schema or DataSchema()
+        self.compiled = compiled
+        self.bundle: tp.Optional[ModelBundle] = None
+        self.swaps = 0
+        self._version: tp.Optional[tp.Tuple] = None
+
+    @property
+    def artifact_names(self) -> tp.Tuple[str, ...]:
+        return MODEL_ARTIFACTS + ("models.ranker_compiled" if self.compiled else "models.ranker",)
+
+    def artifact_version(self) -> tp.Tuple:
+        return tuple(path_stats(self.schema.target_paths[name]) for name in self.artifact_names)
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        version = self.artifact_version()
+        if version == self._version and not force:
+            return False
+
+        bundle = ModelBundle(self.schema, compiled=self.compiled)
+        # update and train-ranker rewrite the artifacts one after another, a bundle loaded while they ran can mix
+        # new encoders with old models, so it is dropped and the next check loads the finished set
+        if self.artifact_version() != version:
+            return False
+        # batches read the bundle once, so each one is scored entirely by the old or the new models;
+        # a failed load raises before the swap and the previous bundle keeps serving
+        self.bundle = bundle
+        self._version = version
+        self.swaps += 1
+        return True
+
+    def load(self, retry_interval: float = 1.0) -> None:
+        # at startup there is no bundle to keep serving, so a load skipped by a concurrent rewrite is retried
+        while not self.reload_if_changed():
+            time.sleep(retry_interval)
@@ -0,0 +1,262 @@
+import asyncio
+import itertools
+import json
+import time
+import typing as tp
+
+import polars as pl
+
+from configs.model import CANDIDATES_BUDGET, SERVING_BATCH_WINDOW_MS, SERVING_MAX_BATCH_SIZE
+from inference.tasks import generate_candidates, rank_candidates, union_candidates
+from serving.models import ModelBundle, ModelStore
+from serving.utils import LatencyStats, MicroBatcher, RecommendationIndex, carts_frame, parse_cart
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def http_response(status: int, payload: tp.Any) -> bytes:
+    body = json.dumps(payload).encode()
+    head = (
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    )
+    return head.encode() + body
+
+
+def score_carts(
+    bundle: ModelBundle, carts: tp.Sequence[tp.Dict[str, tp.Any]], k: int = 10, budget: tp.Optional[int] = CANDIDATES_BUDGET
+) -> tp.List[tp.List[int]]:
+    # candidates, features and ranking run once for the whole batch, results come back in cart order
+    line_items = carts_frame(carts)
+    candidates = union_candidates(
+        generate_candidates(
+            line_items=line_items,
+            models=bundle.models,
+            spmat=bundle.spmat,
+            spmat_norm=bundle.spmat_norm,
+            encoders=bundle.encoders,
+            popularity=bundle.popularity,
+            score_carts=True,
+        ),
+        budget=budget,
+    )
+    recommendations = rank_candidates(
+        context=line_items.select(["receipt_id", "item_id"]),
+        candidates=candidates,
+        item_features=bundle.item_features,
+        ranker=bundle.ranker,
+        item_embeddings=bundle.item_embeddings,
+        k=k,
+        progress=False,
+    )
+    by_cart = dict(zip(recommendations["receipt_id"].to_list(), recommendations["item_id"].to_list()))
+    return [by_cart.get(idx, []) for idx in range(len(carts))]
+
+
+def cart_batcher(
+    store: ModelStore, window_ms: float = SERVING_BATCH_WINDOW_MS, max_batch_size: int = SERVING_MAX_BATCH_SIZE, k: int = 10
+) -> MicroBatcher:
+    # the bundle is read once per batch, a swap in the middle of scoring does not mix models
+    return MicroBatcher(lambda carts: score_carts(store.bundle, carts, k=k), window_ms=window_ms, max_batch_size=max_batch_size)
+
+
+def handle_request(
+    index: RecommendationIndex, stats: LatencyStats, method: str, path: str, body: bytes
+) -> tp.Tuple[int, tp.Any]:
+    if path == "/stats":
+        return 200, {**stats.summary(), "receipts": len(index), "loaded_at": index.loaded_at}
+
+    if method == "GET" and path.startswith("/recommendations/"):
+        receipt_id = int(path.rsplit("/", 1)[1])
+        items = index.get(receipt_id)
+        if items is None:
+            return 404, {"receipt_id": receipt_id, "error": "unknown receipt_id"}
+        return 200, {"receipt_id": receipt_id, "items": items}
+
+    if method == "POST" and path == "/recommendations":
+        receipt_ids = [int(receipt_id) for receipt_id in json.loads(body)["receipt_ids"]]
+        return 200, {
+            "recommendations": [
+                {"receipt_id": receipt_id, "items": items} for receipt_id, items in index.get_many(receipt_ids).items()
+            ]
+        }
+
+    return 404, {"error": f"unknown endpoint {method} {path}"}
+
+
+async def handle_cart_request(
+    batcher: MicroBatcher, store: ModelStore, stats: LatencyStats, path: str, body: bytes
+) -> tp.Tuple[int, tp.Any]:
+    if path == "/carts/stats":
+        return 200, {**stats.summary(), **batcher.summary(), "model_swaps": store.swaps, "loaded_at": store.bundle.loaded_at}
+    cart = parse_cart(json.loads(body))
+    try:
+        items = await batcher.submit(cart)
+    except Exception as e:  # the whole batch failed to score
+        return 500, {"error": str(e)}
+    return 200, {"items": items}
+
+
+async def serve_connection(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    index: RecommendationIndex,
+    stats: LatencyStats,
+    batcher: tp.Optional[MicroBatcher] = None,
+    store: tp.Optional[ModelStore] = None,
+) -> None:
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            started_at = time.monotonic()
+            method, path, _ = request_line.decode().split(" ", 2)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            try:
+                if batcher is not None and path.startswith("/carts"):
+                    status, payload = await handle_cart_request(batcher, store, stats, path, body)
+                else:
+                    status, payload = handle_request(index, stats, method, path, body)
+            except (ValueError, KeyError, TypeError) as e:
+                status, payload = 400, {"error": str(e)}
+            writer.write(http_response(status, payload))
+            await writer.drain()
+
+            if not path.endswith("/stats"):
+                stats.record(started_at)
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def watch_index(index: RecommendationIndex, reload_interval: float) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(reload_interval)
+        try:
+            if await loop.run_in_executor(None, index.reload_if_changed):
+                print(f"reloaded {index.path}: {len(index)} receipts")
+        except Exception as e:  # a half-written file must not take the service down
+            print(f"failed to reload {index.path}, serving the previous version: {e}")
+
+
+async def watch_models(store: ModelStore, reload_interval: float, force: bool = False) -> None:
+    # loading runs in a worker thread, requests keep being batched and scored with the current bundle
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(reload_interval)
+        try:
+            if await loop.run_in_executor(None, store.reload_if_changed, force):
+                print(f"swapped models, version {store.swaps}")
+        except Exception as e:  # e.g. a ranker trained on other item features than the ones on disk
+            print(f"failed to reload models, serving the previous version: {e}")
+
+
+async def run_server(
+    index: RecommendationIndex,
+    host: str,
+    port: int,
+    reload_interval: float,
+    store: tp.Optional[ModelStore] = None,
+    batch_window_ms: float = SERVING_BATCH_WINDOW_MS,
+    max_batch_size: int = SERVING_MAX_BATCH_SIZE,
+) -> None:
+    stats = LatencyStats()
+    tasks = [asyncio.create_task(watch_index(index, reload_interval))]
+    batcher = None
+    if store is not None:
+        batcher = cart_batcher(store, window_ms=batch_window_ms, max_batch_size=max_batch_size)
+        tasks += [asyncio.create_task(batcher.run()), asyncio.create_task(watch_models(store, reload_interval))]
+    server = await asyncio.start_server(lambda r, w: serve_connection(r, w, index, stats, batcher, store), host=host, port=port)
+    print(f"serving {len(index)} receipts on http://{host}:{port}" + (", carts on POST /carts" if batcher else ""))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if batcher is not None:
+            batcher.close()
+
+
+async def _load_test_window(
+    store: ModelStore,
+    carts: tp.Sequence[tp.Dict[str, tp.Any]],
+    window_ms: float,
+    concurrency: int,
+    n_requests: int,
+    max_batch_size: int,
+    swap_interval: tp.Optional[float],
+) -> tp.Dict[str, tp.Any]:
+    batcher = cart_batcher(store, window_ms=window_ms, max_batch_size=max_batch_size)
+    stats = LatencyStats(window_size=n_requests)
+    counter = itertools.count()
+    errors, swaps = 0, store.swaps
+
+    # closed loop: every client sends its next cart as soon as the previous one is answered
+    async def client() -> None:
+        nonlocal errors
+        while (idx := next(counter)) < n_requests:
+            started_at = time.monotonic()
+            try:
+                await batcher.submit(carts[idx % len(carts)])
+            except Exception:
+                errors += 1
+                continue
+            stats.record(started_at)
+
+    tasks = [asyncio.create_task(batcher.run())]
+    if swap_interval:
+        tasks.append(asyncio.create_task(watch_models(store, swap_interval, force=True)))
+    started_at = time.monotonic()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started_at
+    for task in tasks:
+        task.cancel()
+    batcher.close()
+
+    summary = stats.summary()
+    return {
+        "window_ms": float(window_ms),
+        "concurrency": concurrency,
+        "requests": summary["requests"],
+        "errors": errors,
+        "throughput_rps": summary["requests"] / elapsed,
+        "p50_ms": summary["p50_ms"],
+        "p99_ms": summary["p99_ms"],
+        "max_ms": summary["max_ms"],
+        "mean_batch_size": batcher.summary()["mean_batch_size"],
+        "model_swaps": store.swaps - swaps,
+    }
+
+
+def run_load_test(
+    store: ModelStore,
+    carts: tp.Sequence[tp.Dict[str, tp.Any]],
+    windows_ms: tp.Sequence[float],
+    concurrency: int = 32,
+    n_requests: int = 2000,
+    max_batch_size: int = SERVING_MAX_BATCH_SIZE,
+    swap_interval: tp.Optional[float] = None,
+) -> pl.DataFrame:
+    # a warm-up batch keeps one-off library initialisation out of the first window
+    score_carts(store.bundle, carts[:max_batch_size])
+    return pl.DataFrame([
+        asyncio.run(_load_test_window(store, carts, window_ms, concurrency, n_requests, max_batch_size, swap_interval))
+        for window_ms in windows_ms
+    ])
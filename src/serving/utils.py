@@ -0,0 +1,177 @@
+import asyncio
+import os
+import time
+import typing as tp
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import polars as pl
+
+from configs.model import SERVING_BATCH_WINDOW_MS, SERVING_MAX_BATCH_SIZE
+
+
+class RecommendationIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._recommendations: tp.Dict[int, tp.List[int]] = {}
+        self._version: tp.Optional[tp.Tuple[int, int]] = None
+        self.loaded_at: tp.Optional[float] = None
+
+    def __len__(self) -> int:
+        return len(self._recommendations)
+
+    def reload_if_changed(self) -> bool:
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self._version:
+            return False
+
+        recs = pl.read_parquet(self.path, columns=["receipt_id", "item_id"])
+        # the new mapping is built aside and swapped in with a single assignment,
+        # so concurrent lookups see either the old or the new file, never a mix
+        self._recommendations = dict(zip(recs["receipt_id"].to_list(), recs["item_id"].to_list()))
+        self._version = version
+        self.loaded_at = time.time()
+        return True
+
+    def get(self, receipt_id: int) -> tp.Optional[tp.List[int]]:
+        return self._recommendations.get(receipt_id)
+
+    def get_many(self, receipt_ids: tp.Iterable[int]) -> tp.Dict[int, tp.Optional[tp.List[int]]]:
+        recommendations = self._recommendations
+        return {receipt_id: recommendations.get(receipt_id) for receipt_id in receipt_ids}
+
+
+class LatencyStats:
+    def __init__(self, window_size: int = 100_000, qps_window_sec: float = 10.0):
+        self.qps_window_sec = qps_window_sec
+        self.total_requests = 0
+        self.started_at = time.monotonic()
+        self._samples: tp.Deque[tp.Tuple[float, float]] = deque(maxlen=window_size)
+
+    def record(self, started_at: float) -> None:
+        finished_at = time.monotonic()
+        self._samples.append((finished_at, finished_at - started_at))
+        self.total_requests += 1
+
+    def summary(self) -> tp.Dict[str, float]:
+        samples = np.asarray(self._samples, dtype=np.float64).reshape(-1, 2)
+        now = time.monotonic()
+        recent = samples[samples[:, 0] >= now - self.qps_window_sec]
+        window = min(self.qps_window_sec, now - self.started_at)
+        latencies_ms = samples[:, 1] * 1000
+        p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99]) if latencies_ms.shape[0] else (0.0, 0.0, 0.0)
+        return {
+            "requests": self.total_requests,
+            "qps": recent.shape[0] / window if window > 0 else 0.0,
+            "p50_ms": float(p50),
+            "p90_ms": float(p90),
+            "p99_ms": float(p99),
+            "max_ms": float(latencies_ms.max()) if latencies_ms.shape[0] else 0.0,
+        }
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        score_batch: tp.Callable[[tp.List[tp.Any]], tp.List[tp.Any]],
+        window_ms: float = SERVING_BATCH_WINDOW_MS,
+        max_batch_size: int = SERVING_MAX_BATCH_SIZE,
+    ):
+        self.score_batch = score_batch
+        self.window_sec = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batch_sizes: tp.Deque[int] = deque(maxlen=100_000)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        # one scoring thread keeps the event loop free to accept requests for the next batch
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, request: tp.Any) -> tp.Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((request, future))
+        # the batch being collected already holds one request taken off the queue
+        if self._queue.qsize() + 1 >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            # the window starts with the first request, a full queue closes it early
+            if self.window_sec > 0 and self._queue.qsize() + 1 < self.max_batch_size:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.window_sec)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self.batch_sizes.append(len(batch))
+
+            try:
+                results = await loop.run_in_executor(self._executor, self.score_batch, [request for request, _ in batch])
+            except Exception as e:  # a failed batch fails its requests, not the batcher
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def summary(self) -> tp.Dict[str, float]:
+        sizes = np.asarray(self.batch_sizes, dtype=np.float64)
+        return {
+            "batches": int(sizes.shape[0]),
+            "mean_batch_size": float(sizes.mean()) if sizes.shape[0] else 0.0,
+            "max_batch_size": int(sizes.max()) if sizes.shape[0] else 0,
+            "queued": self._queue.qsize(),
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+def parse_cart(payload: tp.Dict[str, tp.Any]) -> tp.Dict[str, tp.Any]:
+    items = [int(item_id) for item_id in payload["items"]]
+    if not items:
+        raise ValueError("cart has no items")
+    cart = {"items": items, "quantities": [float(quantity) for quantity in payload.get("quantities", [1.0] * len(items))]}
+    if len(cart["quantities"]) != len(items):
+        raise ValueError("cart has a different number of items and quantities")
+    if payload.get("store_id") is not None:
+        cart["store_id"] = int(payload["store_id"])
+    return cart
+
+
+def carts_frame(carts: tp.Sequence[tp.Dict[str, tp.Any]]) -> pl.DataFrame:
+    # every cart becomes a receipt whose id is its position in the batch
+    line_items = pl.DataFrame({
+        "receipt_id": [idx for idx, cart in enumerate(carts) for _ in cart["items"]],
+        "item_id": [item_id for cart in carts for item_id in cart["items"]],
+        "quantity": [quantity for cart in carts for quantity in cart["quantities"]],
+    }, schema={"receipt_id": pl.Int64, "item_id": pl.Int64, "quantity": pl.Float64})
+    if any("store_id" in cart for cart in carts):
+        line_items = line_items.with_columns(
+            pl.Series("store_id", [cart.get("store_id") for cart in carts for _ in cart["items"]], dtype=pl.Int64)
+        )
+    return line_items
+
+
+def load_carts(path: str, limit: tp.Optional[int] = None) -> tp.List[tp.Dict[str, tp.Any]]:
+    line_items = pl.read_csv(path, separator="\t")
+    columns = [column for column in ("store_id",) if column in line_items.columns]
+    receipts = (
+        line_items
+            .group_by("receipt_id", maintain_order=True)
+            .agg([pl.col("item_id"), pl.col("quantity").cast(pl.Float64)] + [pl.col(column).first() for column in columns])
+    )
+    if limit is not None:
+        receipts = receipts.head(limit)
+    return [
+        parse_cart({"items": row["item_id"], "quantities": row["quantity"], **{column: row[column] for column in columns}})
+        for row in receipts.iter_rows(named=True)
+    ]
@@ -1,22 +1,80 @@
-from typing import Dict, Any
+from typing import Any, Dict, Optional
 
+import numpy as np
+import polars as pl
 from implicit.als import AlternatingLeastSquares
 from implicit.nearest_neighbours import BM25Recommender, CosineRecommender, TFIDFRecommender
 from scipy.sparse import csr_matrix
 
-from configs.model import bm25_config, tfidf_config, cosine_config, als_config
+from configs.model import ITEM_ITEM_REFIT_SHARE, bm25_config, tfidf_config, cosine_config, als_config
+from data.features import IncrementalStats
+from profiling.utils import profile_step
+from train.utils import item_item_sums, update_als_factors, update_similarity_rows
+
+
+# model class and configured parameters of every candidate generator
+CANDIDATE_MODELS = {
+    "bm25": (BM25Recommender, bm25_config),
+    "tfidf": (TFIDFRecommender, tfidf_config),
+    "cosine": (CosineRecommender, cosine_config),
+    "als": (AlternatingLeastSquares, als_config),
+}
+
+
+def build_model(model_name: str, params: Optional[Dict[str, Any]] = None) -> Any:
+    model_class, config = CANDIDATE_MODELS[model_name]
+    return model_class(**{**config, **(params or {})})
 
 
 def train_implicit_models(spmat_norm: csr_matrix, spmat: csr_matrix) -> Dict[str, Any]:
-    models = {
-        "bm25": BM25Recommender(**bm25_config),
-        "tfidf": TFIDFRecommender(**tfidf_config),
-        "cosine": CosineRecommender(**cosine_config),
-        "als": AlternatingLeastSquares(**als_config)
-    }
+    models = {model_name: build_model(model_name) for model_name in CANDIDATE_MODELS}
 
     for model in ("tfidf", "cosine", "bm25"):
-        models[model].fit(spmat_norm, show_progress=True)
-    models["als"].fit(spmat)
+        with profile_step(f"fit.{model}", rows=spmat_norm.nnz):
+            models[model].fit(spmat_norm, show_progress=True)
+    with profile_step("fit.als", rows=spmat.nnz):
+        models["als"].fit(spmat)
+
+    return models
+
+
+def update_implicit_models(
+    models: Dict[str, Any],
+    spmat_norm: csr_matrix,
+    spmat: csr_matrix,
+    stats: IncrementalStats,
+    new_receipts: np.ndarray,
+    touched_items: np.ndarray,
+    refit_share: float = ITEM_ITEM_REFIT_SHARE,
+) -> bool:
+    # only the delta receipts, the rows appended after those the stats cover, are read
+    delta, delta_norm = spmat[stats.n_receipts:], spmat_norm[stats.n_receipts:]
+    old_sums = stats.item_sums
+    stats.add(item_sums=item_item_sums(delta_norm), n_receipts=delta.shape[0], nnz=delta.nnz)
+
+    # the drift of the item-item models is bounded by refitting them once the appended interactions pass refit_share
+    refit = stats.nnz > (1 + refit_share) * stats.fitted_nnz
+    for model in ("tfidf", "cosine", "bm25"):
+        with profile_step(f"{'fit' if refit else 'update'}.{model}", rows=touched_items.shape[0]):
+            if refit:
+                models[model].fit(spmat_norm, show_progress=False)
+            else:
+                update_similarity_rows(models[model], delta_norm, old_sums, stats.item_sums, touched_items)
+    if refit:
+        stats.fitted_nnz = stats.nnz
+    with profile_step("update.als", rows=new_receipts.shape[0]):
+        models["als"] = update_als_factors(models["als"], delta, stats, new_receipts, touched_items)
+
+    return refit
+
 
-    return models
\ No newline at end of file
+def compare_candidates(incremental: pl.DataFrame, full: pl.DataFrame) -> pl.DataFrame:
+    # share of the full-refit candidates that the incrementally updated models also produce
+    keys = ["model_name", "receipt_id_enc", "item_id_enc"]
+    matched = incremental.select(keys).unique().join(full.select(keys).unique(), on=keys)
+    return (
+        full.group_by("model_name").agg(pl.count().alias("full"))
+        .join(matched.group_by("model_name").agg(pl.count().alias("matched")), on="model_name", how="left")
+        .with_columns((pl.col("matched").fill_null(0) / pl.col("full")).alias("overlap"))
+        .sort("model_name")
+    )
@@ -0,0 +1,147 @@
+from typing import Any, Dict, Tuple
+
+import numpy as np
+from implicit.als import AlternatingLeastSquares
+from implicit.nearest_neighbours import BM25Recommender, ItemItemRecommender, TFIDFRecommender
+from scipy.sparse import csr_matrix, diags
+
+from data.features import IncrementalStats
+from data.utils import resize_csr
+from inference.utils import csr_row_topk
+
+# constructor arguments implicit keeps as attributes of the same name
+ALS_PARAMS = (
+    "factors", "regularization", "alpha", "dtype", "use_native", "use_cg", "iterations", "calculate_training_loss",
+    "num_threads", "random_state",
+)
+ALS_TERMS_BLOCK_SIZE = 65_536
+
+
+def item_item_sums(spmat_norm: csr_matrix) -> Dict[str, np.ndarray]:
+    # per-item sums of x, x^2, x * a and x * a^2 with a = log1p(items of the receipt): bm25 item lengths,
+    # cosine norms and tf-idf norms for any number of items follow from them
+    lengths = np.diff(spmat_norm.indptr)
+    log_lengths = np.repeat(np.log1p(lengths), lengths)
+    values = spmat_norm.data.astype(np.float64)
+    terms = {"sum": values, "sum_sq": values ** 2, "sum_idf": values * log_lengths, "sum_idf_sq": values * log_lengths ** 2}
+    return {name: np.bincount(spmat_norm.indices, weights=weights, minlength=spmat_norm.shape[1]) for name, weights in terms.items()}
+
+
+def item_norms(model: ItemItemRecommender, item_sums: Dict[str, np.ndarray]) -> np.ndarray:
+    # the per-item divisor of the model's weighting, bm25 weights are not normalized
+    n_items = item_sums["sum"].shape[0]
+    if isinstance(model, BM25Recommender):
+        return np.ones(n_items)
+    if isinstance(model, TFIDFRecommender):
+        log_n = np.log(n_items)
+        return np.sqrt(log_n ** 2 * item_sums["sum"] - 2 * log_n * item_sums["sum_idf"] + item_sums["sum_idf_sq"])
+    return np.sqrt(item_sums["sum_sq"])
+
+
+def item_item_weights(model: ItemItemRecommender, spmat_norm: csr_matrix, item_sums: Dict[str, np.ndarray]) -> csr_matrix:
+    # the weighting the model applies to spmat_norm in fit, with the item statistics of item_sums
+    coo = spmat_norm.tocoo()
+    values = coo.data.astype(np.float64)
+    idf = np.log(spmat_norm.shape[1]) - np.log1p(np.diff(spmat_norm.indptr)[coo.row])
+    if isinstance(model, BM25Recommender):
+        length_norm = (1.0 - model.B) + model.B * item_sums["sum"][coo.col] / item_sums["sum"].mean()
+        values = values * (model.K1 + 1.0) / (model.K1 * length_norm + values) * idf
+    elif isinstance(model, TFIDFRecommender):
+        values = np.sqrt(values) * idf
+    return csr_matrix((values / item_norms(model, item_sums)[coo.col], (coo.row, coo.col)), shape=spmat_norm.shape)
+
+
+def set_similarity(model: ItemItemRecommender, similarity: csr_matrix) -> None:
+    # implicit rebuilds its scorer from the similarity matrix when a model is unpickled
+    state = model.__getstate__()
+    state["similarity"] = similarity
+    model.__setstate__(state)
+
+
+def update_similarity_rows(
+    model: ItemItemRecommender,
+    delta_norm: csr_matrix,
+    old_sums: Dict[str, np.ndarray],
+    item_sums: Dict[str, np.ndarray],
+    itemids: np.ndarray,
+) -> None:
+    # stored similarities are dot products of the item vectors, so they are rescaled to the items' current norms
+    # (exact for cosine) and touched rows add the products over the delta receipts before their top K is taken again
+    n_items = delta_norm.shape[1]
+    old_norms = np.pad(item_norms(model, old_sums), (0, n_items - old_sums["sum"].shape[0]))
+    scale = np.divide(old_norms, item_norms(model, item_sums), out=np.ones(n_items), where=old_norms > 0)
+    similarity = diags(scale) @ resize_csr(model.similarity, (n_items, n_items)) @ diags(scale)
+
+    # the products are symmetric, a pair outside a touched row's top K is still known when the row is in the pair's
+    weighted = item_item_weights(model, delta_norm, item_sums)
+    known = similarity.tocsr()[itemids].maximum(similarity.T.tocsr()[itemids])
+    rows, cols, data = csr_row_topk((known + weighted.T.tocsr()[itemids] @ weighted).tocsr(), model.K)
+    fresh = csr_matrix((data, (itemids[rows], cols)), shape=(n_items, n_items))
+
+    keep = np.ones(n_items)
+    keep[itemids] = 0
+    similarity = diags(keep) @ similarity + fresh
+    similarity.eliminate_zeros()
+    set_similarity(model, similarity.tocsr().astype(model.similarity.dtype))
+
+
+def als_terms(user_items: csr_matrix, user_factors: np.ndarray, alpha: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # the receipts' share of every item's least squares problem as implicit's solver builds it:
+    # (gram + regularization + sum (c - 1) y y^T) x = sum c y over the item's receipts y with confidence c
+    n_factors = user_factors.shape[1]
+    lhs, rhs = np.zeros((user_items.shape[1], n_factors ** 2)), np.zeros((user_items.shape[1], n_factors))
+    gram = np.zeros((n_factors, n_factors))
+    for start in range(0, user_items.shape[0], ALS_TERMS_BLOCK_SIZE):
+        block = user_items[start:start + ALS_TERMS_BLOCK_SIZE]
+        factors = user_factors[start:start + ALS_TERMS_BLOCK_SIZE].astype(np.float64)
+        confidence = alpha * block.data.astype(np.float64)
+        outer = (factors[:, :, None] * factors[:, None, :]).reshape(factors.shape[0], -1)
+        lhs += csr_matrix((np.abs(confidence) - 1, block.indices, block.indptr), shape=block.shape).T @ outer
+        rhs += csr_matrix((np.maximum(confidence, 0), block.indices, block.indptr), shape=block.shape).T @ factors
+        gram += factors.T @ factors
+    return gram, lhs.reshape(-1, n_factors, n_factors), rhs
+
+
+def fit_incremental_stats(models: Dict[str, Any], spmat: csr_matrix, spmat_norm: csr_matrix) -> IncrementalStats:
+    als = models["als"]
+    gram, lhs, rhs = als_terms(spmat, als.user_factors, als.alpha)
+    return IncrementalStats(
+        item_sums=item_item_sums(spmat_norm),
+        als_gram=gram,
+        als_lhs=lhs,
+        als_rhs=rhs,
+        n_receipts=spmat.shape[0],
+        nnz=spmat.nnz,
+        fitted_nnz=spmat.nnz,
+    )
+
+
+def with_item_factors(model: AlternatingLeastSquares, item_factors: np.ndarray) -> AlternatingLeastSquares:
+    # a model built from the same parameters, so no norms or gram matrices cached from the old factors survive
+    rebuilt = type(model)(**{name: getattr(model, name) for name in ALS_PARAMS})
+    rebuilt.cg_steps = model.cg_steps
+    rebuilt.user_factors, rebuilt.item_factors = model.user_factors, item_factors.astype(model.dtype)
+    return rebuilt
+
+
+def update_als_factors(
+    model: AlternatingLeastSquares, delta: csr_matrix, stats: IncrementalStats, userids: np.ndarray, itemids: np.ndarray
+) -> AlternatingLeastSquares:
+    # new users are folded in against the known items first, so new items have user factors to fit against
+    n_known_items = model.item_factors.shape[0]
+    model.partial_fit_users(userids, delta[:, :n_known_items])
+    folded = als_terms(delta, model.user_factors[userids], model.alpha)
+    stats.add(als_terms=folded)
+
+    # the touched items' least squares problems come from the accumulated terms, not from their receipts
+    n_factors = stats.als_gram.shape[0]
+    lhs = stats.als_gram + model.regularization * np.eye(n_factors) + stats.als_lhs[itemids]
+    item_factors = np.concatenate((model.item_factors, np.zeros((delta.shape[1] - n_known_items, n_factors), dtype=model.dtype)))
+    item_factors[itemids] = np.linalg.solve(lhs, stats.als_rhs[itemids][..., None])[..., 0]
+    model = with_item_factors(model, item_factors)
+
+    model.partial_fit_users(userids, delta)
+    # the delta receipts' terms follow their refitted factors
+    refitted = als_terms(delta, model.user_factors[userids], model.alpha)
+    stats.add(als_terms=tuple(new - old for new, old in zip(refitted, folded)))
+    return model
@@ -0,0 +1,114 @@
+import json
+import time
+import typing as tp
+
+import polars as pl
+from tqdm import tqdm
+
+from configs.model import N_CANDIDATES, RANDOM_STATE, SWEEP_TRIALS, als_inference_config, nn_inference_config
+from configs.schema import DataSchema
+from data.artifacts import load_artifact
+from evaluation.tasks import CANDIDATE_CUTOFFS
+from evaluation.utils import candidate_metrics
+from inference.tasks import spawn_worker_pool
+from inference.utils import alternating_least_squares_candidates, candidates_frame, nearest_neighbours_candidates
+from profiling.utils import peak_rss_mb, reset_peak_rss
+from train.tasks import CANDIDATE_MODELS, build_model
+from tuning.utils import expand_space, model_size_mb
+
+
+# matrices and the held-out receipts of a sweep worker, loaded once per process
+_shared: tp.Dict[str, tp.Any] = {}
+
+
+def sweep_trials(
+    space: tp.Dict[str, tp.Dict[str, tp.Sequence[tp.Any]]],
+    search: str = "grid",
+    n_trials: int = SWEEP_TRIALS,
+    seed: int = RANDOM_STATE,
+) -> tp.List[tp.Tuple[str, tp.Dict[str, tp.Any]]]:
+    trials = []
+    for model_name, model_space in space.items():
+        if model_name not in CANDIDATE_MODELS:
+            raise ValueError(f"Unknown candidate model '{model_name}', expected one of {tuple(CANDIDATE_MODELS)}")
+        # the configured parameters always run as the baseline of their model
+        configs = []
+        for params in [{}] + expand_space(model_space, search, n_trials, seed):
+            config = {**CANDIDATE_MODELS[model_name][1], **params}
+            if config not in configs:
+                configs.append(config)
+        trials.extend((model_name, config) for config in configs)
+    return trials
+
+
+def _init_sweep_worker(user_indexes: tp.List[int], target: pl.DataFrame) -> None:
+    # interaction matrices are memory-mapped, every worker reads the same pages
+    schema = DataSchema()
+    _shared.update(
+        spmat=load_artifact("models.spmat", schema),
+        spmat_norm=load_artifact("models.spmat_norm", schema),
+        user_indexes=user_indexes,
+        target=target,
+    )
+
+
+def evaluate_config(model_name: str, config: tp.Dict[str, tp.Any], n_candidates: int = N_CANDIDATES) -> tp.Dict[str, tp.Any]:
+    uim = _shared["spmat"] if model_name == "als" else _shared["spmat_norm"]
+    reset_peak_rss()
+
+    model = build_model(model_name, config)
+    start = time.perf_counter()
+    model.fit(uim, show_progress=False)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if model_name == "als":
+        receipt_idxs, item_idxs, scores = alternating_least_squares_candidates(
+            model=model, uim=uim, user_idxs=_shared["user_indexes"], n_candidates_default=n_candidates, **als_inference_config
+        )
+    else:
+        receipt_idxs, item_idxs, scores = nearest_neighbours_candidates(
+            model=model, uim=uim, user_idxs=_shared["user_indexes"], n_candidates_default=n_candidates, **nn_inference_config
+        )
+    inference_seconds = time.perf_counter() - start
+
+    candidates = candidates_frame(receipt_idxs, item_idxs, model_name, scores).rename({"receipt_id_enc": "receipt_id", "item_id_enc": "item_id"})
+    metrics = candidate_metrics(candidates, _shared["target"], [n for n in CANDIDATE_CUTOFFS if n < n_candidates])
+    return {
+        "model_name": model_name,
+        "config": json.dumps(config, sort_keys=True),
+        **metrics,
+        "fit_seconds": fit_seconds,
+        "inference_seconds": inference_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+        "model_mb": model_size_mb(model),
+    }
+
+
+def run_sweep(
+    trials: tp.List[tp.Tuple[str, tp.Dict[str, tp.Any]]],
+    user_indexes: tp.List[int],
+    target: pl.DataFrame,
+    workers: int = 1,
+    n_candidates: int = N_CANDIDATES,
+) -> pl.DataFrame:
+    if workers <= 1:
+        _init_sweep_worker(user_indexes, target)
+        try:
+            results = [evaluate_config(model_name, config, n_candidates) for model_name, config in tqdm(trials)]
+        finally:
+            _shared.clear()
+    else:
+        with spawn_worker_pool(workers, initializer=_init_sweep_worker, initargs=(user_indexes, target)) as pool:
+            futures = [pool.submit(evaluate_config, model_name, config, n_candidates) for model_name, config in trials]
+            results = [future.result() for future in tqdm(futures)]
+
+    configured = {model_name: json.dumps(config, sort_keys=True) for model_name, (_, config) in CANDIDATE_MODELS.items()}
+    return (
+        pl.DataFrame(results)
+        .with_columns(
+            (pl.col("config") == pl.col("model_name").map_dict(configured)).alias("configured"),
+            pl.col("recall").rank("ordinal", descending=True).over("model_name").alias("position"),
+        )
+        .sort(["model_name", "position"])
+    )
@@ -0,0 +1,45 @@
+import itertools
+import typing as tp
+
+import numpy as np
+import polars as pl
+
+from configs.schema import DataSchema
+from data.encoders import IdEncoder
+
+
+SEARCH_STRATEGIES = ("grid", "random")
+
+
+def expand_space(
+    space: tp.Dict[str, tp.Sequence[tp.Any]], search: str = "grid", n_trials: int = 10, seed: int = 0
+) -> tp.List[tp.Dict[str, tp.Any]]:
+    if search not in SEARCH_STRATEGIES:
+        raise ValueError(f"Unknown search '{search}', expected one of {SEARCH_STRATEGIES}")
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if search == "grid":
+        return grid
+    # random search samples grid points without replacement
+    rng = np.random.default_rng(seed)
+    return [grid[idx] for idx in np.sort(rng.choice(len(grid), min(n_trials, len(grid)), replace=False))]
+
+
+def encode_target(target: pl.DataFrame, encoders: tp.Dict[str, IdEncoder]) -> pl.DataFrame:
+    # target items the models never saw stay in as misses with the missing code
+    target = target.select(["receipt_id", "item_id"]).unique()
+    target = target.filter(pl.Series(values=encoders["receipt_id"].contains(target["receipt_id"].to_numpy())))
+    dtype = DataSchema().code_dtype
+    return pl.DataFrame([
+        pl.Series(name="receipt_id", values=encoders["receipt_id"].encode(target["receipt_id"]), dtype=dtype),
+        pl.Series(name="item_id", values=encoders["item_id"].encode(target["item_id"], unknown="missing"), dtype=dtype),
+    ])
+
+
+def model_size_mb(model: tp.Any) -> float:
+    # similarity matrix of item-item models, user and item factors of ALS
+    if hasattr(model, "similarity"):
+        arrays = (model.similarity.data, model.similarity.indices, model.similarity.indptr)
+    else:
+        arrays = (model.user_factors, model.item_factors)
+    return sum(np.asarray(array).nbytes for array in arrays) / 2 ** 20
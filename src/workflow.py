@@ -1,97 +1,308 @@
-import joblib 
+import json
+import os
+import time
+from typing import Dict, List, Optional
 
-from datetime import datetime
-from typing import Dict, Optional
-
-from tqdm import tqdm
-from catboost import CatBoostRanker
 import polars as pl
-import pandas as pd
-from typer import Option, Typer
+from typer import Context, Option, Typer
 from configs.schema import DataSchema
-from data.tasks import load_data, join_candidates_features, join_context_features, generate_features
-from train.tasks import train_implicit_models
-from inference.tasks import get_candidates, union_candidates
-from inference.utils import decode, get_receipt_indexes
+from configs.model import (
+    ALS_QUANTIZED_INDEX,
+    CANDIDATE_GENERATORS,
+    CANDIDATE_NEGATIVES,
+    CANDIDATES_BUDGET,
+    ITEM_ITEM_REFIT_SHARE,
+    N_CANDIDATES,
+    NEGATIVES_PER_POSITIVE,
+    RANDOM_STATE,
+    RANKER_BATCH_SIZE,
+    RANKER_CANDIDATE_FEATURES,
+    RANKER_TEXT_FEATURES,
+    SWEEP_TRIALS,
+)
+from profiling.utils import PROFILERS, enable_profiling, profile_step
 
+# commands import the modules they need in their bodies, so a command starts without
+# loading the libraries of every other one (CatBoost alone costs over a second)
 cli = Typer()
 
 
+@cli.callback()
+def main(
+    ctx: Context,
+    profile: bool = Option(default=False, envvar="RECS_PROFILE", help="Append per-step timings and peak memory to export/profile.jsonl"),
+    dump_step: Optional[str] = Option(None, "--profile-step", envvar="RECS_PROFILE_STEP", help="Step to dump a profiler report for, e.g. fit.als"),
+    profiler: str = Option(default="cprofile", envvar="RECS_PROFILER", help=f"One of {', '.join(PROFILERS)}"),
+    low_memory: Optional[bool] = Option(
+        None, "--low-memory/--no-low-memory", help="Compact dtypes in every table, configs.model LOW_MEMORY by default"
+    ),
+):
+    if low_memory is not None:
+        # exported so that stage subprocesses and spawned workers run in the same mode
+        os.environ["RECS_LOW_MEMORY"] = "1" if low_memory else "0"
+    if not (profile or dump_step):
+        return
+    enable_profiling(ctx.invoked_subcommand, DataSchema().target_paths["metrics.profile"], profile_step=dump_step, profiler=profiler)
+    ctx.with_resource(profile_step("total"))
+
+
 @cli.command()
 def load(
     train_data_path: str = Option(..., envvar="TRAIN_DATA_PATH"),
-    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH")
+    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH"),
+    streaming: bool = Option(default=False, help="Process line items in receipt chunks without loading the files into memory"),
+    memory_budget_mb: float = Option(default=1024, envvar="MEMORY_BUDGET_MB", help="Working memory per chunk in streaming mode"),
+):
+    from data.artifacts import artifact_writer, save_artifact
+    from data.tasks import load_data, load_data_streaming
+    schema = DataSchema()
+    if streaming:
+        with artifact_writer("data.rpi", schema) as write_rpi:
+            spmat, spmat_norm, encoders, popularity = load_data_streaming(
+                train_data_path=train_data_path,
+                val_data_path=val_data_path,
+                memory_budget_mb=memory_budget_mb,
+                write_rpi=write_rpi,
+            )
+    else:
+        rpi, spmat, spmat_norm, encoders, popularity = load_data(train_data_path=train_data_path, val_data_path=val_data_path)
+        save_artifact("data.rpi", rpi, schema)
+    items = (("spmat", spmat), ("spmat_norm", spmat_norm), ("encoders", encoders), ("popularity", popularity))
+    for name, item in items:
+        save_artifact(f"models.{name}", item, schema)
+
+
+@cli.command()
+def embed_items(
+    catalogue_path: str = Option(..., envvar="CATALOGUE_PATH", help="TSV with item_id and item name columns"),
+    embeddings_path: str = Option(..., envvar="WORD_EMBEDDINGS_PATH", help="Word vectors in word2vec text format"),
+    name_column: str = Option(default="name"),
 ):
+    from data.artifacts import save_artifact
+    from data.tasks import embed_item_names
     schema = DataSchema()
-    rpi, spmat, spmat_norm, encoders, popular_products = load_data(train_data_path=train_data_path, val_data_path=val_data_path)
-    rpi.write_csv(schema.target_paths["data.rpi"])
-    jlb_items = (("spmat", spmat), ("spmat_norm", spmat_norm), ("encoders", encoders))
-    for name, item in jlb_items:
-        joblib.dump(item, schema.target_paths[f"models.{name}"])
-    popular_products.write_csv(schema.target_paths["data.popular_products"])
+    catalogue = pl.read_csv(catalogue_path, separator="\t", quote_char=None)
+    item_embeddings = embed_item_names(catalogue, embeddings_path, name_column=name_column)
+    print(f"{len(item_embeddings)} items, {int(item_embeddings.vectors.any(axis=1).sum())} with a known word")
+    save_artifact("models.item_embeddings", item_embeddings, schema)
 
 
 @cli.command()
 def train_candidate_models():
+    from data.artifacts import load_artifact, save_artifact
+    from train.tasks import train_implicit_models
+    from train.utils import fit_incremental_stats
     schema = DataSchema()
-    spmat_norm = joblib.load(schema.target_paths["models.spmat_norm"])
-    spmat = joblib.load(schema.target_paths["models.spmat"])
+    # implicit fits on writable buffers, so the training matrices are not memory-mapped
+    spmat_norm = load_artifact("models.spmat_norm", schema, mmap=False)
+    spmat = load_artifact("models.spmat", schema, mmap=False)
     models = train_implicit_models(spmat_norm=spmat_norm, spmat=spmat)
-    joblib.dump(models, schema.target_paths["models.implicit_models"])
+    save_artifact("models.implicit_models", models, schema)
+    # the running sums update continues from
+    with profile_step("fit.incremental_stats", rows=spmat.nnz):
+        save_artifact("models.incremental_stats", fit_incremental_stats(models, spmat, spmat_norm), schema)
+
+
+@cli.command()
+def sweep_candidate_models(
+    target_path: str = Option(..., envvar="TARGET_PATH"),
+    space_path: Optional[str] = Option(default=None, help="JSON search space, configs.model.sweep_space by default"),
+    model: Optional[List[str]] = Option(default=None, help="Sweep only these models, repeatable"),
+    search: str = Option(default="grid", help="grid or random"),
+    n_trials: int = Option(default=SWEEP_TRIALS, help="Configurations sampled per model by a random search"),
+    workers: int = Option(default=2),
+    n_candidates: int = Option(default=N_CANDIDATES),
+):
+    from configs.model import sweep_space
+    from data.artifacts import load_artifact, save_artifact
+    from tuning.tasks import run_sweep, sweep_trials
+    from tuning.utils import encode_target
+    schema = DataSchema()
+    # candidates are generated for the held-out receipts from their rows of the training matrix, as in inference-candidates
+    target = encode_target(pl.read_csv(target_path, separator="\t"), load_artifact("models.encoders", schema))
+    space = sweep_space
+    if space_path is not None:
+        with open(space_path) as f:
+            space = json.load(f)
+    space = {model_name: model_space for model_name, model_space in space.items() if not model or model_name in model}
+
+    trials = sweep_trials(space, search=search, n_trials=n_trials)
+    print(f"{len(trials)} configurations on {workers} workers")
+    leaderboard = run_sweep(
+        trials, user_indexes=target["receipt_id"].unique().to_list(), target=target, workers=workers, n_candidates=n_candidates
+    )
+    save_artifact("metrics.sweep", leaderboard, schema)
+    with pl.Config(tbl_rows=leaderboard.shape[0], tbl_cols=-1, fmt_str_lengths=80, tbl_width_chars=250):
+        print(leaderboard.drop(["receipts_covered", "candidates_per_receipt"]))
+
+
+@cli.command()
+def update(
+    delta_data_path: str = Option(..., envvar="DELTA_DATA_PATH"),
+    compare_full_refit: bool = Option(default=False, help="Also refit all models from scratch and report candidate overlap"),
+    elapsed_days: float = Option(default=1.0, help="Days since the previous delta, older lines decay in popularity by this much"),
+):
+    from data.artifacts import load_artifact, save_artifact
+    from data.tasks import append_line_items, read_line_items
+    from inference.tasks import get_candidates
+    from train.tasks import compare_candidates, train_implicit_models, update_implicit_models
+    from train.utils import fit_incremental_stats
+    schema = DataSchema()
+    # artifacts are rewritten in place, so nothing is memory-mapped
+    spmat_norm = load_artifact("models.spmat_norm", schema, mmap=False)
+    spmat = load_artifact("models.spmat", schema, mmap=False)
+    encoders = load_artifact("models.encoders", schema, mmap=False)
+    models = load_artifact("models.implicit_models", schema, mmap=False)
+    popularity = load_artifact("models.popularity", schema, mmap=False)
+    stats_path = schema.target_paths["models.incremental_stats"]
+    stats = load_artifact("models.incremental_stats", schema, mmap=False) if os.path.exists(stats_path) else None
+    if stats is None or stats.n_receipts != spmat.shape[0] or stats.nnz != spmat.nnz:
+        # models trained before the stats existed or matrices loaded since, built once from the full matrices
+        print("incremental stats are missing or stale, computing them from the interaction matrices")
+        stats = fit_incremental_stats(models, spmat, spmat_norm)
+
+    start = time.perf_counter()
+    delta_li = read_line_items(delta_data_path)
+    delta_rpi, spmat, spmat_norm, encoders, new_receipts, touched_items = append_line_items(
+        line_items=delta_li, spmat=spmat, spmat_norm=spmat_norm, encoders=encoders
+    )
+    refit = update_implicit_models(
+        models, spmat_norm=spmat_norm, spmat=spmat, stats=stats, new_receipts=new_receipts, touched_items=touched_items
+    )
+    with profile_step("update.popularity", rows=delta_li.shape[0]):
+        popularity.update(delta_li, day=popularity.day + elapsed_days)
+    update_seconds = time.perf_counter() - start
+    print(f"appended {new_receipts.shape[0]} receipts touching {touched_items.shape[0]} items in {update_seconds:.2f} sec")
+    if refit:
+        print(f"item-item models refitted, appended interactions passed {ITEM_ITEM_REFIT_SHARE:.0%} of the fitted ones")
+
+    rpi = load_artifact("data.rpi", schema)
+    rpi = pl.concat((rpi, delta_rpi.select([pl.col(col).cast(dtype) for col, dtype in rpi.schema.items()])))
+    save_artifact("data.rpi", rpi, schema)
+    items = (
+        ("spmat", spmat), ("spmat_norm", spmat_norm), ("encoders", encoders), ("implicit_models", models),
+        ("incremental_stats", stats), ("popularity", popularity),
+    )
+    for name, item in items:
+        save_artifact(f"models.{name}", item, schema)
+
+    if compare_full_refit:
+        start = time.perf_counter()
+        full_models = train_implicit_models(spmat_norm=spmat_norm, spmat=spmat)
+        refit_seconds = time.perf_counter() - start
+        user_indexes = new_receipts.tolist()
+        report = compare_candidates(
+            incremental=pl.concat(list(get_candidates(models=models, uim=spmat, uim_norm=spmat_norm, user_indexes=user_indexes).values())),
+            full=pl.concat(list(get_candidates(models=full_models, uim=spmat, uim_norm=spmat_norm, user_indexes=user_indexes).values())),
+        )
+        print(report)
+        print(f"incremental update {update_seconds:.2f} sec, full refit {refit_seconds:.2f} sec")
+        save_artifact("metrics.update", {
+            "overlap": dict(zip(report["model_name"], report["overlap"])),
+            "update_seconds": update_seconds,
+            "refit_seconds": refit_seconds,
+            "new_receipts": new_receipts.shape[0],
+            "touched_items": touched_items.shape[0],
+        }, schema)
 
 
 @cli.command()
 def inference_candidates(
     inference_data_path: str = Option(..., envvar="INFERENCE_DATA_PATH"),
+    workers: int = Option(default=1),
+    executor: str = Option(default="thread"),
+    score_carts: bool = Option(default=False),
+    quantize_als: bool = Option(default=ALS_QUANTIZED_INDEX, help="Retrieve ALS candidates from an int8 item index"),
+    allowed_items_path: Optional[str] = Option(default=None, help="TSV with an item_id column, ALS only retrieves these items"),
+    budget: Optional[int] = Option(default=CANDIDATES_BUDGET, help="Candidates kept per receipt by reciprocal-rank fusion"),
 ):
+    from data.artifacts import load_artifact, save_artifact
+    from data.tasks import read_line_items
+    from inference.tasks import generate_candidates, union_candidates
+    from inference.utils import allowed_items_mask
     schema = DataSchema()
-    spmat_norm = joblib.load(schema.target_paths["models.spmat_norm"])
-    spmat = joblib.load(schema.target_paths["models.spmat"])
-    models = joblib.load(schema.target_paths["models.implicit_models"])
-    encoders = joblib.load(schema.target_paths["models.encoders"])
-
-    df = (
-        pl.read_csv(inference_data_path, separator="\t")
-            .group_by(["receipt_id", "item_id"])
-            .agg([pl.col("quantity").sum()])
-            .select(["item_id", "receipt_id"])
-            .group_by("receipt_id")
-            .agg(pl.col("item_id"))
+    spmat_norm = load_artifact("models.spmat_norm", schema)
+    spmat = load_artifact("models.spmat", schema)
+    models = load_artifact("models.implicit_models", schema)
+    encoders = load_artifact("models.encoders", schema)
+    allowed_items = None
+    if allowed_items_path:
+        allowed_items = allowed_items_mask(pl.read_csv(allowed_items_path, separator="\t")["item_id"], encoders["item_id"], spmat.shape[1])
+
+    candidates_by_model = generate_candidates(
+        line_items=read_line_items(inference_data_path),
+        models=models,
+        spmat=spmat,
+        spmat_norm=spmat_norm,
+        encoders=encoders,
+        popularity=load_artifact("models.popularity", schema),
+        workers=workers,
+        executor=executor,
+        score_carts=score_carts,
+        allowed_items=allowed_items,
+        quantize=quantize_als,
     )
+    for model_name in CANDIDATE_GENERATORS:
+        save_artifact(f"data.candidates_{model_name}", candidates_by_model[model_name], schema)
+    candidates = union_candidates(candidates_by_model, budget=budget)
+    print("candidates per receipt = ", candidates.shape[0] / max(candidates["receipt_id"].n_unique(), 1))
+    save_artifact("data.candidates", candidates, schema)
 
-    user_indexes = get_receipt_indexes(receipt_ids=df["receipt_id"], encoder=encoders["receipt_id"])
 
-    candidates_by_model = get_candidates(
-        models=models, uim=spmat, uim_norm=spmat_norm, user_indexes=user_indexes
+@cli.command()
+def inference_sharded(
+    inference_data_path: str = Option(..., envvar="INFERENCE_DATA_PATH"),
+    shards: int = Option(default=os.cpu_count() or 1, help="Number of receipt hash partitions"),
+    workers: int = Option(default=os.cpu_count() or 1),
+    batch_size: int = Option(default=RANKER_BATCH_SIZE),
+    compiled: bool = Option(default=False),
+    score_carts: bool = Option(default=False),
+):
+    from data.artifacts import save_artifact
+    from data.tasks import read_line_items
+    from inference.tasks import run_sharded_inference, union_candidates
+    schema = DataSchema()
+    line_items = read_line_items(inference_data_path)
+
+    start = time.perf_counter()
+    candidates_by_model, pred_final_10 = run_sharded_inference(
+        line_items=line_items, n_shards=shards, workers=workers, compiled=compiled, batch_size=batch_size, score_carts=score_carts
     )
-    for model_name, candidates in candidates_by_model.items():
-        candidates = decode(table=candidates, encoder=encoders["receipt_id"], key="receipt_id", enc_key="receipt_id_enc")
-        candidates = decode(
-            table=candidates, encoder=encoders["item_id"], key="item_id", enc_key="item_id_enc"
-        )
-        candidates_by_model[model_name] = candidates
-        candidates.write_csv(schema.target_paths[f"data.candidates_{model_name}"])
-    
-    popular_candidates = pd.read_csv(schema.target_paths["data.popular_products"])
-    candidates_by_model["popular"] = pl.DataFrame(pd.DataFrame({
-            "model_name": ["popular"] * df["receipt_id"].unique().shape[0],
-            "receipt_id": df["receipt_id"].unique().to_list(),
-            "item_id": [popular_candidates["item_id"].to_list()] * df["receipt_id"].unique().shape[0]
-        }).explode("item_id"))
-    candidates = union_candidates(list(candidates_by_model.values()))
-    candidates.write_csv(schema.target_paths["data.candidates"])
+    elapsed = time.perf_counter() - start
+    # no shard runs on empty input, so there are no candidate frames to save
+    if not candidates_by_model:
+        raise ValueError(f"No line items in {inference_data_path}, nothing to run inference on")
+    print("throughput = ", pred_final_10.shape[0] / elapsed, "receipts/sec")
+
+    for model_name in CANDIDATE_GENERATORS:
+        save_artifact(f"data.candidates_{model_name}", candidates_by_model[model_name], schema)
+    save_artifact("data.candidates", union_candidates(candidates_by_model), schema)
+    pred_final = pred_final_10.with_columns(pl.col("item_id").list.first())
+    save_artifact("data.recommendations", pred_final, schema)
+    save_artifact("data.recommendations_10", pred_final_10, schema)
 
 
 @cli.command()
 def train_ranker(
     train_data_path: str = Option(..., envvar="TRAIN_DATA_PATH"),
-    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH")
+    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH"),
+    n_negatives: int = Option(default=NEGATIVES_PER_POSITIVE),
+    candidate_features: bool = Option(default=RANKER_CANDIDATE_FEATURES, help="Train on generator scores and ranks, needs the candidate models"),
+    candidate_negatives: int = Option(default=CANDIDATE_NEGATIVES, help="Negatives drawn from each receipt's candidates with --candidate-features"),
+    text_features: bool = Option(default=RANKER_TEXT_FEATURES, help="Train on cart to item name similarity, needs embed-items"),
     ):
+    from catboost import CatBoostRanker
+    from configs.model import CANDIDATE_FEATURES, RANKER_FEATURES, TEXT_FEATURES
+    from data.artifacts import load_artifact, save_artifact
+    from data.tasks import generate_features, join_candidates_features, join_cart_similarity, join_context_features, read_line_items
+    from inference.tasks import candidate_training_pairs, generate_candidates, union_candidates
 
     schema = DataSchema()
-    train_li = pl.read_csv(train_data_path, separator="\t")
-    val_li = pl.read_csv(val_data_path, separator="\t")
-    ds, prices, quantities, popularity = generate_features(train=train_li, val=val_li)
+    train_li = read_line_items(train_data_path)
+    val_li = read_line_items(val_data_path)
+    popularity = load_artifact("models.popularity", schema)
+    ds, item_features = generate_features(train=train_li, val=val_li, n_negatives=n_negatives, popularity=popularity)
+    context_items = ds.select(["receipt_id", "context"]).explode("context").rename({"context": "item_id"})
 
     pos_ds = ds.select(["positives", "receipt_id", "pos_price", "pos_quantity", "context_price", "context_quantity", "context_popularity", "pos_popularity"]).with_columns(pl.lit(1).alias("target")).rename({
         "positives": "item_id",
@@ -99,68 +310,189 @@ def train_ranker(
         "pos_quantity": "quantity",
         "pos_popularity": "popularity"
     })
-    neg_ds = ds.select(["negatives", "receipt_id", "neg_price", "neg_quantity", "context_price", "context_quantity", "context_popularity", "neg_popularity"]).with_columns(pl.lit(0).alias("target")).rename({
+    neg_ds = ds.select(["negatives", "receipt_id", "neg_price", "neg_quantity", "context_price", "context_quantity", "context_popularity", "neg_popularity"]).explode(["negatives", "neg_price", "neg_quantity", "neg_popularity"]).with_columns(pl.lit(0).alias("target")).rename({
         "negatives": "item_id",
         "neg_price": "price",
         "neg_quantity": "quantity",
         "neg_popularity": "popularity"
     })
     ds = pl.concat((pos_ds, neg_ds)).sort("receipt_id")
-    
+
+    features = RANKER_FEATURES
+    if candidate_features:
+        # the candidate stage runs on every training cart without its positive, exactly as it would at inference
+        context_li = (
+            pl.concat((train_li, val_li))
+            .join(pos_ds.select(["receipt_id", "item_id"]), on=["receipt_id", "item_id"], how="anti")
+            .join(pos_ds.select("receipt_id"), on="receipt_id", how="semi")
+        )
+        candidates = union_candidates(generate_candidates(
+            line_items=context_li,
+            models=load_artifact("models.implicit_models", schema),
+            spmat=load_artifact("models.spmat", schema),
+            spmat_norm=load_artifact("models.spmat_norm", schema),
+            encoders=load_artifact("models.encoders", schema),
+            popularity=popularity,
+            score_carts=True,
+        ), budget=CANDIDATES_BUDGET)
+        ds = candidate_training_pairs(pos_ds, candidates.select(["receipt_id", "item_id", *CANDIDATE_FEATURES]), n_negatives=candidate_negatives)
+        ds = join_candidates_features(candidates=ds, store=item_features).join(
+            join_context_features(context=context_li, store=item_features), on="receipt_id"
+        )
+        features = RANKER_FEATURES + CANDIDATE_FEATURES
+    if text_features:
+        ds = join_cart_similarity(ds, context=context_items, embeddings=load_artifact("models.item_embeddings", schema))
+        features = features + TEXT_FEATURES
+
     ranker = CatBoostRanker(verbose=250, loss_function="PairLogit", random_seed=2105)
-    ranker.fit(X=ds.select(["price", "quantity", "popularity", "context_price", "context_quantity", "context_popularity"]).to_pandas(), y=ds["target"].to_pandas(), group_id=ds["receipt_id"].to_pandas())
-    joblib.dump(ranker, schema.target_paths["models.ranker"])
-    prices.write_csv(schema.target_paths["data.prices"])
-    quantities.write_csv(schema.target_paths["data.quantities"])
-    popularity.write_csv(schema.target_paths["data.popularity"])
+    with profile_step("fit.ranker", rows=ds.shape[0]):
+        ranker.fit(X=ds.select(features).to_pandas(), y=ds["target"].to_pandas(), group_id=ds["receipt_id"].to_pandas())
+    ranker.get_metadata()["item_features_version"] = item_features.version
+    save_artifact("models.ranker", ranker, schema)
+    save_artifact("models.item_features", item_features, schema)
+
+
+@cli.command()
+def export_ranker(
+    batch_rows: int = Option(default=50, help="Rows per scoring call in the latency comparison"),
+):
+    import numpy as np
+    from data.artifacts import load_artifact, save_artifact
+    from inference.tasks import compile_ranker, predict_scores
+    schema = DataSchema()
+    ranker = load_artifact("models.ranker", schema)
+    compiled, max_diff = compile_ranker(ranker)
+    print("max abs difference from CatBoost = ", max_diff)
+
+    batch = pl.DataFrame(np.random.default_rng(RANDOM_STATE).random((batch_rows, len(compiled.feature_names))), schema=compiled.feature_names)
+    for name, model in (("catboost", ranker), ("compiled", compiled)):
+        predict_scores(model, batch, compiled.feature_names)
+        start = time.perf_counter()
+        for _ in range(100):
+            predict_scores(model, batch, compiled.feature_names)
+        print(f"{name}: {(time.perf_counter() - start) / 100 * 1e6:.0f} us per {batch_rows} rows")
+    save_artifact("models.ranker_compiled", compiled, schema)
 
 
 @cli.command()
 def make_recommendations(
-    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH")
+    val_data_path: Optional[str] = Option(default=None, envvar="VAL_DATA_PATH"),
+    batch_size: int = Option(default=RANKER_BATCH_SIZE),
+    per_receipt: bool = Option(default=False),
+    compiled: bool = Option(default=False, help="Score with the ranker exported by export-ranker"),
 ):
+    from data.artifacts import load_artifact, save_artifact
+    from data.tasks import read_line_items
+    from inference.tasks import check_ranker_version, rank_candidates, uses_text_features
     schema = DataSchema()
-    context_df = pl.read_csv(val_data_path, separator="\t").select(["receipt_id", "item_id"]).group_by("receipt_id").agg(pl.col("item_id").alias("context"))
-    candidates = pl.read_csv(schema.target_paths["data.candidates"]).select(["receipt_id", "item_id"])
-    prices = pl.read_csv(schema.target_paths["data.prices"])
-    popularity = pl.read_csv(schema.target_paths["data.popularity"])
-    quantities = pl.read_csv(schema.target_paths["data.quantities"])
-    ranker = joblib.load(schema.target_paths["models.ranker"])
-
-    context_with_features = join_context_features(context=context_df, prices=prices, quantities=quantities, popularity=popularity)
-    candidates_with_features = join_candidates_features(candidates=candidates, prices=prices, quantities=quantities, popularity=popularity)
-    ds = context_with_features.join(candidates_with_features, on="receipt_id", how="left")
-   
-    predictions = {
-        "receipt_id": [],
-        "item_id": [],
-        "score": []
-    }
-    for receipt_id in tqdm(ds["receipt_id"].unique()):
-        receipt_items = ds.filter(pl.col("receipt_id") == receipt_id)
-        score = ranker.predict(receipt_items.select(["price", "quantity", "popularity", "context_price", "context_quantity", "context_popularity"]).to_pandas())
-        predictions["receipt_id"].append(receipt_id)
-        predictions["item_id"].append(receipt_items["item_id"].to_list())
-        predictions["score"].append(score)
-
-
-    predictions = pl.DataFrame(predictions)
-
-    pred_final = predictions.explode(["item_id", "score"]).sort(["receipt_id", "score"], descending=True).group_by("receipt_id").agg(pl.col("item_id").first())
-    pred_final.write_csv(schema.target_paths["data.recommendations"], separator=";")
-    pred_final_10 = predictions.explode(["item_id", "score"]).sort(["receipt_id", "score"], descending=True).group_by("receipt_id").agg(pl.col("item_id").head(10))
-    pred_final_10.write_parquet(schema.target_paths["data.recommendations_10"])
+    context_df = read_line_items(val_data_path).select(["receipt_id", "item_id"])
+    candidates = load_artifact("data.candidates", schema)
+    item_features = load_artifact("models.item_features", schema)
+    ranker = load_artifact("models.ranker_compiled" if compiled else "models.ranker", schema)
+    check_ranker_version(ranker, item_features)
+
+    item_embeddings = load_artifact("models.item_embeddings", schema) if uses_text_features(ranker) else None
+
+    start = time.perf_counter()
+    pred_final_10 = rank_candidates(
+        context=context_df,
+        candidates=candidates,
+        item_features=item_features,
+        ranker=ranker,
+        batch_size=batch_size,
+        per_receipt=per_receipt,
+        item_embeddings=item_embeddings,
+    )
+    elapsed = time.perf_counter() - start
+    if pred_final_10.shape[0] == 0 and candidates.shape[0] > 0:
+        raise ValueError(f"No candidate receipts in {val_data_path}, pass the data inference-candidates ran on")
+    print("throughput = ", pred_final_10.shape[0] / elapsed, "receipts/sec")
+
+    pred_final = pred_final_10.with_columns(pl.col("item_id").list.first())
+    save_artifact("data.recommendations", pred_final, schema)
+    save_artifact("data.recommendations_10", pred_final_10, schema)
 
 
 @cli.command()
 def evaluate_common_metrics(
     target_path: str = Option(..., envvar="TARGET_PATH"),
 ):
+    from data.artifacts import load_artifact, save_artifact
+    from evaluation.tasks import evaluate_recommendations
+    schema = DataSchema()
+    val_target = pl.read_csv(target_path, separator="\t")
+    metrics = evaluate_recommendations(
+        recommendations=load_artifact("data.recommendations_10", schema),
+        target=val_target,
+        n_items=len(load_artifact("models.encoders", schema)["item_id"]),
+    )
+    for name, value in metrics.items():
+        print(f"{name} = ", value)
+    save_artifact("metrics.common", metrics, schema)
+
+
+@cli.command()
+def evaluate_candidates_metrics(
+    target_path: str = Option(..., envvar="TARGET_PATH"),
+):
+    from data.artifacts import load_artifact, save_artifact
+    from evaluation.tasks import evaluate_candidates
     schema = DataSchema()
-    val_target = pl.read_csv(target_path, separator='\t')
-    recs = pl.read_csv(schema.target_paths["data.recommendations"], separator=';').rename({"item_id":"pred_id"})
-    res = val_target.join(recs, on="receipt_id", how="left").filter(pl.col("item_id") == pl.col("pred_id"))
-    print("accuracy = ", res.shape[0] / val_target.shape[0])
+    candidates_by_model = {model_name: load_artifact(f"data.candidates_{model_name}", schema) for model_name in CANDIDATE_GENERATORS}
+    candidates_by_model["union"] = load_artifact("data.candidates", schema)
+    report = evaluate_candidates(candidates_by_model, target=pl.read_csv(target_path, separator="\t"))
+    with pl.Config(tbl_rows=-1):
+        print(report)
+    save_artifact("metrics.candidates", report.to_dicts(), schema)
+
+
+@cli.command()
+def run_all(
+    train_data_path: str = Option(..., envvar="TRAIN_DATA_PATH"),
+    val_data_path: str = Option(..., envvar="VAL_DATA_PATH"),
+    inference_data_path: Optional[str] = Option(default=None, envvar="INFERENCE_DATA_PATH", help="Defaults to the validation data"),
+    target_path: Optional[str] = Option(default=None, envvar="TARGET_PATH", help="Metrics are skipped without a target"),
+    workers: int = Option(default=2, help="Independent stages run in parallel up to this number"),
+    hash_inputs: bool = Option(default=False, help="Fingerprint input files by content instead of size and mtime"),
+    force: bool = Option(default=False, help="Rerun every stage regardless of the stage manifest"),
+):
+    from pipeline.tasks import STAGES, run_pipeline
+    paths = {"train": train_data_path, "val": val_data_path, "inference": inference_data_path or val_data_path, "target": target_path}
+    stages = [stage for stage in STAGES if all(paths[name] for name in STAGES[stage]["inputs"])]
+    report = run_pipeline(paths=paths, stages=stages, workers=workers, hash_inputs=hash_inputs, force=force)
+    print(report)
+
+
+@cli.command()
+def run_pipeline(
+    train_data_path: str = Option(..., envvar="TRAIN_DATA_PATH"),
+    val_data_path: str = Option(..., envvar="VAL_DATA_PATH"),
+    inference_data_path: Optional[str] = Option(default=None, envvar="INFERENCE_DATA_PATH", help="Defaults to the validation data"),
+    target_path: Optional[str] = Option(default=None, envvar="TARGET_PATH", help="Metrics are skipped without a target"),
+    save_artifacts: bool = Option(default=False, help="Write every intermediate artifact, not only recommendations and metrics"),
+):
+    from typer.main import get_command
+    from pipeline.tasks import STAGES, run_in_process
+    paths = {"train": train_data_path, "val": val_data_path, "inference": inference_data_path or val_data_path, "target": target_path}
+    stages = [stage for stage in STAGES if all(paths[name] for name in STAGES[stage]["inputs"])]
+    command = get_command(cli)
+    start = time.perf_counter()
+    report = run_in_process(
+        paths=paths,
+        invoke=lambda stage, args: command.main([stage, *args], prog_name="workflow.py", standalone_mode=False),
+        stages=stages,
+        save_artifacts=save_artifacts,
+    )
+    print(report)
+    print(f"total {time.perf_counter() - start:.1f} sec")
+
+
+@cli.command()
+def describe_artifacts():
+    from data.artifacts import describe_artifacts as describe_artifacts_table
+    with pl.Config(tbl_rows=-1, fmt_str_lengths=80):
+        print(describe_artifacts_table(DataSchema()))
+
 
 if __name__ == "__main__":
     cli()
\ No newline at end of file
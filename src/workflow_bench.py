@@ -0,0 +1,49 @@
+from typing import Optional
+
+import polars as pl
+from typer import Option, Typer
+from configs.schema import DataSchema
+from benchmark.tasks import FUNCTIONS, run_benchmarks
+from benchmark.utils import generate_dataset
+
+cli = Typer()
+
+
+@cli.command()
+def generate_data(
+    output_dir: str = Option(default="../data/synthetic"),
+    n_receipts: int = Option(default=100_000),
+    n_items: int = Option(default=5_000),
+    zipf_exponent: float = Option(default=1.1),
+    mean_basket_size: float = Option(default=4.0),
+    seed: int = Option(default=0),
+):
+    paths = generate_dataset(
+        output_dir, n_receipts=n_receipts, n_items=n_items, zipf_exponent=zipf_exponent, mean_basket_size=mean_basket_size, seed=seed
+    )
+    for name, path in paths.items():
+        print(name, path)
+
+
+@cli.command()
+def run(
+    scales: str = Option(default="1000,10000,100000", help="Comma-separated receipt counts"),
+    n_items: int = Option(default=5_000),
+    functions: str = Option(default=",".join(FUNCTIONS)),
+    output_path: Optional[str] = Option(default=None, help="JSON lines file the results are appended to"),
+    seed: int = Option(default=0),
+):
+    schema = DataSchema()
+    results = run_benchmarks(
+        scales=[int(scale) for scale in scales.split(",")],
+        n_items=n_items,
+        output_path=output_path or schema.target_paths["metrics.benchmarks"],
+        functions=[name for name in functions.split(",") if name],
+        seed=seed,
+    )
+    with pl.Config(tbl_rows=-1):
+        print(results.select(["n_receipts", "kind", "name", "seconds", "cpu_seconds", "peak_rss_mb", "rows"]))
+
+
+if __name__ == "__main__":
+    cli()
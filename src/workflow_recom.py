@@ -1,11 +1,19 @@
-from typer import Typer
+import asyncio
+import typing as tp
+
+from typer import Option, Typer
+from configs.model import SERVING_BATCH_WINDOW_MS, SERVING_MAX_BATCH_SIZE
 from configs.schema import DataSchema
 
-import polars as pl
+cli = Typer()
 
 
+@cli.command()
 def recom_by_receipt_id():
+    from serving.utils import RecommendationIndex
+
     schema = DataSchema()
+    index = RecommendationIndex(schema.target_paths["data.recommendations_10"])
 
     while True:
         receipt_id = input("Input receipt id: ['exit' to stop] ")
@@ -13,10 +21,75 @@ def recom_by_receipt_id():
         if receipt_id == "exit": break
         receipt_id = int(receipt_id)
 
-        recom: pl.DataFrame = pl.read_parquet(schema.target_paths["data.recommendations_10"])
-    
-        print(recom.filter(pl.col("receipt_id") == receipt_id))
+        index.reload_if_changed()
+        print(receipt_id, index.get(receipt_id))
+
+
+@cli.command()
+def serve(
+    host: str = Option(default="127.0.0.1", envvar="RECOM_HOST"),
+    port: int = Option(default=8080, envvar="RECOM_PORT"),
+    reload_interval: float = Option(default=5.0),
+    carts: bool = Option(default=False, help="Score carts posted to /carts with the candidate models and the ranker"),
+    batch_window_ms: float = Option(default=SERVING_BATCH_WINDOW_MS),
+    max_batch_size: int = Option(default=SERVING_MAX_BATCH_SIZE),
+    compiled: bool = Option(default=False, help="Score with the compiled ranker from export-ranker"),
+):
+    from serving.tasks import run_server
+    from serving.utils import RecommendationIndex
+
+    schema = DataSchema()
+    index = RecommendationIndex(schema.target_paths["data.recommendations_10"])
+    index.reload_if_changed()
+    store = None
+    if carts:
+        from serving.models import ModelStore
+        store = ModelStore(schema, compiled=compiled)
+        store.load()
+    asyncio.run(run_server(
+        index=index,
+        host=host,
+        port=port,
+        reload_interval=reload_interval,
+        store=store,
+        batch_window_ms=batch_window_ms,
+        max_batch_size=max_batch_size,
+    ))
+
+
+@cli.command()
+def load_test(
+    carts_path: str = Option(..., envvar="INFERENCE_DATA_PATH"),
+    windows_ms: str = Option(default="0,2,5,10,20", help="Comma separated batch windows to compare"),
+    concurrency: int = Option(default=32),
+    n_requests: int = Option(default=2000),
+    n_carts: tp.Optional[int] = Option(default=None),
+    max_batch_size: int = Option(default=SERVING_MAX_BATCH_SIZE),
+    swap_interval: tp.Optional[float] = Option(default=None, help="Reload the models every N seconds during the test"),
+    compiled: bool = Option(default=False),
+):
+    import polars as pl
+    from data.artifacts import save_artifact
+    from serving.models import ModelStore
+    from serving.tasks import run_load_test
+    from serving.utils import load_carts
+
+    schema = DataSchema()
+    store = ModelStore(schema, compiled=compiled)
+    store.load()
+    report = run_load_test(
+        store=store,
+        carts=load_carts(carts_path, limit=n_carts),
+        windows_ms=[float(window) for window in windows_ms.split(",")],
+        concurrency=concurrency,
+        n_requests=n_requests,
+        max_batch_size=max_batch_size,
+        swap_interval=swap_interval,
+    )
+    with pl.Config(tbl_cols=-1, tbl_width_chars=200):
+        print(report)
+    save_artifact("metrics.serving", report, schema)
 
 
 if __name__ == "__main__":
-    recom_by_receipt_id()
\ No newline at end of file
+    cli()